@@ -0,0 +1,98 @@
+from common.pmessage import PMessage
+from common.robot import RobotRef
+
+class CommandCompiler(object):
+    """
+    compile a list of actions (mf,mf*N,tl,tr,tb) into the command stream sent to the robot in one pass
+    consecutive mf are merged into mf*N, consecutive turns are folded into the shortest equivalent turn,
+    callibration messages can be inserted after the commands
+    `callibration_func`: function (pos,ori) => list of messages to send once the robot reaches that pose
+    """
+    TURN_TO_QUARTERS = {PMessage.M_TURN_RIGHT:1,PMessage.M_TURN_BACK:2,PMessage.M_TURN_LEFT:3}
+    QUARTERS_TO_TURNS = {0:[],1:[PMessage.M_TURN_RIGHT],2:[PMessage.M_TURN_BACK],3:[PMessage.M_TURN_LEFT]}
+
+    _merge_move_forward = True
+    _max_move_forward = PMessage.MAX_MOVE_FORWARD_STEPS # longest mf*N the robot accepts
+    _fold_turns = True
+    _callibration_func = None
+
+    # compile state
+    _output = None # list of commands and callibration messages
+    _robot = None # RobotRef following the compiled commands, only used for callibration
+    _num_moves = 0 # mf not written yet
+    _turns = None # turns not written yet
+
+    def __init__(self,**kwargs):
+        self._merge_move_forward = kwargs.get("merge_move_forward",True)
+        self._max_move_forward = kwargs.get("max_move_forward",PMessage.MAX_MOVE_FORWARD_STEPS)
+        self._fold_turns = kwargs.get("fold_turns",True)
+        self._callibration_func = kwargs.get("callibration_func",None)
+
+    def compile(self,actions,start_pos=None,start_ori=None):
+        "return the list of commands, with callibration messages in between, the start pose is needed for callibration"
+        self._output = []
+        self._num_moves = 0
+        self._turns = []
+        if (self._callibration_func):
+            if (start_pos is None or start_ori is None):
+                raise Exception("start pose is needed to insert callibration messages")
+            self._robot = RobotRef(ori=start_ori,pos=start_pos)
+        for action in actions:
+            if (action.startswith(PMessage.M_MOVE_FORWARD)):
+                if (self._turns and self._fold_turns and self._get_quarters(self._turns)==0 and self._can_fold(self._turns)):
+                    # the turns cancel out, keep merging the moves around them
+                    self._turns = []
+                elif (self._turns):
+                    self._flush_moves()
+                    self._flush_turns()
+                for i in range(int(action.split("*")[1]) if "*" in action else 1):
+                    self._num_moves += 1
+                    if (not self._merge_move_forward or self._num_moves==self._max_move_forward):
+                        self._flush_moves()
+            elif (action in self.TURN_TO_QUARTERS):
+                self._turns.append(action)
+            else:
+                raise Exception("cannot compile action {}".format(action))
+        self._flush_moves()
+        self._flush_turns()
+        return self._output
+
+    def _flush_moves(self):
+        if (self._num_moves>1):
+            self._write("{}*{}".format(PMessage.M_MOVE_FORWARD,self._num_moves))
+        elif (self._num_moves==1):
+            self._write(PMessage.M_MOVE_FORWARD)
+        self._num_moves = 0
+
+    def _flush_turns(self):
+        turns,self._turns = self._turns,[]
+        if (not turns):
+            return
+        if (not self._fold_turns or not self._can_fold(turns)):
+            for turn in turns:
+                self._write(turn)
+            return
+        for turn in self.QUARTERS_TO_TURNS[self._get_quarters(turns)]:
+            self._write(turn)
+
+    def _get_quarters(self,turns):
+        "return the number of quarter turns to the right that turns add up to, from 0 to 3"
+        return sum([self.TURN_TO_QUARTERS[turn] for turn in turns])%4
+
+    def _can_fold(self,turns):
+        "turns following the moves not written yet are not folded if the robot should callibrate in between"
+        if (not self._callibration_func):
+            return True
+        pos,ori = self._robot.get_pose_after([PMessage.M_MOVE_FORWARD]*self._num_moves)
+        for turn in turns[:-1]:
+            ori = ori.if_applied_action(turn)
+            if (self._callibration_func(pos,ori)):
+                return False
+        return True
+
+    def _write(self,command):
+        self._output.append(command)
+        if (self._callibration_func):
+            pos,ori = self._robot.get_pose_after([command])
+            self._robot.reset(ori=ori,pos=pos)
+            self._output.extend(self._callibration_func(pos,ori))
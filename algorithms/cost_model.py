@@ -0,0 +1,145 @@
+import json
+import re
+from common.pmessage import PMessage
+
+class ExecutionCostModel(object):
+    """
+    predicted time the robot takes to execute each command,
+    mf*N takes move_overhead+N*move_per_grid, the overhead being the acceleration and deceleration of every move,
+    every callibration stop takes callibration,
+    the default parameters are the grid step costs of the planners, fit() learns them in seconds from recorded runs
+    """
+    PARAM_NAMES = ['move_overhead','move_per_grid','turn_left','turn_right','turn_back','callibration']
+    DEFAULT_PARAMS = {'move_overhead':0,'move_per_grid':1,'turn_left':2,'turn_right':2,'turn_back':4,'callibration':0}
+    DEFAULT_CALLIBRATION_TIME = 1 # seconds, ArduinoInterface waits this long after a callibration message
+    CALLIBRATION_MSGS = [PMessage.M_CALLIBRATE_FRONT,PMessage.M_CALLIBRATE_LEFT,PMessage.M_CALLIBRATE_RIGHT]
+
+    _params = None # dict of parameter name => value
+
+    def __init__(self,**kwargs):
+        self._params = dict(self.DEFAULT_PARAMS)
+        for name in self.PARAM_NAMES:
+            if (kwargs.get(name) is not None):
+                self._params[name] = kwargs.get(name)
+
+    def get_params(self):
+        return dict(self._params)
+
+    def get_key(self):
+        "return a hashable value identifying the parameters"
+        return tuple([self._params[name] for name in self.PARAM_NAMES])
+
+    def get_move_forward_time(self,num_steps):
+        return self._params['move_overhead'] + num_steps*self._params['move_per_grid']
+
+    def get_min_time_per_grid(self,max_steps):
+        "return the lowest time per grid of a move of at most max_steps grids"
+        return min([self.get_move_forward_time(n)*1.0/n for n in range(1,max_steps+1)])
+
+    def get_turn_time(self,action):
+        if (action==PMessage.M_TURN_LEFT):
+            return self._params['turn_left']
+        elif (action==PMessage.M_TURN_RIGHT):
+            return self._params['turn_right']
+        elif (action==PMessage.M_TURN_BACK):
+            return self._params['turn_back']
+        raise Exception("{} is not a turn".format(action))
+
+    def get_callibration_time(self):
+        return self._params['callibration']
+
+    def get_command_time(self,command):
+        "command is a move command, a callibration message or a PMessage of either, other messages take no time"
+        if (isinstance(command,PMessage)):
+            command = command.get_msg()
+        if (command.startswith(PMessage.M_MOVE_FORWARD)):
+            return self.get_move_forward_time(int(command.split("*")[1]) if "*" in command else 1)
+        elif (command in (PMessage.M_TURN_LEFT,PMessage.M_TURN_RIGHT,PMessage.M_TURN_BACK)):
+            return self.get_turn_time(command)
+        elif (command in self.CALLIBRATION_MSGS):
+            return self.get_callibration_time()
+        return 0
+
+    def get_run_time(self,commands):
+        "return the predicted time of executing the list of commands"
+        return sum([self.get_command_time(command) for command in commands])
+
+    def save(self,file_name):
+        with open(file_name,"w") as f:
+            json.dump(self._params,f,indent=1,sort_keys=True)
+
+    @staticmethod
+    def load(file_name):
+        with open(file_name) as f:
+            return ExecutionCostModel(**json.load(f))
+
+    @staticmethod
+    def fit(samples):
+        "return the model fitted to samples, a list of (command,seconds)"
+        moves,turns,callibrations = [],{},[]
+        for command,seconds in samples:
+            if (command.startswith(PMessage.M_MOVE_FORWARD)):
+                moves.append((int(command.split("*")[1]) if "*" in command else 1,seconds))
+            elif (command in (PMessage.M_TURN_LEFT,PMessage.M_TURN_RIGHT,PMessage.M_TURN_BACK)):
+                turns.setdefault(command,[]).append(seconds)
+            elif (command in ExecutionCostModel.CALLIBRATION_MSGS):
+                callibrations.append(seconds)
+        if (not moves or not (turns.get(PMessage.M_TURN_LEFT) or turns.get(PMessage.M_TURN_RIGHT))):
+            raise Exception("not enough samples, both moves and turns are needed")
+        params = {}
+        params['move_overhead'],params['move_per_grid'] = _fit_line(moves)
+        mean = lambda values:sum(values)/float(len(values))
+        turn_left,turn_right = turns.get(PMessage.M_TURN_LEFT),turns.get(PMessage.M_TURN_RIGHT)
+        params['turn_left'] = mean(turn_left or turn_right)
+        params['turn_right'] = mean(turn_right or turn_left)
+        if (turns.get(PMessage.M_TURN_BACK)):
+            params['turn_back'] = mean(turns[PMessage.M_TURN_BACK])
+        else:
+            params['turn_back'] = params['turn_left']+params['turn_right']
+        params['callibration'] = mean(callibrations) if callibrations else ExecutionCostModel.DEFAULT_CALLIBRATION_TIME
+        return ExecutionCostModel(**params)
+
+
+def _fit_line(points):
+    "return (a,b) of the least squares fit of y = a+b*x with a>=0, points is a list of (x,y)"
+    n = float(len(points))
+    mean_x = sum([x for x,y in points])/n
+    mean_y = sum([y for x,y in points])/n
+    var_x = sum([(x-mean_x)**2 for x,y in points])
+    if (var_x>0):
+        b = sum([(x-mean_x)*(y-mean_y) for x,y in points])/var_x
+        a = mean_y-b*mean_x
+        if (a>=0):
+            return a,b
+    # a single move length or a negative overhead, fit a line through the origin
+    return 0.0,sum([x*y for x,y in points])/float(sum([x*x for x,y in points]))
+
+
+# lines written by interfaces.real.ArduinoInterface with DEBUG_INTERFACE enabled
+WRITE_LINE_PATTERN = re.compile(r'(\d+)SER--Write to Arduino b4: (\S+)')
+ACK_LINE_PATTERN = re.compile(r'(\d+)SER--Read from Arduino after[23]: ({.*})')
+
+def parse_ack_log(lines):
+    """
+    return a list of (command,seconds) from the lines of a debug log,
+    a move lasts from its write to its ack, a callibration lasts until the next write,
+    moves whose ack is missing are skipped
+    """
+    samples = []
+    pending = None # (command,write time in milliseconds)
+    for line in lines:
+        match = WRITE_LINE_PATTERN.search(line)
+        if (match):
+            time,command = int(match.group(1)),match.group(2)
+            if (pending and pending[0] in ExecutionCostModel.CALLIBRATION_MSGS):
+                samples.append((pending[0],(time-pending[1])/1000.0))
+            pending = (command,time) if command in PMessage.VALID_MOVE_COMMAND_SET or \
+                                        command in ExecutionCostModel.CALLIBRATION_MSGS else None
+            continue
+        match = ACK_LINE_PATTERN.search(line)
+        if (match and pending and pending[0] in PMessage.VALID_MOVE_COMMAND_SET):
+            ack = PMessage(json_str=match.group(2),validate=False)
+            if (ack.get_type()==PMessage.T_ROBOT_MOVE):
+                samples.append((pending[0],(int(match.group(1))-pending[1])/1000.0))
+                pending = None
+    return samples
@@ -0,0 +1,259 @@
+from common import *
+from common.utils import HeapMinQueue
+from common.popattern import BaseObserver
+from collections import deque
+import weakref
+
+class DistanceField(BaseObserver):
+    """
+    number of moves between every robot centre and the source position, computed by one BFS over the arena
+    the robot can only be centred where MapRef.is_accessible_centre() is True,
+    the field listens to the MapRef and is only recomputed when the accessibility of some centre has changed
+    """
+    NEIGHBOUR_DELTAS = [(0,-1),(1,0),(0,1),(-1,0)]
+
+    _map_ref = None
+    _source_pos = None
+    _size_x = 0
+    _distances = None # flat list indexed by y*size_x+x, None if unreachable
+    _accessible = None # bytearray snapshot of the accessible centres the field was computed for
+    _changed_pos = None # set of positions changed since the last computation, None means the whole map
+    _map_version = None # version of the map at the last refresh
+
+    def __init__(self,map_ref,source_pos):
+        self._map_ref = map_ref
+        self._source_pos = source_pos
+        self._changed_pos = None
+        map_ref.add_change_listener(self)
+
+    def update(self,data=None):
+        "map change notification, data is the list of changed positions, None means the whole map"
+        if (data is None or self._changed_pos is None):
+            self._changed_pos = None
+        else:
+            self._changed_pos.update(data)
+
+    def get_source_pos(self):
+        return self._source_pos
+
+    def get_distance(self,x,y):
+        "return the number of moves between (x,y) and the source, None if the robot cannot go there"
+        self._refresh()
+        if (self._map_ref.is_out_of_arena(x,y)):
+            return None
+        return self._distances[y*self._size_x+x]
+
+    def is_reachable(self,x,y):
+        return self.get_distance(x,y) is not None
+
+    def _refresh(self):
+        "recompute the field if a change since the last computation made a centre (in)accessible"
+        map_ref = self._map_ref
+        if (map_ref.get_version()!=self._map_version):
+            # notifications are held back while the map is in a batch
+            self.update(map_ref.get_pending_changes())
+            self._map_version = map_ref.get_version()
+        changed_pos,self._changed_pos = self._changed_pos,set()
+        if (changed_pos is None or self._is_accessibility_changed(changed_pos)):
+            self._snapshot_accessibility()
+            self._compute()
+
+    def _is_accessibility_changed(self,changed_pos):
+        map_ref,accessible,size_x = self._map_ref,self._accessible,self._size_x
+        if (len(accessible)!=map_ref.get_size_x()*map_ref.get_size_y()):
+            return True
+        checked = set()
+        for x,y in changed_pos:
+            # the robot footprint is 3x3, a cell change affects the centres around it
+            for dx in (-1,0,1):
+                for dy in (-1,0,1):
+                    pos = (x+dx,y+dy)
+                    if (pos in checked or map_ref.is_out_of_arena(*pos)):
+                        continue
+                    checked.add(pos)
+                    if (map_ref.is_accessible_centre(*pos)!=bool(accessible[pos[1]*size_x+pos[0]])):
+                        return True
+        return False
+
+    def _snapshot_accessibility(self):
+        map_ref = self._map_ref
+        self._size_x = map_ref.get_size_x()
+        self._accessible = bytearray(self._size_x*map_ref.get_size_y())
+        for x,y in map_ref.get_accessible_centre_pos():
+            self._accessible[y*self._size_x+x] = 1
+
+    def _is_accessible(self,x,y):
+        return not self._map_ref.is_out_of_arena(x,y) and self._accessible[y*self._size_x+x]==1
+
+    def _compute(self):
+        size_x = self._size_x
+        distances = [None]*len(self._accessible)
+        self._distances = distances
+        source_x,source_y = self._source_pos
+        if (not self._is_accessible(source_x,source_y)):
+            return
+        distances[source_y*size_x+source_x] = 0
+        pos_q = deque([self._source_pos])
+        while (pos_q):
+            x,y = pos_q.popleft()
+            distance = distances[y*size_x+x]+1
+            for dx,dy in self.NEIGHBOUR_DELTAS:
+                next_x,next_y = x+dx,y+dy
+                if (self._is_accessible(next_x,next_y) and distances[next_y*size_x+next_x] is None):
+                    distances[next_y*size_x+next_x] = distance
+                    pos_q.append((next_x,next_y))
+
+
+class TurnAwareDistanceField(DistanceField):
+    """
+    cost of every state (x,y,orientation) with turns costing `turn_cost` and moves costing `move_cost`,
+    computed by one Dijkstra search over the arena
+    without `source_ori` the cost is the one of reaching the source position from the state, in any orientation,
+    with `source_ori` it is the one of reaching the state from the source pose
+    """
+    STATE_ORI_VALUES = [NORTH.get_value(),EAST.get_value(),SOUTH.get_value(),WEST.get_value()]
+
+    _source_ori = None
+    _turn_cost = 2
+    _move_cost = 1
+    _costs = None # flat list indexed by (y*size_x+x)*8+ori_value, None if unreachable
+
+    def __init__(self,map_ref,source_pos,source_ori=None,turn_cost=2,move_cost=1):
+        self._source_ori = source_ori
+        self._turn_cost = turn_cost
+        self._move_cost = move_cost
+        DistanceField.__init__(self,map_ref=map_ref,source_pos=source_pos)
+
+    def get_source_ori(self):
+        return self._source_ori
+
+    def get_cost(self,x,y,ori):
+        "return the cost of the state (x,y,ori), None if the robot cannot go there"
+        self._refresh()
+        if (self._map_ref.is_out_of_arena(x,y)):
+            return None
+        return self._costs[(y*self._size_x+x)*8+ori.get_value()]
+
+    def get_distance(self,x,y):
+        "return the lowest cost of the states at (x,y), None if the robot cannot go there"
+        self._refresh()
+        if (self._map_ref.is_out_of_arena(x,y)):
+            return None
+        return self._distances[y*self._size_x+x]
+
+    def _compute(self):
+        size_x = self._size_x
+        costs = [None]*(len(self._accessible)*8)
+        self._costs = costs
+        self._distances = [None]*len(self._accessible)
+        source_x,source_y = self._source_pos
+        if (not self._is_accessible(source_x,source_y)):
+            return
+        if (self._source_ori):
+            sources = [(source_x,source_y,self._source_ori.get_value())]
+        else:
+            sources = [(source_x,source_y,ori_value) for ori_value in self.STATE_ORI_VALUES]
+        index = lambda state:(state[1]*size_x+state[0])*8+state[2]
+        state_q = HeapMinQueue(key=lambda state:costs[index(state)])
+        for state in sources:
+            costs[index(state)] = 0
+            state_q.enqueue(state)
+        # searching from the source pose follows the edges forward, searching to the source position backward
+        get_neighbours = self._get_successors if self._source_ori else self._get_predecessors
+        while (not state_q.is_empty()):
+            state = state_q.dequeue_min()
+            cost = costs[index(state)]
+            pos_index = state[1]*size_x+state[0]
+            if (self._distances[pos_index] is None or cost<self._distances[pos_index]):
+                self._distances[pos_index] = cost
+            for next_state,step_cost in get_neighbours(state):
+                next_cost = cost+step_cost
+                old_cost = costs[index(next_state)]
+                if (old_cost is None or next_cost<old_cost):
+                    costs[index(next_state)] = next_cost
+                    state_q.enqueue(next_state)
+
+    def _get_successors(self,state):
+        "return a list of (state,cost) reached by tl, tr and mf"
+        x,y,ori_value = state
+        neighbours = [((x,y,(ori_value+6)%8),self._turn_cost),((x,y,(ori_value+2)%8),self._turn_cost)]
+        delta_x,delta_y = AbsoluteOrientation.get_instance(ori_value).to_pos_change()
+        if (self._is_accessible(x+delta_x,y+delta_y)):
+            neighbours.append(((x+delta_x,y+delta_y,ori_value),self._move_cost))
+        return neighbours
+
+    def _get_predecessors(self,state):
+        "return a list of (state,cost) reaching state by tl, tr and mf"
+        x,y,ori_value = state
+        neighbours = [((x,y,(ori_value+2)%8),self._turn_cost),((x,y,(ori_value+6)%8),self._turn_cost)]
+        delta_x,delta_y = AbsoluteOrientation.get_instance(ori_value).to_pos_change()
+        if (self._is_accessible(x-delta_x,y-delta_y)):
+            neighbours.append(((x-delta_x,y-delta_y,ori_value),self._move_cost))
+        return neighbours
+
+
+class ArenaDistanceFields(object):
+    """
+    distance fields of one MapRef, shared by everything asking how far a cell is from the start zone,
+    the end zone, a planner target or the robot, use get_instance() to get the object of a map
+    fields are created on first use and stay up to date with the map
+    """
+    _instances = weakref.WeakKeyDictionary() # MapRef => ArenaDistanceFields
+
+    _map_ref = None
+    _fields = None # source_pos => DistanceField
+    _turn_aware_fields = None # (source_pos,turn_cost,move_cost) => TurnAwareDistanceField to the source
+    _robot_field = None # TurnAwareDistanceField from the last robot pose asked for
+    _robot_field_key = None # (robot_pos,robot_ori,turn_cost,move_cost) of _robot_field
+
+    @staticmethod
+    def get_instance(map_ref):
+        instance = ArenaDistanceFields._instances.get(map_ref)
+        if (instance is None):
+            instance = ArenaDistanceFields(map_ref)
+            ArenaDistanceFields._instances[map_ref] = instance
+        return instance
+
+    def __init__(self,map_ref):
+        "should not be called outside the class"
+        self._map_ref = weakref.proxy(map_ref)
+        self._fields = {}
+        self._turn_aware_fields = {}
+
+    def get_field(self,source_pos):
+        "return the DistanceField counting moves to source_pos"
+        field = self._fields.get(source_pos)
+        if (field is None):
+            field = DistanceField(map_ref=self._map_ref,source_pos=source_pos)
+            self._fields[source_pos] = field
+        return field
+
+    def get_turn_aware_field(self,source_pos,turn_cost=2,move_cost=1):
+        "return the TurnAwareDistanceField of the cost of reaching source_pos"
+        key = (source_pos,turn_cost,move_cost)
+        field = self._turn_aware_fields.get(key)
+        if (field is None):
+            field = TurnAwareDistanceField(map_ref=self._map_ref,source_pos=source_pos,turn_cost=turn_cost,move_cost=move_cost)
+            self._turn_aware_fields[key] = field
+        return field
+
+    def get_robot_field(self,robot_pos,robot_ori,turn_cost=2,move_cost=1):
+        "return the TurnAwareDistanceField of the cost of reaching every state from the robot pose"
+        key = (robot_pos,robot_ori,turn_cost,move_cost)
+        if (key!=self._robot_field_key):
+            self._robot_field = TurnAwareDistanceField(map_ref=self._map_ref,source_pos=robot_pos,source_ori=robot_ori,
+                                                       turn_cost=turn_cost,move_cost=move_cost)
+            self._robot_field_key = key
+        return self._robot_field
+
+    def get_start_field(self):
+        return self.get_field(self._map_ref.get_start_zone_center_pos())
+
+    def get_end_field(self):
+        return self.get_field(self._map_ref.get_end_zone_center_pos())
+
+    def get_distance_from_start(self,x,y):
+        return self.get_start_field().get_distance(x,y)
+
+    def get_distance_from_end(self,x,y):
+        return self.get_end_field().get_distance(x,y)
@@ -0,0 +1,217 @@
+from common import *
+from common.utils import HeapMinQueue
+from common.popattern import BaseObserver
+from common.debug import debug,DEBUG_ALGO
+from algorithms.shortest_path import AStarShortestPathAlgoWithOrientation
+
+INFINITE_COST = float('inf')
+
+class DStarLiteShortestPathAlgo(BaseObserver):
+    """
+    D* Lite over the state space (x,y,orientation), with the same edges and costs as AStarShortestPathAlgoWithOrientation
+    the search runs backwards from the target position, so g of a state is its cost to the target,
+    the planner listens to the MapRef and only repairs the states whose edges changed since the last call,
+    the robot may move between calls, each call returns the shortest path from the current robot pose
+    """
+    UNIT_TURN_COST = AStarShortestPathAlgoWithOrientation.UNIT_TURN_COST
+    UNIT_MOVE_COST = AStarShortestPathAlgoWithOrientation.UNIT_MOVE_COST
+    STATE_ORI_VALUES = [ori.get_value() for ori in AStarShortestPathAlgoWithOrientation.STATE_ORIENTATIONS]
+
+    _map_ref = None
+    _target_pos = None
+    _g = None # dict of (x,y,ori_value) -> cost to the target, missing means infinite
+    _rhs = None # dict of (x,y,ori_value) -> one step lookahead of g
+    _keys = None # dict of queued state -> key
+    _queue = None # HeapMinQueue of inconsistent states
+    _k_m = 0 # key modifier, increased whenever the robot moves
+    _start = None # state of the robot at the last search, None before the first search
+    _accessible = None # dict of (x,y) -> accessibility of the position at the last search
+    _changed_pos = None # set of positions changed since the last search, None means the whole map
+    _map_version = None # version of the map at the last search
+    _num_expanded = 0 # states expanded by the last call
+
+    def __init__(self,map_ref,target_pos):
+        self._map_ref = map_ref
+        self._target_pos = target_pos
+        self._changed_pos = set()
+        map_ref.add_change_listener(self)
+
+    def update(self,data=None):
+        "map change notification, data is the list of changed positions, None means the whole map"
+        if (data is None or self._changed_pos is None):
+            self._changed_pos = None
+        else:
+            self._changed_pos.update(data)
+
+    def get_shortest_path(self,robot_pos,robot_ori):
+        "return a list of commands for walking through the shortest path"
+        self.replan(robot_pos=robot_pos,robot_ori=robot_ori)
+        return self._get_command_list()
+
+    def replan(self,robot_pos,robot_ori):
+        "bring the search up to date with the map and the robot pose"
+        start = (robot_pos[0],robot_pos[1],robot_ori.get_value())
+        self._num_expanded = 0
+        map_ref = self._map_ref
+        if (map_ref.get_version()!=self._map_version):
+            # notifications are held back while the map is in a batch
+            self.update(map_ref.get_pending_changes())
+            self._map_version = map_ref.get_version()
+        if (self._start is None or self._changed_pos is None):
+            self._initialize(start)
+        else:
+            self._k_m += self._get_heuristic_value(self._start,start)
+            self._start = start
+            self._apply_changes()
+        self._compute_shortest_path()
+        debug("number of expanded states for repairing shortest path: {}".format(self._num_expanded),DEBUG_ALGO)
+
+    def get_cost(self):
+        "return the cost of the shortest path found by the last call, infinite if the target cannot be reached"
+        return self._g.get(self._start,INFINITE_COST)
+
+    def get_num_expanded(self):
+        return self._num_expanded
+
+    def _initialize(self,start):
+        self._g = {}
+        self._rhs = {}
+        self._keys = {}
+        self._queue = HeapMinQueue(key=lambda x:self._keys[x])
+        self._k_m = 0
+        self._start = start
+        self._changed_pos = set()
+        map_ref = self._map_ref
+        self._accessible = dict(((x,y),map_ref.is_accessible_centre(x,y))
+                                for y in range(map_ref.get_size_y()) for x in range(map_ref.get_size_x()))
+        if (self._accessible.get(self._target_pos)):
+            for ori_value in self.STATE_ORI_VALUES:
+                state = (self._target_pos[0],self._target_pos[1],ori_value)
+                self._rhs[state] = 0
+                self._enqueue(state)
+
+    def _apply_changes(self):
+        "update the states whose edges go through a position whose accessibility has changed"
+        changed_pos,self._changed_pos = self._changed_pos,set()
+        centres = set()
+        for x,y in changed_pos:
+            # the robot footprint is 3x3, a cell change affects the centres around it
+            for dx in (-1,0,1):
+                for dy in (-1,0,1):
+                    centres.add((x+dx,y+dy))
+        for pos in centres:
+            if (pos not in self._accessible):
+                continue
+            accessible = self._map_ref.is_accessible_centre(*pos)
+            if (accessible==self._accessible[pos]):
+                continue
+            self._accessible[pos] = accessible
+            x,y = pos
+            for ori_value in self.STATE_ORI_VALUES:
+                self._update_state((x,y,ori_value))
+                # the state moving forward into pos
+                delta_x,delta_y = AbsoluteOrientation.get_instance(ori_value).to_pos_change()
+                self._update_state((x-delta_x,y-delta_y,ori_value))
+
+    def _compute_shortest_path(self):
+        queue,g,rhs,keys = self._queue,self._g,self._rhs,self._keys
+        start = self._start
+        while (not queue.is_empty() and
+               (keys[queue.peek()]<self._get_key(start) or rhs.get(start,INFINITE_COST)!=g.get(start,INFINITE_COST))):
+            state = queue.peek()
+            old_key,new_key = keys[state],self._get_key(state)
+            self._num_expanded += 1
+            if (old_key<new_key):
+                keys[state] = new_key
+                queue.update(state)
+            elif (g.get(state,INFINITE_COST)>rhs.get(state,INFINITE_COST)):
+                g[state] = rhs[state]
+                queue.remove(state)
+                del keys[state]
+                for pred,cost in self._get_predecessors(state):
+                    self._update_state(pred)
+            else:
+                g.pop(state,None)
+                self._update_state(state)
+                for pred,cost in self._get_predecessors(state):
+                    self._update_state(pred)
+
+    def _update_state(self,state):
+        "recompute rhs of state from its successors and put it in the queue if it is inconsistent"
+        x,y,ori_value = state
+        if ((x,y)==self._target_pos and self._accessible.get((x,y))):
+            rhs = 0
+        else:
+            rhs = INFINITE_COST
+            for action,succ,cost in self._get_successors(state):
+                rhs = min(rhs,cost+self._g.get(succ,INFINITE_COST))
+        if (rhs==INFINITE_COST):
+            self._rhs.pop(state,None)
+        else:
+            self._rhs[state] = rhs
+        if (state in self._queue):
+            self._queue.remove(state)
+            del self._keys[state]
+        if (self._g.get(state,INFINITE_COST)!=rhs):
+            self._enqueue(state)
+
+    def _enqueue(self,state):
+        self._keys[state] = self._get_key(state)
+        self._queue.enqueue(state)
+
+    def _get_key(self,state):
+        cost = min(self._g.get(state,INFINITE_COST),self._rhs.get(state,INFINITE_COST))
+        return (cost+self._get_heuristic_value(self._start,state)+self._k_m,cost)
+
+    def _get_heuristic_value(self,from_state,to_state):
+        "manhattan distance between the positions, never overestimates the cost in either direction"
+        return (abs(from_state[0]-to_state[0])+abs(from_state[1]-to_state[1]))*self.UNIT_MOVE_COST
+
+    def _get_successors(self,state):
+        "return a list of (action,state,cost), the same edges as AStarShortestPathAlgoWithOrientation"
+        x,y,ori_value = state
+        if (not self._accessible.get((x,y))):
+            return []
+        successors = [
+            (PMessage.M_MOVE_FORWARD,None,self.UNIT_MOVE_COST),
+            (PMessage.M_TURN_LEFT,(x,y,(ori_value+6)%8),self.UNIT_TURN_COST),
+            (PMessage.M_TURN_RIGHT,(x,y,(ori_value+2)%8),self.UNIT_TURN_COST),
+        ]
+        delta_x,delta_y = AbsoluteOrientation.get_instance(ori_value).to_pos_change()
+        if (self._accessible.get((x+delta_x,y+delta_y))):
+            successors[0] = (PMessage.M_MOVE_FORWARD,(x+delta_x,y+delta_y,ori_value),self.UNIT_MOVE_COST)
+        else:
+            del successors[0]
+        return successors
+
+    def _get_predecessors(self,state):
+        "return a list of (state,cost) of the states having an edge to state"
+        x,y,ori_value = state
+        if (not self._accessible.get((x,y))):
+            return []
+        predecessors = [
+            ((x,y,(ori_value+2)%8),self.UNIT_TURN_COST), # turning left from there
+            ((x,y,(ori_value+6)%8),self.UNIT_TURN_COST), # turning right from there
+        ]
+        delta_x,delta_y = AbsoluteOrientation.get_instance(ori_value).to_pos_change()
+        if (self._accessible.get((x-delta_x,y-delta_y))):
+            predecessors.append(((x-delta_x,y-delta_y,ori_value),self.UNIT_MOVE_COST))
+        return predecessors
+
+    def _get_command_list(self):
+        "follow the cheapest successors from the robot state to the target"
+        state = self._start
+        if (self.get_cost()==INFINITE_COST):
+            raise Exception("no path found from {} to {}".format(state[:2],self._target_pos))
+        cmd_list = []
+        while ((state[0],state[1])!=self._target_pos):
+            best_cost,best_action,best_state = INFINITE_COST,None,None
+            for action,succ,cost in self._get_successors(state):
+                succ_cost = cost+self._g.get(succ,INFINITE_COST)
+                if (succ_cost<best_cost):
+                    best_cost,best_action,best_state = succ_cost,action,succ
+            if (best_state is None or len(cmd_list)>len(self._g)):
+                raise Exception("no path found from {} to {}".format(self._start[:2],self._target_pos))
+            cmd_list.append(best_action)
+            state = best_state
+        return cmd_list
@@ -1,7 +1,13 @@
 from common import *
 from common.amap import MapRef
+from common.robot import RobotRef
 from common.pmessage import PMessage
+from common.popattern import BaseObserver
+from common.utils import HeapMinQueue
 from common.debug import debug,DEBUG_ALGO
+from algorithms.shortest_path import AStarShortestPathAlgoWithOrientation
+from algorithms.incremental_path import DStarLiteShortestPathAlgo
+from algorithms.distance_field import ArenaDistanceFields
 import random
 
 class MazeExploreAlgo():
@@ -22,6 +28,7 @@ class MazeExploreAlgo():
 
     MOVE_ALONG_WALL_STRATEGY = "alongwall"
     NO_DUPLICATE_EXPLORE_STRATEGY = "noduplicate"
+    FRONTIER_STRATEGY = "frontier"
 
     _strategy = MOVE_ALONG_WALL_STRATEGY
 
@@ -30,6 +37,14 @@ class MazeExploreAlgo():
         self._map_ref = map_ref
         self._history_ls = []
 
+    def may_end_at_start_zone(self):
+        "return True if the exploration can be ended whenever the robot is back at the start zone"
+        return True
+
+    def get_distance_fields(self):
+        "return the ArenaDistanceFields of the map, for distance queries to the start zone, the end zone or the robot"
+        return ArenaDistanceFields.get_instance(self._map_ref)
+
     def get_next_move(self):
         "return the command to be executed next"
         if (self._strategy == self.MOVE_ALONG_WALL_STRATEGY):
@@ -49,18 +64,19 @@ class MazeExploreAlgo():
             self._history_ls.append((self._robot.get_position(),self._robot.get_orientation()))
 
         candidate_actions = [] # list of (action,utility)
-        for action in self.action_precedence:
-            ori = self.get_ori_to_check(desired_action=action)
-            status = self.check_status(ori)
-            if (status!=self.CANNOT_ACCESS):
-                utility = self._robot.get_action_utility_points(action=action,map_ref=self._map_ref)
-                if (not candidate_actions):
+        actions = [action for action in self.action_precedence
+                   if self.check_status(self.get_ori_to_check(desired_action=action))!=self.CANNOT_ACCESS]
+        # score all actions with one lookup
+        poses = [self._robot.get_pose_after([action,PMessage.M_MOVE_FORWARD]) for action in actions]
+        utilities = self._robot.get_footprint_unknown_counts(poses,self._map_ref)
+        for action,utility in zip(actions,utilities):
+            if (not candidate_actions):
+                candidate_actions.append((action,utility))
+            else:
+                if (utility==candidate_actions[0][1]):
                     candidate_actions.append((action,utility))
-                else:
-                    if (utility==candidate_actions[0][1]):
-                        candidate_actions.append((action,utility))
-                    elif (utility>candidate_actions[0][1]):
-                        candidate_actions = [(action,utility)]
+                elif (utility>candidate_actions[0][1]):
+                    candidate_actions = [(action,utility)]
 
         if (candidate_actions):#pick the action with highest utility
             return candidate_actions[random.randint(0,len(candidate_actions)-1)][0]
@@ -90,13 +106,16 @@ class MazeExploreAlgo():
 
     def check_status(self,ori):
         "return CAN_ACCESS,CANNOT_ACCESS or UNSURE"
-        # locate the three blocks to check
         pos_change = ori.to_pos_change()
+        robot_centre_pos = self._robot.get_position()
+        # the whole footprint after moving is known to be clear
+        if (self._map_ref.is_accessible_centre(robot_centre_pos[0]+pos_change[0],robot_centre_pos[1]+pos_change[1])):
+            return self.CAN_ACCESS
+        # locate the three blocks to check
         side_pos_delta = [(pos_change[0]*2,i) for i in range(-1,2)] if pos_change[1] == 0\
                             else [(i,pos_change[1]*2) for i in range(-1,2)] # position difference from the target blocks to center
         # check the blocks
         has_unexplored = False
-        robot_centre_pos = self._robot.get_position()
         for delta in side_pos_delta:
             target_pos = (delta[0]+robot_centre_pos[0],delta[1]+robot_centre_pos[1])
             x,y = target_pos[0], target_pos[1]
@@ -111,4 +130,271 @@ class MazeExploreAlgo():
 
     def get_ori_to_check(self,desired_action):
         "return the orientation after executing given a potential action"
-        return (self._robot.get_orientation().if_applied_action(desired_action))
\ No newline at end of file
+        return (self._robot.get_orientation().if_applied_action(desired_action))
+
+
+class FrontierTracker(BaseObserver):
+    """
+    keep the set of frontier cells of a MapRef up to date from its change notifications,
+    a frontier cell is an unknown cell next to a known cell that is not an obstacle
+    """
+    NEIGHBOUR_DELTAS = [(0,0),(-1,0),(1,0),(0,-1),(0,1)]
+
+    _map_ref = None
+    _frontier = None # set of (x,y)
+    _version = 0 # increased whenever the frontier changes
+    _map_version = None # version of the map the frontier was last brought up to date with
+
+    def __init__(self,map_ref):
+        self._map_ref = map_ref
+        self._frontier = set()
+        self.rebuild()
+        map_ref.add_change_listener(self)
+
+    def update(self,data=None):
+        "data is the list of changed positions, None means the whole map"
+        if (data is None):
+            self.rebuild()
+            return
+        checked = set()
+        for x,y in data:
+            for dx,dy in self.NEIGHBOUR_DELTAS:
+                pos = (x+dx,y+dy)
+                if (pos not in checked):
+                    checked.add(pos)
+                    self._check_cell(pos)
+
+    def rebuild(self):
+        self._frontier = set()
+        self._version += 1
+        for y in range(self._map_ref.get_size_y()):
+            for x in range(self._map_ref.get_size_x()):
+                self._check_cell((x,y))
+
+    def get_frontier(self):
+        self._sync()
+        return self._frontier
+
+    def get_version(self):
+        self._sync()
+        return self._version
+
+    def has_frontier(self):
+        self._sync()
+        return len(self._frontier)>0
+
+    def _sync(self):
+        "merge the changes the map holds back while it is in a batch"
+        map_ref = self._map_ref
+        if (map_ref.get_version()!=self._map_version):
+            self._map_version = map_ref.get_version()
+            self.update(map_ref.get_pending_changes())
+
+    def is_frontier(self,x,y):
+        map_ref = self._map_ref
+        if (map_ref.is_out_of_arena(x,y) or map_ref.get_cell(x,y)!=MapRef.UNKNOWN):
+            return False
+        for dx,dy in self.NEIGHBOUR_DELTAS[1:]:
+            if (not map_ref.is_out_of_arena(x+dx,y+dy) and
+                    map_ref.get_cell(x+dx,y+dy) not in (MapRef.UNKNOWN,MapRef.OBSTACLE)):
+                return True
+        return False
+
+    def _check_cell(self,pos):
+        if (self.is_frontier(*pos)):
+            if (pos not in self._frontier):
+                self._frontier.add(pos)
+                self._version += 1
+        elif (pos in self._frontier):
+            self._frontier.discard(pos)
+            self._version += 1
+
+
+class InformationGainSearchAlgo(AStarShortestPathAlgoWithOrientation):
+    """
+    uniform cost search over (x,y,orientation) from the robot pose,
+    finds the pose whose sensors would see the most unknown cells per unit of travel cost
+    `gain_func`: function (x,y,ori) => number of unknown cells seen at that pose
+    """
+    _gain_func = None
+    _max_gain = 0 # upper bound of gain_func, used to stop the search early
+    _best_node = None
+    _best_gain = 0
+
+    def __init__(self,map_ref,gain_func,max_gain):
+        self._gain_func = gain_func
+        self._max_gain = max_gain
+        AStarShortestPathAlgoWithOrientation.__init__(self,map_ref=map_ref,target_pos=None)
+
+    def get_best_path(self,robot_pos,robot_ori):
+        "return (list of commands to the best pose, gain at the best pose), ([],0) if nothing can be gained"
+        self._build_search_tree(robot_pos=robot_pos,robot_ori=robot_ori)
+        if (not self._best_node):
+            return [],0
+        return self.get_command_list(start_node=None,end_node=self._best_node),self._best_gain
+
+    def _build_search_tree(self,robot_pos,robot_ori):
+        self._state_nodes = {}
+        self._num_expanded = 0
+        self._best_node,self._best_gain = None,0
+        best_score = 0
+        start_node = self._get_state_node(robot_pos[0],robot_pos[1],robot_ori)
+        start_node.set_g(0)
+        node_q = HeapMinQueue(key=lambda x:x.get_g())
+        node_q.enqueue(start_node)
+        while(not node_q.is_empty()):
+            cur_node = node_q.dequeue_min()
+            cur_node.visited = True
+            self._num_expanded += 1
+            cost = cur_node.get_g()
+            if (cost>0):
+                # nodes come out in increasing cost, no later node can beat the best score
+                if (self._max_gain<=best_score*cost):
+                    break
+                gain = self._gain_func(cur_node.x,cur_node.y,cur_node.ori)
+                score = gain*1.0/cost
+                if (score>best_score):
+                    best_score = score
+                    self._best_node,self._best_gain = cur_node,gain
+            for action,n,step_cost in self.get_successor_nodes(cur_node):
+                if (n.visited):
+                    continue
+                new_g = cost + step_cost
+                if (n.parent is None or new_g<n.get_g()):
+                    n.parent = cur_node
+                    n.action = action
+                    n.set_g(new_g)
+                    node_q.enqueue(n)
+        debug("best pose {} with gain {}, expanded {} states".format(
+            self._best_node.get_desc() if self._best_node else None,self._best_gain,self._num_expanded),DEBUG_ALGO)
+
+    def _get_heuristic_value(self,x,y):
+        return 0
+
+    def _get_state_heuristic_value(self,x,y,ori):
+        return 0
+
+
+class MazeExploreAlgoWithFrontier(MazeExploreAlgo):
+    """
+    frontier based exploration
+    go to the reachable pose with the highest information gain per travel cost,
+    the gain of a pose is the number of unknown cells in the footprint of RobotSettings.SENSORS,
+    go back to the start zone when no unknown cell can be seen from any reachable pose
+    """
+    _strategy = MazeExploreAlgo.FRONTIER_STRATEGY
+    # the gain of a pose is clamped because the robot also senses on the way to its target, which the score ignores,
+    # an unclamped footprint (up to 12 cells) sends it across the arena for one pose and takes 10% more moves over the
+    # map corpus, limits of 3 and 4 take the fewest
+    _GAIN_LIMIT = 4
+
+    _frontier_tracker = None # FrontierTracker
+    _home_planner = None # DStarLiteShortestPathAlgo to the start zone, repaired every time going back is planned
+    _max_gain = 0
+    _plan = None # list of (x,y,ori,action) still to be executed
+    _plan_target = None # (x,y,ori) the plan leads to
+    _going_back = False
+    _frontier_version = None # version of the frontier when going back was planned
+
+    def __init__(self,robot,map_ref,home_planner=None):
+        "home_planner is a DStarLiteShortestPathAlgo to the start zone kept by the caller, a new one is made if None"
+        MazeExploreAlgo.__init__(self,robot,map_ref)
+        self._frontier_tracker = FrontierTracker(map_ref)
+        if (home_planner is None):
+            home_planner = DStarLiteShortestPathAlgo(map_ref=map_ref,target_pos=map_ref.get_start_zone_center_pos())
+        self._home_planner = home_planner
+        self._max_gain = min(sum([s['range'] for s in RobotRef.SENSORS]),self._GAIN_LIMIT)
+        self._plan = []
+        self._going_back = False
+
+    def may_end_at_start_zone(self):
+        return False
+
+    def get_next_move(self):
+        "return the command to be executed next, None if the exploration is finished"
+        if (not self._is_plan_valid()):
+            self._replan()
+        if (not self._plan):
+            return None
+        return self._plan.pop(0)[3]
+
+    def get_gain(self,x,y,ori):
+        "return the number of unknown cells the sensors would see with the robot at (x,y) facing ori"
+        map_ref = self._map_ref
+        seen = set()
+        for (dx,dy),(step_x,step_y),sensor_range in RobotRef.get_sensor_templates(ori):
+            sx,sy = x+dx,y+dy
+            for i in range(sensor_range):
+                sx,sy = sx+step_x,sy+step_y
+                if (map_ref.is_out_of_arena(sx,sy)):
+                    break
+                value = map_ref.get_cell(sx,sy)
+                if (value==MapRef.OBSTACLE):
+                    break
+                if (value==MapRef.UNKNOWN):
+                    seen.add((sx,sy))
+        return min(len(seen),self._GAIN_LIMIT)
+
+    def get_frontier_tracker(self):
+        return self._frontier_tracker
+
+    def _is_plan_valid(self):
+        if (not self._plan):
+            return False
+        x,y,ori,action = self._plan[0]
+        robot_pos,robot_ori = self._robot.get_position(),self._robot.get_orientation()
+        if ((x,y)!=robot_pos or ori!=robot_ori):
+            # the previous command was not executed as expected
+            return False
+        if (action==PMessage.M_MOVE_FORWARD):
+            delta_x,delta_y = ori.to_pos_change()
+            if (not self._map_ref.is_accessible_centre(x+delta_x,y+delta_y)):
+                return False
+        if (not self._going_back):
+            # nothing left to see at the target, look for a better one
+            return self.get_gain(*self._plan_target)>0
+        # new unknown cells may have been sensed on the way back
+        return self._frontier_tracker.get_version()==self._frontier_version
+
+    def _replan(self):
+        self._plan,self._going_back = [],False
+        robot_pos,robot_ori = self._robot.get_position(),self._robot.get_orientation()
+        if (self._frontier_tracker.has_frontier()):
+            algo = InformationGainSearchAlgo(map_ref=self._map_ref,gain_func=self.get_gain,max_gain=self._max_gain)
+            commands,gain = algo.get_best_path(robot_pos=robot_pos,robot_ori=robot_ori)
+            if (commands):
+                self._set_plan(commands)
+                debug("Frontier target {} with gain {}".format(self._plan_target,gain),DEBUG_ALGO)
+                return
+        start_pos = self._map_ref.get_start_zone_center_pos()
+        distance = self.get_distance_fields().get_distance_from_start(*robot_pos)
+        if (distance==0):
+            return
+        if (distance is None):
+            # keep exploring rather than ending the run away from the start
+            debug("Cannot go back to start: no path found from {}, moving along the wall".format(robot_pos),DEBUG_ALGO)
+            self._set_plan([self.move_along_wall()])
+            return
+        debug("No frontier can be reached, going back to start",DEBUG_ALGO)
+        try:
+            commands = self._home_planner.get_shortest_path(robot_pos=robot_pos,robot_ori=robot_ori)
+        except Exception as e:
+            debug("Cannot go back to start: {}, moving along the wall".format(e),DEBUG_ALGO)
+            self._set_plan([self.move_along_wall()])
+            return
+        self._set_plan(commands)
+        self._going_back = True
+        self._frontier_version = self._frontier_tracker.get_version()
+
+    def _set_plan(self,commands):
+        "keep the robot pose expected before each command, to detect commands not executed as planned"
+        (x,y),ori = self._robot.get_position(),self._robot.get_orientation()
+        self._plan = []
+        for command in commands:
+            self._plan.append((x,y,ori,command))
+            if (command==PMessage.M_MOVE_FORWARD):
+                delta_x,delta_y = ori.to_pos_change()
+                x,y = x+delta_x,y+delta_y
+            else:
+                ori = ori.if_applied_action(command)
+        self._plan_target = (x,y,ori)
@@ -1,7 +1,12 @@
 from common import *
-from common.utils import MinQueue
-from common.debug import debug,DEBUG_ALGO
+from common.utils import HeapMinQueue
+from common.debug import debug,is_debug_enabled,DEBUG_ALGO
 from common.amap import MapRef
+from common.robot import RobotRef
+from algorithms.distance_field import ArenaDistanceFields
+from algorithms.cost_model import ExecutionCostModel
+from collections import OrderedDict
+from threading import Lock
 
 class AStarShortestPathAlgo():
 
@@ -15,12 +20,18 @@ class AStarShortestPathAlgo():
     _nodes = [] # 2D list of nodes
     _map_ref = None # MapRef object
     _target_pos = None # tuple
+    _num_expanded = 0 # nodes taken from the open list by the last search
 
     def __init__(self,map_ref,target_pos):
         self._map_ref = map_ref
         self._target_pos = target_pos
         self._init_matrices(m=self._map_ref.get_size_x(),n=self._map_ref.get_size_y(),map_ref=self._map_ref)
 
+    @classmethod
+    def get_cost_key(cls):
+        "return a hashable value identifying the costs the planner minimizes"
+        return (cls.UNIT_TURN_COST,cls.UNIT_MOVE_COST)
+
     def get_shortest_path(self,robot_pos,robot_ori):
         "return a list of commands for walking through the shortest path"
         self._build_search_tree(robot_pos=robot_pos,robot_ori=robot_ori)
@@ -32,7 +43,8 @@ class AStarShortestPathAlgo():
 
     def _build_search_tree(self,robot_pos,robot_ori):
         num_iterations=1
-        node_q = MinQueue(key=lambda x:x.get_f()) # queue of (x,y) positions
+        verbose = is_debug_enabled(DEBUG_ALGO)
+        node_q = HeapMinQueue(key=lambda x:x.get_f()) # queue of nodes
         start_node = self._nodes[robot_pos[1]][robot_pos[0]]
         start_node.ori = robot_ori
         dest_node = self._nodes[self._target_pos[1]][self._target_pos[0]]
@@ -49,22 +61,32 @@ class AStarShortestPathAlgo():
             for n in neighbours:
                 new_g = self.compute_g_value(cur_node=cur_node,target_node=n)
                 new_f = new_g + n.get_h()
-                debug("new g value is {}".format(new_g),DEBUG_ALGO)
+                if (verbose):
+                    debug("new g value is {}".format(new_g),DEBUG_ALGO)
                 if (n.visited):
                     if (new_f<n.get_f()):
                         n.set_g(new_g)
-                        debug("[Update parent] Attach {} to node {}".format(n.get_desc(),cur_node.get_desc()),DEBUG_ALGO)
+                        if (verbose):
+                            debug("[Update parent] Attach {} to node {}".format(n.get_desc(),cur_node.get_desc()),DEBUG_ALGO)
                         n.parent = cur_node
                         n.ori = AbsoluteOrientation.get_ori_at_dest(start_pos=(cur_node.x,cur_node.y),dest_pos=(n.x,n.y))
-                    debug("[No action] {} is visited and new_f is {}".format(n.get_desc(),new_f),DEBUG_ALGO)
+                        if (n in node_q):
+                            node_q.update(n)
+                    if (verbose):
+                        debug("[No action] {} is visited and new_f is {}".format(n.get_desc(),new_f),DEBUG_ALGO)
                 else: # not visited
                     n.parent = cur_node
                     n.set_g(new_g)
                     n.visited = True
-                    debug("[Create parent] Attach {} to node {}".format(n.get_desc(),cur_node.get_desc()),DEBUG_ALGO)
+                    if (verbose):
+                        debug("[Create parent] Attach {} to node {}".format(n.get_desc(),cur_node.get_desc()),DEBUG_ALGO)
                     n.ori = AbsoluteOrientation.get_ori_at_dest(start_pos=(cur_node.x,cur_node.y),dest_pos=(n.x,n.y))
                     node_q.enqueue(n)
         debug("number of iterations for finding shortest path: {}".format(num_iterations),DEBUG_ALGO)
+        self._num_expanded = num_iterations-1
+
+    def get_num_expanded(self):
+        return self._num_expanded
 
     def _get_nodes(self):
         return self._nodes
@@ -72,23 +94,23 @@ class AStarShortestPathAlgo():
 
     def _get_inaccessible_pos_list(self,map_ref):
         "pos where robot will collide with obstacles or the wall"
-        pos_list = []
-        # 1 all obstacle positions and surrounding positions
-        for y in range(map_ref.get_size_y()):
-            for x in range(map_ref.get_size_x()):
-                if (map_ref.get_cell(x,y)==MapRef.OBSTACLE or map_ref.get_cell(x,y)==MapRef.UNKNOWN):
-                    pos_list.extend(map_ref.get_surrounding_pos(x,y))
-                    pos_list.append((x,y))
-        # 2 near wall positions
-        pos_list.extend(map_ref.get_along_wall_pos())
-        return list(set(pos_list))
+        return [(x,y) for y in range(map_ref.get_size_y()) for x in range(map_ref.get_size_x())
+                if not map_ref.is_accessible_centre(x,y)]
+
+    def get_route(self,start_node,end_node):
+        "return the list of nodes from start_node to end_node following the parent pointers"
+        route = [end_node]
+        while (not route[-1].equals(start_node)):
+            route.append(route[-1].parent)
+        route.reverse()
+        return route
 
     def get_command_list(self,start_node,end_node):
         "return list of commands"
-        if (start_node.equals(end_node)):
-            return []
-        cmd_list = self.get_command_list(start_node=start_node,end_node=end_node.parent)
-        cmd_list.extend(self.get_point_move_command(from_node=end_node.parent,to_node=end_node))
+        route = self.get_route(start_node=start_node,end_node=end_node)
+        cmd_list = []
+        for i in range(1,len(route)):
+            cmd_list.extend(self.get_point_move_command(from_node=route[i-1],to_node=route[i]))
         return cmd_list
 
     def get_point_move_command(self,from_node,to_node):
@@ -97,13 +119,12 @@ class AStarShortestPathAlgo():
         return actions + [PMessage.M_MOVE_FORWARD]
 
     def print_route(self,dest_node,start_node):
-        # terminating case
-        if (dest_node.equals(start_node)):
-            debug("{},{}".format(start_node.x,start_node.y),DEBUG_ALGO)
+        if (not is_debug_enabled(DEBUG_ALGO)):
             return
-        # recursive call
-        self.print_route(dest_node=dest_node.parent,start_node=start_node)
-        debug("node: {},{}  | h value: {}  | g value: {}".format(dest_node.x,dest_node.y,dest_node._h,dest_node._g),DEBUG_ALGO)
+        route = self.get_route(start_node=start_node,end_node=dest_node)
+        debug("{},{}".format(start_node.x,start_node.y),DEBUG_ALGO)
+        for node in route[1:]:
+            debug("node: {},{}  | h value: {}  | g value: {}".format(node.x,node.y,node._h,node._g),DEBUG_ALGO)
 
     def compute_g_value(self,cur_node,target_node):
         "return the cost value from cur_pos to target_pos"
@@ -124,14 +145,223 @@ class AStarShortestPathAlgo():
 
     def _init_matrices(self,m,n,map_ref):
         "initialize all matrices to m*n, for inaccessible positions, None will be put"
-        inaccessible_list = self._get_inaccessible_pos_list(map_ref)
-        self._nodes = [[None if (x,y) in inaccessible_list else Node(x,y,self._get_heuristic_value(x,y))
+        self._nodes = [[Node(x,y,self._get_heuristic_value(x,y)) if map_ref.is_accessible_centre(x,y) else None
                         for x in range(m)]
                        for y in range(n)]
 
     def _get_heuristic_value(self,x,y):
         return abs(x-self._target_pos[0]) + abs(y-self._target_pos[1]) if self._map_ref.get_cell(x,y)==MapRef.CLEAR else self.NON_ACCESS_H_VALUE
 
+class AStarShortestPathAlgoWithOrientation(AStarShortestPathAlgo):
+    """
+    A* over the state space (x,y,orientation)
+    turning is an explicit edge costing UNIT_TURN_COST and moving forward costs UNIT_MOVE_COST,
+    so the returned command list is the cheapest sequence of mf/tl/tr
+    """
+
+    # the robot can only face these orientations
+    STATE_ORIENTATIONS = [NORTH,EAST,SOUTH,WEST]
+    _USE_DISTANCE_FIELD = True # tighten the heuristic with the number of moves to the target around obstacles
+
+    _state_nodes = None # dict of (x,y,ori_value) -> Node
+    _distance_field = None # DistanceField to the target
+
+    def get_shortest_path(self,robot_pos,robot_ori):
+        "return a list of commands for walking through the shortest path"
+        if (self._USE_DISTANCE_FIELD):
+            self._distance_field = ArenaDistanceFields.get_instance(self._map_ref).get_field(self._target_pos)
+            if (not self._distance_field.is_reachable(*robot_pos)):
+                self._num_expanded = 0
+                raise Exception("no path found from {} to {}".format(robot_pos,self._target_pos))
+        dest_node = self._build_search_tree(robot_pos=robot_pos,robot_ori=robot_ori)
+        if (not dest_node):
+            raise Exception("no path found from {} to {}".format(robot_pos,self._target_pos))
+        return self.get_command_list(start_node=None,end_node=dest_node)
+
+    def _build_search_tree(self,robot_pos,robot_ori):
+        "return the node reached at the target position, None if the target cannot be reached"
+        self._state_nodes = {}
+        self._num_expanded = 0
+        start_node = self._get_state_node(robot_pos[0],robot_pos[1],robot_ori)
+        start_node.set_g(0)
+        node_q = HeapMinQueue(key=lambda x:(x.get_f(),x.get_h()))
+        node_q.enqueue(start_node)
+        while(not node_q.is_empty()):
+            cur_node = node_q.dequeue_min()
+            cur_node.visited = True
+            self._num_expanded += 1
+            if ((cur_node.x,cur_node.y)==self._target_pos):
+                debug("number of expanded states for finding shortest path: {}".format(self._num_expanded),DEBUG_ALGO)
+                return cur_node
+            for action,n,cost in self.get_successor_nodes(cur_node):
+                if (n.visited):
+                    continue
+                new_g = cur_node.get_g() + cost
+                if (n.parent is None or new_g<n.get_g()):
+                    n.parent = cur_node
+                    n.action = action
+                    n.set_g(new_g)
+                    node_q.enqueue(n)
+        debug("target {} cannot be reached, expanded {} states".format(self._target_pos,self._num_expanded),DEBUG_ALGO)
+        return None
+
+    def get_successor_nodes(self,node):
+        "return a list of (action,node,cost)"
+        successors = [
+            (PMessage.M_TURN_LEFT,self._get_state_node(node.x,node.y,node.ori.to_left()),self.UNIT_TURN_COST),
+            (PMessage.M_TURN_RIGHT,self._get_state_node(node.x,node.y,node.ori.to_right()),self.UNIT_TURN_COST),
+        ]
+        delta_x,delta_y = node.ori.to_pos_change()
+        x,y = node.x+delta_x,node.y+delta_y
+        if (self.is_accessible(x,y)):
+            successors.append((PMessage.M_MOVE_FORWARD,self._get_state_node(x,y,node.ori),self.UNIT_MOVE_COST))
+        return successors
+
+    def is_accessible(self,x,y):
+        return not self._map_ref.is_out_of_arena(x,y) and self._nodes[y][x]!=None
+
+    def _get_state_node(self,x,y,ori):
+        "return the node of state (x,y,ori), create it if it has not been reached before"
+        key = (x,y,ori.get_value())
+        node = self._state_nodes.get(key)
+        if (not node):
+            node = Node(x,y,self._get_state_heuristic_value(x,y,ori))
+            node.ori = ori
+            self._state_nodes[key] = node
+        return node
+
+    def _get_state_heuristic_value(self,x,y,ori):
+        "manhattan distance plus the minimum number of turns needed, never overestimates"
+        delta_x,delta_y = self._target_pos[0]-x,self._target_pos[1]-y
+        needed_oris = []
+        if (delta_x):
+            needed_oris.append(EAST if delta_x>0 else WEST)
+        if (delta_y):
+            needed_oris.append(SOUTH if delta_y>0 else NORTH)
+        if (not needed_oris):
+            num_turns = 0
+        else:
+            # facing each needed orientation at some point, the first one costs at least min turns
+            num_turns = min([ori.get_minimum_turns_to(o) for o in needed_oris]) + len(needed_oris) - 1
+        h = (abs(delta_x)+abs(delta_y))*self.UNIT_MOVE_COST + num_turns*self.UNIT_TURN_COST
+        if (self._distance_field):
+            # both never overestimate, so neither does the larger one
+            h = max(h,(self._distance_field.get_distance(x,y) or 0)*self.UNIT_MOVE_COST)
+        return h
+
+    def get_command_list(self,start_node,end_node):
+        "return list of commands, follow the parent pointers from end_node back to the start"
+        cmd_list = []
+        cur_node = end_node
+        while (cur_node.parent and not (start_node and cur_node is start_node)):
+            cmd_list.append(cur_node.action)
+            cur_node = cur_node.parent
+        cmd_list.reverse()
+        return cmd_list
+
+class AStarShortestPathAlgoWithMacroMoves(AStarShortestPathAlgoWithOrientation):
+    """
+    A* over (x,y,orientation) where moving forward jumps a whole straight run in one edge,
+    every mf*N up to MAX_MOVE_FORWARD_STEPS along the run is a successor costing get_move_forward_cost(N),
+    so the returned command list is already in multi-grid form
+    a node reached by mf*N only continues straight beyond what its parent could reach in one jump,
+    which loses nothing as long as one long move never costs more than shorter moves covering the same grids,
+    and the run only stops where the robot can turn and move on, or at the target
+    """
+    MAX_MOVE_FORWARD_STEPS = PMessage.MAX_MOVE_FORWARD_STEPS
+
+    def get_move_forward_cost(self,num_steps):
+        "return the cost of mf*num_steps"
+        return num_steps*self.UNIT_MOVE_COST
+
+    def get_successor_nodes(self,node):
+        "return a list of (action,node,cost)"
+        successors = [
+            (PMessage.M_TURN_LEFT,self._get_state_node(node.x,node.y,node.ori.to_left()),self.UNIT_TURN_COST),
+            (PMessage.M_TURN_RIGHT,self._get_state_node(node.x,node.y,node.ori.to_right()),self.UNIT_TURN_COST),
+        ]
+        min_steps = 1
+        if (node.action and node.action.startswith(PMessage.M_MOVE_FORWARD)):
+            # shorter straight moves are successors of the parent already
+            min_steps = self.MAX_MOVE_FORWARD_STEPS-self.get_num_steps(node.action)+1
+        delta_x,delta_y = node.ori.to_pos_change()
+        x,y = node.x,node.y
+        for num_steps in range(1,self.MAX_MOVE_FORWARD_STEPS+1):
+            x,y = x+delta_x,y+delta_y
+            if (not self.is_accessible(x,y)):
+                break
+            if (num_steps>=min_steps and self._is_jump_point(x,y,delta_x,delta_y,num_steps)):
+                action = PMessage.M_MOVE_FORWARD if num_steps==1 else "{}*{}".format(PMessage.M_MOVE_FORWARD,num_steps)
+                successors.append((action,self._get_state_node(x,y,node.ori),self.get_move_forward_cost(num_steps)))
+        return successors
+
+    def _is_jump_point(self,x,y,delta_x,delta_y,num_steps):
+        "return True if a move along (delta_x,delta_y) may stop at (x,y)"
+        # turning where neither side can be entered leads nowhere
+        return ((x,y)==self._target_pos or num_steps==self.MAX_MOVE_FORWARD_STEPS or
+                self.is_accessible(x+delta_y,y+delta_x) or self.is_accessible(x-delta_y,y-delta_x))
+
+    @staticmethod
+    def get_num_steps(action):
+        "return the number of grids moved by mf or mf*N"
+        return int(action.split("*")[1]) if "*" in action else 1
+
+class AStarShortestPathAlgoWithCostModel(AStarShortestPathAlgoWithMacroMoves):
+    """
+    minimize the predicted execution time of an ExecutionCostModel instead of grid steps,
+    turning back is an edge of its own, it may take less time than two quarter turns,
+    a command ending at a pose where the fast run callibrates also pays for the callibration stops there
+    the model is shared by all instances, see set_cost_model()
+    """
+    _cost_model = ExecutionCostModel()
+    _callibration_counts = None # dict of (x,y,ori_value) -> number of callibration messages sent at that pose
+
+    def __init__(self,map_ref,target_pos):
+        model = self._cost_model
+        # lower bounds of the costs, used by the heuristics, tb counts as two quarter turns
+        self.UNIT_TURN_COST = min(model.get_turn_time(PMessage.M_TURN_LEFT),model.get_turn_time(PMessage.M_TURN_RIGHT),
+                                  model.get_turn_time(PMessage.M_TURN_BACK)/2.0)
+        self.UNIT_MOVE_COST = model.get_min_time_per_grid(self.MAX_MOVE_FORWARD_STEPS)
+        self._callibration_counts = {}
+        AStarShortestPathAlgoWithMacroMoves.__init__(self,map_ref=map_ref,target_pos=target_pos)
+
+    @classmethod
+    def set_cost_model(cls,cost_model):
+        cls._cost_model = cost_model
+
+    @classmethod
+    def get_cost_model(cls):
+        return cls._cost_model
+
+    @classmethod
+    def get_cost_key(cls):
+        return cls._cost_model.get_key()
+
+    def get_move_forward_cost(self,num_steps):
+        return self._cost_model.get_move_forward_time(num_steps)
+
+    def get_successor_nodes(self,node):
+        "return a list of (action,node,cost)"
+        successors = []
+        for action,n,cost in AStarShortestPathAlgoWithMacroMoves.get_successor_nodes(self,node):
+            if (action in (PMessage.M_TURN_LEFT,PMessage.M_TURN_RIGHT)):
+                cost = self._cost_model.get_turn_time(action)
+            successors.append((action,n,cost+self._get_callibration_cost(n)))
+        n = self._get_state_node(node.x,node.y,node.ori.to_back())
+        successors.append((PMessage.M_TURN_BACK,n,self._cost_model.get_turn_time(PMessage.M_TURN_BACK)+self._get_callibration_cost(n)))
+        return successors
+
+    def _get_callibration_cost(self,node):
+        "the fast run sends one callibration message for every fully blocked side"
+        if (not self._cost_model.get_callibration_time()):
+            return 0
+        key = (node.x,node.y,node.ori.get_value())
+        count = self._callibration_counts.get(key)
+        if (count is None):
+            count = len(RobotRef(ori=node.ori,pos=(node.x,node.y)).get_sides_fully_blocked(self._map_ref))
+            self._callibration_counts[key] = count
+        return count*self._cost_model.get_callibration_time()
+
 class Node():
 
     INIT_H_VALUE = 0
@@ -142,6 +372,7 @@ class Node():
     _f = _h
     visited = False
     ori = None
+    action = None # action taken at parent to reach this node
     x=0 # coordinate
     y=0
 
@@ -175,4 +406,75 @@ class Node():
 
     def equals(self,a_node):
         "check whether a_node has the same coordinate of self"
-        return self.x==a_node.x and self.y==a_node.y
\ No newline at end of file
+        return self.x==a_node.x and self.y==a_node.y
+
+
+class PlanCache(object):
+    """
+    least recently used cache of searched planners and their command lists,
+    keyed by (planner class,map version,robot pose,target,cost settings),
+    so planning again on a map that has not changed returns at once
+    """
+    _instance = None
+    _CAPACITY = 16
+
+    _plans = None # OrderedDict of key => (planner,commands,error message), least recently used first
+    _lock = None
+    _hits = 0
+    _misses = 0
+
+    @staticmethod
+    def get_instance():
+        if (not PlanCache._instance):
+            PlanCache._instance = PlanCache()
+        return PlanCache._instance
+
+    def __init__(self,capacity=None):
+        self._plans = OrderedDict()
+        self._lock = Lock()
+        if (capacity is not None):
+            self._CAPACITY = capacity
+
+    def get_shortest_path(self,planner_class,map_ref,target_pos,robot_pos,robot_ori):
+        "return a list of commands like planner_class(map_ref,target_pos).get_shortest_path(robot_pos,robot_ori)"
+        _,commands,error = self._get_plan(planner_class,map_ref,target_pos,robot_pos,robot_ori)
+        if (error is not None):
+            raise Exception(error)
+        return list(commands)
+
+    def get_planner(self,planner_class,map_ref,target_pos,robot_pos,robot_ori):
+        "return the planner after searching from the robot pose, it must not be searched again"
+        return self._get_plan(planner_class,map_ref,target_pos,robot_pos,robot_ori)[0]
+
+    def clear(self):
+        with self._lock:
+            self._plans = OrderedDict()
+
+    def get_stats(self):
+        "return (hits,misses)"
+        return self._hits,self._misses
+
+    def _get_plan(self,planner_class,map_ref,target_pos,robot_pos,robot_ori):
+        key = (planner_class,map_ref.get_version(),tuple(robot_pos),robot_ori.get_value(),tuple(target_pos),
+               planner_class.get_cost_key())
+        with self._lock:
+            plan = self._plans.pop(key,None)
+            if (plan):
+                self._hits += 1
+                self._plans[key] = plan
+                return plan
+            self._misses += 1
+        planner = planner_class(map_ref=map_ref,target_pos=target_pos)
+        commands,error = None,None
+        try:
+            commands = planner.get_shortest_path(robot_pos=robot_pos,robot_ori=robot_ori)
+        except Exception as e:
+            # failures are cached as well, the target stays unreachable until the map changes
+            error = str(e)
+        plan = (planner,commands,error)
+        with self._lock:
+            self._plans[key] = plan
+            while (len(self._plans)>self._CAPACITY):
+                self._plans.popitem(last=False)
+        debug("plan cache miss, {} plans cached".format(len(self._plans)),DEBUG_ALGO)
+        return plan
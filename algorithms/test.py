@@ -0,0 +1,176 @@
+"""
+testing the planners on maps changed inside a batch
+"""
+import random
+from common import *
+from common.amap import MapRef
+from common.robot import RobotRef
+from algorithms.cost_model import ExecutionCostModel,parse_ack_log
+from algorithms.distance_field import ArenaDistanceFields
+from algorithms.incremental_path import DStarLiteShortestPathAlgo
+from algorithms.shortest_path import AStarShortestPathAlgoWithOrientation,AStarShortestPathAlgoWithMacroMoves,\
+    AStarShortestPathAlgoWithCostModel,PlanCache
+
+def walled_map():
+    "return a clear map with a wall across the arena at y=10"
+    map_ref = MapRef()
+    map_ref.set_cell_list([(x,y) for x in range(map_ref.get_size_x()) for y in range(map_ref.get_size_y())],
+                          MapRef.CLEAR,maintain_obstacle=False)
+    map_ref.set_cell_list([(x,10) for x in range(map_ref.get_size_x())],MapRef.OBSTACLE)
+    return map_ref
+
+def plan(map_ref):
+    "return the commands from the start zone to the end zone, or the error message"
+    try:
+        return PlanCache.get_instance().get_shortest_path(planner_class=AStarShortestPathAlgoWithOrientation,
+                                                          map_ref=map_ref,target_pos=map_ref.get_end_zone_center_pos(),
+                                                          robot_pos=map_ref.get_start_zone_center_pos(),robot_ori=NORTH)
+    except Exception as e:
+        return str(e)
+
+def reaches(commands,robot_pos,robot_ori,target_pos):
+    return RobotRef(pos=robot_pos,ori=robot_ori).get_pose_after(commands)[0]==target_pos
+
+def test_plan_in_batch():
+    map_ref = walled_map()
+    fields = ArenaDistanceFields.get_instance(map_ref)
+    assert plan(map_ref).startswith("no path found")
+    assert fields.get_distance_from_start(1,1) is None
+    with map_ref.batch():
+        # the wall is gone before the listeners are notified
+        map_ref.set_cell_list([(x,10) for x in range(map_ref.get_size_x())],MapRef.CLEAR,maintain_obstacle=False)
+        assert fields.get_distance_from_start(1,1)==17
+        assert reaches(plan(map_ref),map_ref.get_start_zone_center_pos(),NORTH,map_ref.get_end_zone_center_pos())
+    with map_ref.batch():
+        map_ref.set_cell_list([(x,10) for x in range(map_ref.get_size_x())],MapRef.OBSTACLE)
+        assert fields.get_distance_from_start(1,1) is None
+        assert plan(map_ref).startswith("no path found")
+
+def test_repair_in_batch():
+    map_ref = walled_map()
+    planner = DStarLiteShortestPathAlgo(map_ref=map_ref,target_pos=map_ref.get_start_zone_center_pos())
+    robot_pos,target_pos = map_ref.get_end_zone_center_pos(),map_ref.get_start_zone_center_pos()
+    planner.replan(robot_pos=robot_pos,robot_ori=SOUTH)
+    assert planner.get_cost()==float('inf')
+    with map_ref.batch():
+        map_ref.set_cell_list([(x,10) for x in range(map_ref.get_size_x())],MapRef.CLEAR,maintain_obstacle=False)
+        assert reaches(planner.get_shortest_path(robot_pos=robot_pos,robot_ori=SOUTH),robot_pos,SOUTH,target_pos)
+        map_ref.set_cell_list([(x,10) for x in range(3,map_ref.get_size_x())],MapRef.OBSTACLE)
+        commands = planner.get_shortest_path(robot_pos=robot_pos,robot_ori=SOUTH)
+        assert reaches(commands,robot_pos,SOUTH,target_pos)
+        # through the gap at the left of the wall
+        robot = RobotRef(pos=robot_pos,ori=SOUTH)
+        for command in commands:
+            robot.execute_command(command)
+            assert map_ref.is_accessible_centre(*robot.get_position()),robot.get_position()
+    # the held back notification changes nothing
+    assert planner.get_shortest_path(robot_pos=robot_pos,robot_ori=SOUTH)==commands
+    assert planner.get_num_expanded()==0
+
+def random_map(rand,max_obstacles=25):
+    "return a clear map with up to max_obstacles random obstacles"
+    map_ref = MapRef()
+    map_ref.set_unknowns_as_clear()
+    for _ in range(rand.randint(0,max_obstacles)):
+        map_ref.set_cell(rand.randrange(map_ref.get_size_x()),rand.randrange(map_ref.get_size_y()),MapRef.OBSTACLE)
+    return map_ref
+
+def get_unit_cost(commands):
+    "return the cost of the commands counting grid steps and quarter turns"
+    return sum([AStarShortestPathAlgoWithMacroMoves.get_num_steps(command)*AStarShortestPathAlgoWithMacroMoves.UNIT_MOVE_COST
+                if command.startswith(PMessage.M_MOVE_FORWARD) else AStarShortestPathAlgoWithMacroMoves.UNIT_TURN_COST
+                for command in commands])
+
+def shortest_path_or_none(planner,robot_pos,robot_ori):
+    try:
+        return planner.get_shortest_path(robot_pos=robot_pos,robot_ori=robot_ori)
+    except Exception:
+        return None
+
+def test_macro_moves_cost():
+    "jumping straight runs must find plans as cheap as moving one grid at a time"
+    rand = random.Random(24)
+    for _ in range(100):
+        map_ref = random_map(rand)
+        accessible = map_ref.get_accessible_centre_pos()
+        if (len(accessible)<2):
+            continue
+        for _ in range(5):
+            robot_pos,robot_ori,target_pos = rand.choice(accessible),rand.choice([NORTH,EAST,SOUTH,WEST]),rand.choice(accessible)
+            grid_commands = shortest_path_or_none(AStarShortestPathAlgoWithOrientation(map_ref=map_ref,target_pos=target_pos),
+                                                  robot_pos,robot_ori)
+            macro_commands = shortest_path_or_none(AStarShortestPathAlgoWithMacroMoves(map_ref=map_ref,target_pos=target_pos),
+                                                   robot_pos,robot_ori)
+            assert (grid_commands is None)==(macro_commands is None),(robot_pos,robot_ori,target_pos)
+            if (grid_commands is None):
+                continue
+            assert get_unit_cost(macro_commands)==get_unit_cost(grid_commands),(robot_pos,robot_ori,target_pos)
+            assert RobotRef(pos=robot_pos,ori=robot_ori).get_pose_after(macro_commands)[0]==target_pos
+
+def get_moves(commands):
+    return [command for command in commands if command.startswith(PMessage.M_MOVE_FORWARD)]
+
+def test_move_overhead():
+    "every move paying an overhead, the cost model planner must cover the path in fewer, longer moves"
+    rand = random.Random(25)
+    cost_model = AStarShortestPathAlgoWithCostModel.get_cost_model()
+    num_unit_moves,num_overhead_moves = 0,0
+    try:
+        for _ in range(50):
+            map_ref = random_map(rand)
+            robot_pos,target_pos = map_ref.get_start_zone_center_pos(),map_ref.get_end_zone_center_pos()
+            AStarShortestPathAlgoWithCostModel.set_cost_model(ExecutionCostModel())
+            unit_commands = shortest_path_or_none(AStarShortestPathAlgoWithCostModel(map_ref=map_ref,target_pos=target_pos),
+                                                  robot_pos,NORTH)
+            if (unit_commands is None):
+                continue
+            AStarShortestPathAlgoWithCostModel.set_cost_model(ExecutionCostModel(move_overhead=10))
+            overhead_commands = AStarShortestPathAlgoWithCostModel(map_ref=map_ref,target_pos=target_pos).\
+                get_shortest_path(robot_pos=robot_pos,robot_ori=NORTH)
+            assert RobotRef(pos=robot_pos,ori=NORTH).get_pose_after(overhead_commands)[0]==target_pos
+            assert len(get_moves(overhead_commands))<=len(get_moves(unit_commands)),(unit_commands,overhead_commands)
+            num_unit_moves += len(get_moves(unit_commands))
+            num_overhead_moves += len(get_moves(overhead_commands))
+    finally:
+        AStarShortestPathAlgoWithCostModel.set_cost_model(cost_model)
+    assert num_overhead_moves<num_unit_moves,(num_overhead_moves,num_unit_moves)
+
+def test_cost_model_fit():
+    model = ExecutionCostModel(move_overhead=0.4,move_per_grid=0.25,turn_left=0.9,turn_right=1.1,turn_back=1.6,callibration=0.5)
+    samples = [(command,model.get_command_time(command))
+               for command in ["mf","mf*2","mf*5","mf*9","tl","tr","tb",PMessage.M_CALLIBRATE_RIGHT]]
+    fitted = ExecutionCostModel.fit(samples)
+    for name,value in model.get_params().items():
+        assert abs(fitted.get_params()[name]-value)<1e-9,(name,fitted.get_params())
+    # without turning back or callibrating, those take two quarter turns and the arduino delay
+    fitted = ExecutionCostModel.fit([sample for sample in samples if sample[0] in ("mf","mf*5","tl","tr")])
+    assert abs(fitted.get_turn_time(PMessage.M_TURN_BACK)-2.0)<1e-9
+    assert fitted.get_callibration_time()==ExecutionCostModel.DEFAULT_CALLIBRATION_TIME
+    try:
+        ExecutionCostModel.fit([("mf",1.0)])
+        assert False,"a model is fitted without turns"
+    except Exception as e:
+        assert "not enough samples" in str(e)
+
+def test_parse_ack_log():
+    ack = PMessage(type=PMessage.T_ROBOT_MOVE,msg="mf*3")
+    sensor = PMessage(type=PMessage.T_UPDATE_MAP_STATUS,msg="1,2,0")
+    lines = [
+        "[i]: 1000SER--Write to Arduino b4: mf*3\n",
+        "[i]: 1200SER--Read from Arduino after2: {}\n".format(sensor),
+        "[i]: 1750SER--Read from Arduino after3: {}\n".format(ack),
+        "[i]: 2000SER--Write to Arduino b4: {}\n".format(PMessage.M_CALLIBRATE_RIGHT),
+        "[i]: 2600SER--Write to Arduino b4: tl\n",
+        "[i]: 3500SER--Read from Arduino after2: {}\n".format(ack),
+        # the ack of the last move is missing
+        "[i]: 4000SER--Write to Arduino b4: mf\n",
+    ]
+    assert parse_ack_log(lines)==[("mf*3",0.75),(PMessage.M_CALLIBRATE_RIGHT,0.6),("tl",0.9)],parse_ack_log(lines)
+
+if __name__ == '__main__':
+    test_plan_in_batch()
+    test_repair_in_batch()
+    test_macro_moves_cost()
+    test_move_overhead()
+    test_cost_model_fit()
+    test_parse_ack_log()
@@ -1,6 +1,8 @@
 import os
 import math
 import re
+import itertools
+from contextlib import contextmanager
 from Tkinter import *
 from abc import ABCMeta,abstractmethod
 from bitarray import bitarray
@@ -9,6 +11,9 @@ from common import *
 from common.debug import debug,DEBUG_COMMON
 from common.popattern import *
 
+# every change of any map takes the next number, so a version identifies the content of one map in this process
+_map_versions = itertools.count(1)
+
 class MapSetting():
     # map settings
     DEFAULT_MAP_SIZE_X = 15
@@ -30,6 +35,7 @@ class MapSetting():
 
     DEFAULT_CELL_VALUE = UNKNOWN
     VALID_CELL_VALUES = [CLEAR,OBSTACLE,UNKNOWN,START_ZONE,END_ZONE]
+    BLOCKING_CELL_VALUES = [OBSTACLE,UNKNOWN] # robot cannot overlap these cells
     START_ZONE_INDICES = [(x,y) for x in range(3) for y in range(3)]
     # default directory to store map descriptors
     # see MapRef
@@ -175,16 +181,24 @@ class MapRef(BitMapIOMixin,MapSetting,BasePublisher):
     internal representation of the arena map
     """
 
-    # map data
-    _map_ref = None # 2D matrix
-    _fixed_list = None # list of positions that cannot be reassigned value
+    # map data, all stored as flat arrays indexed by y*size_x+x
+    _map_ref = None # bytearray of cell values
+    _fixed_cells = None # bytearray, 1 if the cell cannot be reassigned value
+    _blocked_counts = None # bytearray, number of blocking cells in the 3*3 robot footprint centred at each cell
+    _value_counts = None # list, number of cells holding each cell value, indexed by value
+    _version = 0 # changes whenever a cell value changes, see get_version()
 
     size_x = 0
     size_y = 0
     _start_zone_centre_pos = ()
     _end_zone_centre_pos = ()
 
-    _listeners = [] # list of observers
+    _topic = BasePublisher.TOPIC_MAP
+
+    # change notification batching, see begin_batch()
+    _batch_depth = 0
+    _dirty_pos = None # set of positions changed during the batch
+    _dirty_all = False # whether a full-map notification is pending
 
     def __init__(self,x=None,y=None,default=None):
         self.reset(x,y,default)
@@ -192,56 +206,117 @@ class MapRef(BitMapIOMixin,MapSetting,BasePublisher):
     def reset(self,x=None,y=None,default=None):
         self._start_zone_centre_pos=self.DEFAULT_START_POS
         self._end_zone_centre_pos = self.DEFAULT_END_POS
-        self._fixed_list = []
         if (x and y and default):
-            self._map_ref = [[default for _ in range(x)] for __ in range(y)]
+            self._init_storage(x,y,default)
         else:
-            self._map_ref = [[self.DEFAULT_CELL_VALUE for _ in range(self.DEFAULT_MAP_SIZE_X)] for __ in range(self.DEFAULT_MAP_SIZE_Y)]
+            self._init_storage(self.DEFAULT_MAP_SIZE_X,self.DEFAULT_MAP_SIZE_Y,self.DEFAULT_CELL_VALUE)
         # set start zone to be clear
-        self._update_size()
         indexes = self.get_start_zone_indexes() + self.get_end_zone_indexes()
         self.set_fixed_cells(indexes,value=MapSetting.CLEAR)
         self.notify()
 
     def is_fully_explored(self):
-        return self.get_unknown_percentage()==0
+        return self._value_counts[self.UNKNOWN]==0
 
     def get_unknown_percentage(self):
         map_size = self.size_y * self.size_x
-        num_unknown_cells = sum([1 for x in range(self.size_x) for y in range(self.size_y) if self.get_cell(x,y)==self.UNKNOWN])
+        num_unknown_cells = self._value_counts[self.UNKNOWN]
         return int(math.ceil(100.0*num_unknown_cells/map_size))
 
+    def get_version(self):
+        "return a number that changes whenever the map changes, two maps never share a version"
+        return self._version
+
+    def get_num_cells(self,value):
+        "return the number of cells currently holding value"
+        return self._value_counts[value]
+
     def refresh(self):
         self.notify()
 
     def get_cell(self,x,y):
-        return self._map_ref[y][x]
+        return self._map_ref[y*self.size_x+x]
+
+    def get_cells(self):
+        "return the bytearray of all cell values indexed by y*size_x+x, it must not be modified"
+        return self._map_ref
 
     def set_cell(self,x,y,value,notify=True):
-        if ((x,y) in self._fixed_list):
+        if (self.is_out_of_arena(x,y)):
+            return
+        index = y*self.size_x+x
+        if (self._fixed_cells[index]):
             return
-        self._map_ref[y][x] = value
+        self._write_cell(index,x,y,value)
         if (notify):
             self.notify([(x,y)])
 
     def set_cell_list(self,pos_list,value,notify=True,maintain_obstacle=True,maintain_clear=False):
         "pos_list should be a list of (x,y), if maintain_obstacle is true, then the cells that are already set to be obstacle will NOT be updated"
+        cells,fixed_cells,size_x = self._map_ref,self._fixed_cells,self.size_x
         for x,y in pos_list:
-            if ((x,y) in self._fixed_list):
+            if (self.is_out_of_arena(x,y)):
                 continue
-            if (not self.is_out_of_arena(x,y)):
-                if (maintain_obstacle and self.get_cell(x,y)==MapSetting.OBSTACLE):
-                    continue
-                if (maintain_clear and self.get_cell(x,y)==MapSetting.CLEAR):
-                    continue
-                self.set_cell(x,y,value,notify=False)
+            index = y*size_x+x
+            if (fixed_cells[index]):
+                continue
+            if (maintain_obstacle and cells[index]==MapSetting.OBSTACLE):
+                continue
+            if (maintain_clear and cells[index]==MapSetting.CLEAR):
+                continue
+            self._write_cell(index,x,y,value)
         if (notify):
             self.notify(pos_list)
 
+    def _write_cell(self,index,x,y,value):
+        "the only place where a cell value is changed, keep derived data in sync"
+        old_value = self._map_ref[index]
+        if (old_value==value):
+            return
+        self._map_ref[index] = value
+        self._version = next(_map_versions)
+        self._value_counts[old_value] -= 1
+        self._value_counts[value] += 1
+        was_blocking = old_value in self.BLOCKING_CELL_VALUES
+        is_blocking = value in self.BLOCKING_CELL_VALUES
+        if (was_blocking!=is_blocking):
+            self._update_blocked_counts(x,y,1 if is_blocking else -1)
+
     def set_fixed_cells(self,pos_list,value):
         "set cells' value and mark them as fixed"
         self.set_cell_list(pos_list,value,maintain_obstacle=False,maintain_clear=False)
-        self._fixed_list = list(set(self._fixed_list + pos_list))
+        for x,y in pos_list:
+            if (not self.is_out_of_arena(x,y)):
+                self._fixed_cells[y*self.size_x+x] = 1
+
+    def is_fixed_cell(self,x,y):
+        return not self.is_out_of_arena(x,y) and self._fixed_cells[y*self.size_x+x]==1
+
+    def is_accessible_centre(self,x,y):
+        "return True if the robot footprint centred at (x,y) is inside the arena and overlaps no obstacle or unknown cell"
+        if (self.is_out_of_arena(x,y) or self.is_along_wall(x,y)):
+            return False
+        return self._blocked_counts[y*self.size_x+x]==0
+
+    def get_accessible_centre_pos(self):
+        "return a list of positions where the robot centre can be placed"
+        return [(x,y) for y in range(1,self.size_y-1) for x in range(1,self.size_x-1)
+                if self._blocked_counts[y*self.size_x+x]==0]
+
+    def _rebuild_blocked_counts(self):
+        "recompute the footprint blocking counts from scratch"
+        self._blocked_counts = bytearray(self.size_x*self.size_y)
+        for y in range(self.size_y):
+            for x in range(self.size_x):
+                if (self._map_ref[y*self.size_x+x] in self.BLOCKING_CELL_VALUES):
+                    self._update_blocked_counts(x,y,1)
+
+    def _update_blocked_counts(self,x,y,delta):
+        "add delta to the counts of all centres whose footprint covers (x,y)"
+        counts,size_x = self._blocked_counts,self.size_x
+        for j in range(max(y-1,0),min(y+2,self.size_y)):
+            for i in range(max(x-1,0),min(x+2,size_x)):
+                counts[j*size_x+i] += delta
 
     def are_all_unaccessible(self,pos_list):
         "return true if all positions in the list are not accessbile"
@@ -262,25 +337,47 @@ class MapRef(BitMapIOMixin,MapSetting,BasePublisher):
         return [(x,y) for x in range(self.size_x) for y in range(self.size_y) if x==0 or x==self.size_x-1 or y==0 or y==self.size_y-1]
 
     def load_map_from_file(self,file_name):
-        self._map_ref=self.load_map(file_name)
+        self._load_2d_array(self.load_map(file_name))
         indexes = self.get_start_zone_indexes()
         self.set_cell_list(indexes,value=MapSetting.CLEAR)
-        self._update_size()
         self.notify()
 
     def save_map_to_file(self,filename):
-        self.save_map(filename,td_array=self._map_ref)
-
-    def _update_size(self):
-        self.size_x = len(self._map_ref[0])
-        self.size_y = len(self._map_ref)
+        self.save_map(filename,td_array=self.to_2d_array())
+
+    def to_2d_array(self):
+        "return the map as a list of rows, as used by the map IO mixins"
+        return [list(self._map_ref[y*self.size_x:(y+1)*self.size_x]) for y in range(self.size_y)]
+
+    def _init_storage(self,size_x,size_y,value):
+        "allocate the flat arrays for a size_x*size_y map with every cell set to value"
+        self.size_x = size_x
+        self.size_y = size_y
+        self._map_ref = bytearray([value])*(size_x*size_y)
+        self._fixed_cells = bytearray(size_x*size_y)
+        self._rebuild_derived_data()
+
+    def _load_2d_array(self,td_array):
+        "replace the cell values with td_array, fixed cells are kept if the map size is unchanged"
+        size_x,size_y = len(td_array[0]),len(td_array)
+        if (size_x!=self.size_x or size_y!=self.size_y):
+            self._init_storage(size_x,size_y,self.DEFAULT_CELL_VALUE)
+        self._map_ref = bytearray(value for row in td_array for value in row)
+        self._rebuild_derived_data()
+
+    def _rebuild_derived_data(self):
+        "recompute everything derived from the cell values, call after _map_ref is replaced"
+        self._version = next(_map_versions)
+        self._value_counts = [0]*(max(self.VALID_CELL_VALUES)+1)
+        for value in self._map_ref:
+            self._value_counts[value] += 1
+        self._rebuild_blocked_counts()
 
     def is_out_of_arena(self,x,y):
         return (x<0 or y<0 or x>=self.size_x or y>=self.size_y)
 
     def get_num_obstacles(self):
-        return sum([1 if self.get_cell(x,y)==MapSetting.OBSTACLE else 0
-                    for x in range(self.size_x) for y in range(self.size_y)])
+        return self._value_counts[MapSetting.OBSTACLE]
 
     def set_unknowns_as_clear(self):
         "set all unknown cells as clear"
@@ -312,7 +409,59 @@ class MapRef(BitMapIOMixin,MapSetting,BasePublisher):
         x,y=self.get_start_zone_center_pos()
         return [(x+i,y+j) for i in range(-1,2) for j in range(-1,2)]
 
+    def begin_batch(self):
+        "hold back notifications until the matching end_batch(), batches can be nested"
+        if (self._batch_depth==0):
+            self._dirty_pos = set()
+            self._dirty_all = False
+        self._batch_depth += 1
+
+    def end_batch(self):
+        "deliver all positions changed since begin_batch() as a single notification"
+        if (self._batch_depth==0):
+            raise Exception("end_batch called without begin_batch")
+        self._batch_depth -= 1
+        if (self._batch_depth>0):
+            return
+        dirty_pos,dirty_all = self._dirty_pos,self._dirty_all
+        self._dirty_pos = None
+        self._dirty_all = False
+        if (dirty_all):
+            self.notify()
+        elif (dirty_pos):
+            self.notify(sorted(dirty_pos))
+
+    @contextmanager
+    def batch(self):
+        "context manager wrapping begin_batch() and end_batch()"
+        self.begin_batch()
+        try:
+            yield self
+        finally:
+            self.end_batch()
+
+    def is_batching(self):
+        return self._batch_depth>0
+
+    def get_pending_changes(self):
+        """
+        return the positions changed in the open batch that listeners have not been notified of yet,
+        None if the whole map has changed, an empty list outside a batch
+        listeners caching data derived from the map must merge these before answering inside a batch
+        """
+        if (self._batch_depth==0):
+            return []
+        if (self._dirty_all):
+            return None
+        return list(self._dirty_pos)
+
     def notify(self,data=None):
+        if (self._batch_depth>0):
+            if (data!=None):
+                self._dirty_pos.update(data)
+            else:
+                self._dirty_all = True
+            return
         if (data!=None):
             super(MapRef,self).notify(data=data)
         else:
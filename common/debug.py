@@ -34,6 +34,10 @@ DEBUG_SETTING = {
 }
 
 
+def is_debug_enabled(type):
+    "return True if debug messages of type are printed, used to skip building expensive messages"
+    return type in DEBUG_SETTING['enabled_types']
+
 def debug(message,type):
     "if save_file is turned on, file will be saved to hour-minute-second(debug).txt"
     if (not hasattr(debug,"started")):
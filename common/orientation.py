@@ -1,6 +1,11 @@
 from common.pmessage import PMessage
 
-class Orientation():
+class Orientation(object):
+    """
+    orientations are interned, there is exactly one object for every value,
+    so they can be compared with `is` and used as dict keys
+    everything derived from the value is computed once by _build_tables()
+    """
     _val = 0
 
     def __init__(self,val):
@@ -13,6 +18,16 @@ class Orientation():
     def get_name(self):
         raise NotImplementedError()
 
+    # copies and unpickled objects are the interned instance
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self,memo):
+        return self
+
+    def __reduce__(self):
+        return (_get_interned_orientation,(self.__class__,self._val))
+
 class AbsoluteOrientation(Orientation):
     """
     This should be a singleton pattern, only use get_instance() to get object
@@ -22,65 +37,88 @@ class AbsoluteOrientation(Orientation):
     6  5      4
     """
     POS_CHANGE_DICT = {0:(-1,-1),1:(0,-1),2:(1,-1),3:(1,0),4:(1,1),5:(0,1),6:(-1,1),7:(-1,0)}
-    ACTION_TO_ORI_CHANGE = {PMessage.M_TURN_LEFT:-2,PMessage.M_TURN_RIGHT:2,PMessage.M_MOVE_FORWARD:0}
+    ACTION_TO_ORI_CHANGE = {PMessage.M_TURN_LEFT:-2,PMessage.M_TURN_RIGHT:2,PMessage.M_TURN_BACK:4,PMessage.M_MOVE_FORWARD:0}
     ORI_VERBOSE = {1:'up',5:'down',7:'left',3:'right'}
+    POS_CHANGE_TO_VALUE = {(0,-1):1,(1,0):3,(0,1):5,(-1,0):7}
+
+    _instances = {} # value => instance
 
-    _instances = []
+    # tables of every instance, see _build_tables()
+    _pos_change = None
+    _left = None
+    _right = None
+    _back = None
+    _action_results = None # action => orientation
+    _turns_to = None # list indexed by the value of the other orientation
+    _turn_actions_to = None # list indexed by the value of the other orientation
 
     @staticmethod
     def get_instance(val):
-        for instance in AbsoluteOrientation._instances:
-            if (instance.get_value()==val):
-                return instance
-        # create new instance
-        new_instance = AbsoluteOrientation(val)
-        AbsoluteOrientation._instances.append(new_instance)
-        return new_instance
+        instance = AbsoluteOrientation._instances.get(val)
+        if (instance is None):
+            # create new instance
+            instance = AbsoluteOrientation(val)
+            AbsoluteOrientation._instances[val] = instance
+        return instance
+
+    @staticmethod
+    def _build_tables():
+        "called once all eight instances exist"
+        instances = [AbsoluteOrientation.get_instance(val) for val in range(8)]
+        for ori in instances:
+            val = ori._val
+            ori._pos_change = AbsoluteOrientation.POS_CHANGE_DICT[val]
+            ori._left = instances[(val+2*3)%8]
+            ori._right = instances[(val+2*1)%8]
+            ori._back = instances[(val+2*2)%8]
+            ori._action_results = dict((action,instances[(val+change)%8])
+                                       for action,change in AbsoluteOrientation.ACTION_TO_ORI_CHANGE.items())
+            ori._turns_to = []
+            ori._turn_actions_to = []
+            for other_val in range(8):
+                val_diff = (other_val-val)%8
+                ori._turns_to.append(int(min(val_diff,8-val_diff)/2))
+                if (val_diff==2):
+                    ori._turn_actions_to.append([PMessage.M_TURN_RIGHT])
+                elif (val_diff==6):
+                    ori._turn_actions_to.append([PMessage.M_TURN_LEFT])
+                elif (val_diff==4):
+                    # turn 180 degrees
+                    ori._turn_actions_to.append([PMessage.M_TURN_RIGHT,PMessage.M_TURN_RIGHT])
+                else: # no need to turn
+                    ori._turn_actions_to.append([])
 
     def to_pos_change(self):
         "return tuple representing the position change relative to the center"
-        return self.POS_CHANGE_DICT[self._val]
+        return self._pos_change
 
     def if_applied_action(self,action):
         "return the resulting ori if action applied"
-        new_val = (self._val + self.ACTION_TO_ORI_CHANGE[action])%8
-        return AbsoluteOrientation.get_instance(new_val)
+        return self._action_results[action]
 
     def get_minimum_turns_to(self,a_ori):
         "return number of turns needed to be made to reach a_ori"
-        val_diff = (a_ori._val-self._val)%8
-        val_diff = min(val_diff,8-val_diff)
-        return int(val_diff/2)
+        return self._turns_to[a_ori._val]
 
     def to_left(self):
-        return AbsoluteOrientation.get_instance((self._val+2*3)%8)
+        return self._left
 
     def to_right(self):
-        return AbsoluteOrientation.get_instance((self._val+2*1)%8)
+        return self._right
 
     def to_back(self):
-        return AbsoluteOrientation.get_instance((self._val+2*2)%8)
+        return self._back
 
     @staticmethod
     def get_ori_at_dest(start_pos,dest_pos):
         "return the resulting ori if the robot go from start to dest"
         pos_diff = (dest_pos[0]-start_pos[0],dest_pos[1]-start_pos[1])
-        LOOPUP_DICT = {(0,-1):1,(1,0):3,(0,1):5,(-1,0):7}
-        new_val = LOOPUP_DICT[pos_diff]
-        return AbsoluteOrientation.get_instance(new_val)
+        return AbsoluteOrientation._instances[AbsoluteOrientation.POS_CHANGE_TO_VALUE[pos_diff]]
 
     @staticmethod
     def get_turn_actions(start_ori,end_ori):
         "return the list of actions to turn from start_ori to end_ori, None if no action needed"
-        if (end_ori.get_value()==(start_ori.get_value()+2)%8):
-            return [PMessage.M_TURN_RIGHT]
-        elif(end_ori.get_value()==(start_ori.get_value()-2)%8):
-            return [PMessage.M_TURN_LEFT]
-        elif (end_ori.get_value()==(start_ori.get_value()+4)%8):
-            # turn 180 degrees
-            return [PMessage.M_TURN_RIGHT,PMessage.M_TURN_RIGHT]
-        else: # no need to turn
-            return []
+        return list(start_ori._turn_actions_to[end_ori._val])
 
     def get_name(self):
         "get verbose name"
@@ -102,27 +140,31 @@ class RelativeOrientation(Orientation):
 
     ORI_VERBOSE = {-1:'front-left',0:'front',1:'front-right',-2:'left',2:'right',-3:'back-left',3:'back-right',4:'back'}
 
-    _instances = []
+    _instances = {} # value => instance
+    _abs_oris = None # list of absolute orientations indexed by the value of the front orientation, see _build_tables()
 
     @staticmethod
     def get_instance(val):
-        for instance in RelativeOrientation._instances:
-            if (instance.get_value()==val):
-                return instance
-        # create new instance
-        new_instance = RelativeOrientation(val)
-        RelativeOrientation._instances.append(new_instance)
-        return new_instance
+        instance = RelativeOrientation._instances.get(val)
+        if (instance is None):
+            # create new instance
+            instance = RelativeOrientation(val)
+            RelativeOrientation._instances[val] = instance
+        return instance
+
+    @staticmethod
+    def _build_tables():
+        "called once the absolute orientations have their tables"
+        for val in range(-3,5):
+            ori = RelativeOrientation.get_instance(val)
+            ori._abs_oris = [AbsoluteOrientation.get_instance((val+front_val)%8) for front_val in range(8)]
 
     def get_actual_abs_ori(self,ref_front_ori):
         "return absolute orientation, if front_major is True, front-left and front-right will be considered as front"
-        val = self._val
-        abs_val = (val + ref_front_ori.get_value())%8
-        return AbsoluteOrientation.get_instance(abs_val)
+        return self._abs_oris[ref_front_ori._val]
 
     def to_pos_change(self,rel_front_ori):
-        abs_val = (self._val + rel_front_ori.get_value())%8
-        return AbsoluteOrientation.get_instance(abs_val).to_pos_change()
+        return self._abs_oris[rel_front_ori._val]._pos_change
 
     def __unicode__(self):
         return self.ORI_VERBOSE[self._val]
@@ -131,6 +173,9 @@ class RelativeOrientation(Orientation):
         return self.ORI_VERBOSE[self._val]
 
 
+def _get_interned_orientation(cls,val):
+    return cls.get_instance(val)
+
 #TODO: move this to another module
 def sum_coordinate(c1,c2):
     return tuple(sum(x) for x in zip(c1, c2))
@@ -155,4 +200,7 @@ LEFT = RelativeOrientation.get_instance(-2)
 RIGHT = RelativeOrientation.get_instance(2)
 BACK_LEFT = RelativeOrientation.get_instance(-3)
 BACK_RIGHT = RelativeOrientation.get_instance(3)
-BACK = RelativeOrientation.get_instance(4)
\ No newline at end of file
+BACK = RelativeOrientation.get_instance(4)
+
+AbsoluteOrientation._build_tables()
+RelativeOrientation._build_tables()
@@ -1,4 +1,10 @@
 import json
+import re
+import struct
+import time
+from common.debug import debug,DEBUG_VALIDATION
+
+JSON_OBJECT_PATTERN = re.compile(r'{[^{}]+}')
 
 class ValidationException(Exception):
     pass
@@ -18,6 +24,7 @@ class PMessage():
     T_UPDATE_ROBOT_STATUS = "ur" # msg should be x,y,o
     T_UPDATE_MAP_STATUS = "ums" # msg should be a list of tuples
     T_CALLIBRATE = "callibrate"
+    T_SET_FRAMING = "framing" # msg should be one of PMessageStream.VALID_FRAMINGS, see PMessageStream.request_framing()
     #TODO: for simulation only
     T_LOAD_MAP = "loadmap" # msg should be map path
 
@@ -39,15 +46,20 @@ class PMessage():
     M_CALLIBRATE_LEFT = "cleft"
     M_CALLIBRATE_RIGHT = "cright"
 
+    MAX_MOVE_FORWARD_STEPS = 20
+    M_MULTI_MOVE_FORWARD_MSGS = ["mf*{}".format(i) for i in range(1,MAX_MOVE_FORWARD_STEPS+1)]
+
+    # built once for O(1) membership tests, see validate()
+    VALID_CMD_MSG_SET = frozenset(M_MULTI_MOVE_FORWARD_MSGS + M_VALID_COMMAND_MSGS)
+    VALID_MOVE_COMMAND_SET = frozenset(M_MULTI_MOVE_FORWARD_MSGS + M_MOVE_INSTRUCTIONS)
+
     @staticmethod
     def get_valid_cmd_msgs():
-        mf_msgs = ["mf*{}".format(i) for i in range(1,21)]
-        return mf_msgs + PMessage.M_VALID_COMMAND_MSGS
+        return PMessage.M_MULTI_MOVE_FORWARD_MSGS + PMessage.M_VALID_COMMAND_MSGS
 
     @staticmethod
     def get_valid_move_commands():
-        mf_msgs = ["mf*{}".format(i) for i in range(1,21)]
-        return mf_msgs + PMessage.M_MOVE_INSTRUCTIONS
+        return PMessage.M_MULTI_MOVE_FORWARD_MSGS + PMessage.M_MOVE_INSTRUCTIONS
 
 
     def render_msg(self):
@@ -63,25 +75,24 @@ class PMessage():
     def __init__(self,**kwargs):
         """
         can either initialize via json by passing in `json_str`,
-        or pass in `type` and `msg`
+        or pass in `type` and `msg`,
+        pass `validate=False` to skip validation for trusted messages generated internally
         """
         json_str = kwargs.get("json_str")
         if (json_str):
             obj = json.loads(json_str)
-            PMessage.validate(obj['type'],obj['msg'])
-            self._type = obj['type'].strip()
-            self._msg = obj['msg'].strip()
+            type,msg = obj['type'],obj['msg']
         else:
-            PMessage.validate(kwargs.get("type"),kwargs.get("msg"))
-            self._type = kwargs.get("type").strip()
-            self._msg = kwargs.get("msg").strip()
+            type,msg = kwargs.get("type"),kwargs.get("msg")
+        if (kwargs.get("validate",True)):
+            PMessage.validate(type,msg)
+        self._type = type.strip()
+        self._msg = msg.strip()
 
     @staticmethod
     def load_messages_from_json(json_str):
         "json_str may be a concatenation of json, return a list of PMessage"
-        import re
-        json_pattern = re.compile(r'{[^{}]+}')
-        json_strs = json_pattern.findall(json_str)
+        json_strs = JSON_OBJECT_PATTERN.findall(json_str)
         return [PMessage(json_str=js) for js in json_strs]
 
     def equals(self,a_msg):
@@ -99,33 +110,10 @@ class PMessage():
     @staticmethod
     def validate(type,msg):
         # only validate messages read in from android or arduino
-        msg = msg.strip()
-        if (type==PMessage.T_COMMAND):
-            if (msg not in PMessage.get_valid_cmd_msgs()):
-                raise ValidationException("{} is not a valid command".format(msg))
-        elif(type==PMessage.T_ROBOT_MOVE):
-            if (msg not in PMessage.get_valid_cmd_msgs()
-                and msg!=PMessage.M_START_FASTRUN):
-                raise ValidationException("{} is not a valid robot move".format(msg))
-        elif(type==PMessage.T_STATE_CHANGE):
-            return
-        elif(type==PMessage.T_MAP_UPDATE):
-            try:
-                values = map(int,msg.strip().split(","))
-                a = values[PMessage.SENSOR_VALUE_NUM-1]
-            except:
-                raise ValidationException("{} is not a valid map update".format(msg))
-        elif(type==PMessage.T_SET_ROBOT_POS):
-            PMessage.validate_int_list(msg,2)
-        elif(type==PMessage.T_UPDATE_ROBOT_STATUS):
-            PMessage.validate_int_list(msg,3)
-        elif(type==PMessage.T_UPDATE_MAP_STATUS):
-            #TODO: validate this
-            return
-        elif(type==PMessage.T_LOAD_MAP or type==PMessage.T_CALLIBRATE):
-            return
-        else:
+        validator = _VALIDATORS.get(type)
+        if (validator is None):
             raise ValidationException("{} is not a valid message type".format(type))
+        validator(msg.strip())
 
     @staticmethod
     def validate_int_list(ls_str,expected_len):
@@ -134,4 +122,457 @@ class PMessage():
         except:
             raise ValidationException("{} is not a valid int list".format(ls_str))
         if (len(values)!=expected_len):
-            raise ValidationException("{} has length {}, expected {}".format(ls_str,len(values),expected_len))
\ No newline at end of file
+            raise ValidationException("{} has length {}, expected {}".format(ls_str,len(values),expected_len))
+
+def _validate_command(msg):
+    if (msg not in PMessage.VALID_CMD_MSG_SET):
+        raise ValidationException("{} is not a valid command".format(msg))
+
+def _validate_robot_move(msg):
+    # M_START_FASTRUN is part of VALID_CMD_MSG_SET
+    if (msg not in PMessage.VALID_CMD_MSG_SET):
+        raise ValidationException("{} is not a valid robot move".format(msg))
+
+def _validate_map_update(msg):
+    try:
+        values = map(int,msg.split(","))
+        a = values[PMessage.SENSOR_VALUE_NUM-1]
+    except:
+        raise ValidationException("{} is not a valid map update".format(msg))
+
+def _validate_robot_pos(msg):
+    PMessage.validate_int_list(msg,2)
+
+def _validate_robot_status(msg):
+    PMessage.validate_int_list(msg,3)
+
+def _validate_framing(msg):
+    if (msg not in PMessageStream.VALID_FRAMINGS):
+        raise ValidationException("{} is not a valid framing".format(msg))
+
+def _validate_map_status(msg):
+    # x,y,value of every changed cell, joined by |
+    for cell in msg.split("|"):
+        PMessage.validate_int_list(cell,3)
+
+def _validate_nothing(msg):
+    return
+
+# message type => validator of the stripped msg, precompiled at import
+_VALIDATORS = {
+    PMessage.T_COMMAND: _validate_command,
+    PMessage.T_ROBOT_MOVE: _validate_robot_move,
+    PMessage.T_STATE_CHANGE: _validate_nothing,
+    PMessage.T_MAP_UPDATE: _validate_map_update,
+    PMessage.T_SET_ROBOT_POS: _validate_robot_pos,
+    PMessage.T_UPDATE_ROBOT_STATUS: _validate_robot_status,
+    PMessage.T_UPDATE_MAP_STATUS: _validate_map_status,
+    PMessage.T_LOAD_MAP: _validate_nothing,
+    PMessage.T_CALLIBRATE: _validate_nothing,
+    PMessage.T_SET_FRAMING: _validate_framing,
+}
+
+
+class PMessageBinaryCodec(object):
+    """
+    compact binary representation of PMessage, used by PMessageStream.FRAMING_BINARY
+    frame layout: 1 type byte, varint payload length, payload
+    payloads are packed for the frequent message types:
+    `T_UPDATE_MAP_STATUS`: 2 bytes per cell, x(6 bits) y(6 bits) value(4 bits)
+    `T_UPDATE_ROBOT_STATUS`: 3 unsigned bytes x,y,orientation
+    `T_MAP_UPDATE`: SENSOR_VALUE_NUM signed bytes
+    `T_COMMAND`,`T_ROBOT_MOVE`: 1 byte index into PMessage.get_valid_cmd_msgs()
+    a message that cannot be packed losslessly is sent as text with the RAW_FLAG set in the type byte,
+    a message of unknown type is sent as its json rendering with type byte 0
+    """
+    TYPE_JSON = 0
+    RAW_FLAG = 0x80
+    # type byte of each message type is its index + 1, only append to this list
+    TYPES = [PMessage.T_COMMAND,
+             PMessage.T_STATE_CHANGE,
+             PMessage.T_ROBOT_MOVE,
+             PMessage.T_MAP_UPDATE,
+             PMessage.T_SET_ROBOT_POS,
+             PMessage.T_UPDATE_ROBOT_STATUS,
+             PMessage.T_UPDATE_MAP_STATUS,
+             PMessage.T_CALLIBRATE,
+             PMessage.T_LOAD_MAP,
+             PMessage.T_SET_FRAMING]
+    TYPE_CODES = dict((t,i+1) for i,t in enumerate(TYPES))
+
+    CMD_MSGS = PMessage.get_valid_cmd_msgs()
+    CMD_CODES = dict((m,i) for i,m in enumerate(CMD_MSGS))
+
+    _CELL_FORMAT = "!H"
+    _ROBOT_STATUS_FORMAT = "!3B"
+    _SENSOR_FORMAT = "!{}b".format(PMessage.SENSOR_VALUE_NUM)
+
+    def encode(self,pmsg):
+        "return the frame for pmsg"
+        code = self.TYPE_CODES.get(pmsg.get_type())
+        if (code is None):
+            code,payload = self.TYPE_JSON,pmsg.render_msg()
+        else:
+            payload = self._pack(pmsg.get_type(),pmsg.get_msg())
+            if (payload is None):
+                code,payload = code | self.RAW_FLAG,pmsg.get_msg().encode("utf-8")
+        return chr(code) + encode_varint(len(payload)) + payload
+
+    def decode(self,code,payload):
+        "return the PMessage of a frame, raise ValidationException if the frame is invalid"
+        if (code==self.TYPE_JSON):
+            return PMessage(json_str=payload)
+        type_index = (code & ~self.RAW_FLAG) - 1
+        if (type_index<0 or type_index>=len(self.TYPES)):
+            raise ValidationException("{} is not a valid type code".format(code))
+        type = self.TYPES[type_index]
+        if (code & self.RAW_FLAG):
+            msg = payload.decode("utf-8")
+        else:
+            try:
+                msg = self._unpack(type,payload)
+            except (struct.error,IndexError) as e:
+                raise ValidationException("cannot unpack {}: {}".format(type,e))
+        return PMessage(type=type,msg=msg)
+
+    def _pack(self,type,msg):
+        "return packed payload, None if msg has no lossless packed form"
+        try:
+            if (type==PMessage.T_UPDATE_MAP_STATUS):
+                return self._pack_cells(msg)
+            elif (type==PMessage.T_UPDATE_ROBOT_STATUS):
+                return self._pack_ints(self._ROBOT_STATUS_FORMAT,msg)
+            elif (type==PMessage.T_MAP_UPDATE):
+                return self._pack_ints(self._SENSOR_FORMAT,msg)
+            elif (type==PMessage.T_COMMAND or type==PMessage.T_ROBOT_MOVE):
+                code = self.CMD_CODES.get(msg)
+                return None if code is None else chr(code)
+        except (ValueError,struct.error):
+            pass
+        return None
+
+    def _unpack(self,type,payload):
+        if (type==PMessage.T_UPDATE_MAP_STATUS):
+            return self._unpack_cells(payload)
+        elif (type==PMessage.T_UPDATE_ROBOT_STATUS):
+            return ",".join(map(str,struct.unpack(self._ROBOT_STATUS_FORMAT,payload)))
+        elif (type==PMessage.T_MAP_UPDATE):
+            return ",".join(map(str,struct.unpack(self._SENSOR_FORMAT,payload)))
+        elif (type==PMessage.T_COMMAND or type==PMessage.T_ROBOT_MOVE):
+            return self.CMD_MSGS[ord(payload)]
+        raise ValidationException("{} has no packed form".format(type))
+
+    def _pack_ints(self,format,msg):
+        values = map(int,msg.split(","))
+        data = struct.pack(format,*values)
+        if (",".join(map(str,values))!=msg):
+            # not in canonical form, packing would change the message
+            return None
+        return data
+
+    def _pack_cells(self,msg):
+        if (not msg):
+            return None
+        data = []
+        for cell in msg.split("|"):
+            x,y,v = map(int,cell.split(","))
+            if (not (0<=x<64 and 0<=y<64 and 0<=v<16) or "{},{},{}".format(x,y,v)!=cell):
+                return None
+            data.append(struct.pack(self._CELL_FORMAT,(x<<10)|(y<<4)|v))
+        return "".join(data)
+
+    def _unpack_cells(self,payload):
+        if (len(payload)%2):
+            raise ValidationException("cell run has odd length {}".format(len(payload)))
+        cells = struct.unpack("!{}H".format(len(payload)/2),payload)
+        return "|".join(["{},{},{}".format(c>>10,(c>>4)&0x3f,c&0xf) for c in cells])
+
+
+def encode_varint(value):
+    "unsigned LEB128"
+    data = []
+    while (value>=0x80):
+        data.append(chr((value & 0x7f) | 0x80))
+        value >>= 7
+    data.append(chr(value))
+    return "".join(data)
+
+def decode_varint(data,pos=0):
+    "return (value,position after the varint), value is None if data ends within the varint"
+    value = 0
+    shift = 0
+    while (pos<len(data)):
+        byte = ord(data[pos])
+        value |= (byte & 0x7f) << shift
+        pos += 1
+        if (not byte & 0x80):
+            return value,pos
+        shift += 7
+    return None,pos
+
+
+class PMessageStream(object):
+    """
+    incremental decoder for PMessages received over a stream connection
+    keeps the incomplete frame between calls of feed(), so a message split across reads is not lost
+    supported framings:
+    `FRAMING_JSON`: concatenated json objects, compatible with render_msg()
+    `FRAMING_NEWLINE`: one json object per line
+    `FRAMING_LENGTH_PREFIX`: 4-byte big-endian length followed by the json object
+    `FRAMING_BINARY`: PMessageBinaryCodec frames
+
+    the framing can be negotiated on an open connection:
+    one side calls request_framing() and holds further messages until the other side answers,
+    the other side answers with the framing it accepts in the old framing and switches right after,
+    the answers and held messages are collected by pop_outgoing() and must be sent by the interface,
+    check_negotiation() gives up a request that is not answered in time and keeps the old framing
+    """
+    FRAMING_JSON = "json"
+    FRAMING_NEWLINE = "newline"
+    FRAMING_LENGTH_PREFIX = "length"
+    FRAMING_BINARY = "binary"
+    VALID_FRAMINGS = [FRAMING_JSON,FRAMING_NEWLINE,FRAMING_LENGTH_PREFIX,FRAMING_BINARY]
+
+    MAX_FRAME_SIZE = 1<<16 # larger frames are treated as garbage and dropped
+    _LENGTH_FORMAT = "!I"
+    _LENGTH_SIZE = struct.calcsize(_LENGTH_FORMAT)
+
+    _framing = FRAMING_JSON
+    _accepted_framings = None # framings the other side may switch this stream to
+    _codec = None # PMessageBinaryCodec
+    _buffer = "" # received data not decoded yet
+    # json scanning state, so that data already in the buffer is scanned only once
+    _scan_pos = 0
+    _depth = 0
+    _in_string = False
+    _escaped = False
+    # negotiation state
+    _requested_framing = None # framing requested by this side and not answered yet
+    _held_msgs = None # PMessages encoded while waiting for the answer
+    _outgoing = None # data to be sent because of negotiation
+    _requested_at = None # time the framing was requested
+    _negotiation_timeout = 1.0 # seconds to wait for the answer before giving up the request
+
+    def __init__(self,framing=FRAMING_JSON,accepted_framings=VALID_FRAMINGS,negotiation_timeout=None):
+        if (framing not in self.VALID_FRAMINGS):
+            raise ValueError("{} is not a valid framing".format(framing))
+        self._framing = framing
+        self._accepted_framings = frozenset(accepted_framings)
+        if (negotiation_timeout is not None):
+            self._negotiation_timeout = negotiation_timeout
+        self._codec = PMessageBinaryCodec()
+        self.reset()
+
+    def reset(self):
+        "discard all buffered data"
+        self._buffer = ""
+        self._reset_scan_state()
+        self._requested_framing = None
+        self._held_msgs = []
+        self._outgoing = []
+
+    def get_framing(self):
+        return self._framing
+
+    def request_framing(self,framing,now=None):
+        "return the data to be sent to ask the other side to switch to framing"
+        if (framing not in self.VALID_FRAMINGS):
+            raise ValueError("{} is not a valid framing".format(framing))
+        data = self._encode(PMessage(validate=False,type=PMessage.T_SET_FRAMING,msg=framing))
+        self._requested_framing = framing
+        self._requested_at = now if now is not None else time.time()
+        return data
+
+    def check_negotiation(self,now):
+        """
+        give up the framing request if it has not been answered within the timeout,
+        the held messages are then encoded in the old framing and collected by pop_outgoing(),
+        return seconds until the request times out, None if no request is waiting
+        """
+        if (not self._requested_framing):
+            return None
+        wait = self._requested_at+self._negotiation_timeout-now
+        if (wait>0):
+            return wait
+        debug("Framing {} not answered, staying with {}".format(self._requested_framing,self._framing),DEBUG_VALIDATION)
+        self._requested_framing = None
+        self._release_held_msgs()
+        return None
+
+    def pop_outgoing(self):
+        "return the data produced by negotiation that has to be sent, in order"
+        data,self._outgoing = self._outgoing,[]
+        return data
+
+    def encode(self,pmsg):
+        "return the data to be sent for pmsg, empty while a framing request is not answered"
+        if (self._requested_framing):
+            self._held_msgs.append(pmsg)
+            return ""
+        return self._encode(pmsg)
+
+    def _encode(self,pmsg):
+        if (self._framing==self.FRAMING_BINARY):
+            return self._codec.encode(pmsg)
+        data = pmsg.render_msg()
+        if (self._framing==self.FRAMING_NEWLINE):
+            return data + "\n"
+        elif (self._framing==self.FRAMING_LENGTH_PREFIX):
+            return struct.pack(self._LENGTH_FORMAT,len(data)) + data
+        return data
+
+    def feed(self,data):
+        "append received data, return list of PMessage for every complete and valid frame"
+        self._buffer += data
+        pmsgs = []
+        while (True):
+            frame = self._next_frame()
+            if (frame is None):
+                break
+            try:
+                pmsg = self._decode_frame(frame)
+            except (ValidationException,ValueError,KeyError,TypeError,AttributeError) as e:
+                debug("Invalid frame {!r}: {}".format(frame,e),DEBUG_VALIDATION)
+                continue
+            if (pmsg.get_type()==PMessage.T_SET_FRAMING):
+                # the rest of the buffer is decoded with the new framing
+                self._negotiate(pmsg.get_msg())
+            else:
+                pmsgs.append(pmsg)
+        return pmsgs
+
+    def _negotiate(self,framing):
+        if (self._requested_framing):
+            # answer to our request
+            if (framing==self._requested_framing):
+                self._set_framing(framing)
+            else:
+                debug("Framing {} refused, staying with {}".format(self._requested_framing,self._framing),DEBUG_VALIDATION)
+            self._requested_framing = None
+            self._release_held_msgs()
+        else:
+            # request from the other side, answer before switching,
+            # also a late answer to a request given up by check_negotiation(), then both sides switch
+            if (framing not in self._accepted_framings):
+                framing = self._framing
+            self._outgoing.append(self._encode(PMessage(validate=False,type=PMessage.T_SET_FRAMING,msg=framing)))
+            self._set_framing(framing)
+
+    def _release_held_msgs(self):
+        self._outgoing.extend([self._encode(pmsg) for pmsg in self._held_msgs])
+        self._held_msgs = []
+
+    def _set_framing(self,framing):
+        if (framing!=self._framing):
+            debug("Switching framing from {} to {}".format(self._framing,framing),DEBUG_VALIDATION)
+            self._framing = framing
+            self._reset_scan_state()
+
+    def _reset_scan_state(self):
+        self._scan_pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    def _next_frame(self):
+        "remove the next complete frame from the buffer and return it, None if there is none"
+        if (self._framing==self.FRAMING_NEWLINE):
+            return self._next_line()
+        elif (self._framing==self.FRAMING_LENGTH_PREFIX):
+            return self._next_length_prefixed()
+        elif (self._framing==self.FRAMING_BINARY):
+            return self._next_binary()
+        return self._next_json_object()
+
+    def _decode_frame(self,frame):
+        if (self._framing==self.FRAMING_BINARY):
+            return self._codec.decode(*frame)
+        return PMessage(json_str=frame)
+
+    def _next_line(self):
+        while (True):
+            end = self._buffer.find("\n")
+            if (end<0):
+                if (len(self._buffer)>self.MAX_FRAME_SIZE):
+                    self._buffer = ""
+                return None
+            line = self._buffer[:end].strip()
+            self._buffer = self._buffer[end+1:]
+            if (line):
+                return line
+
+    def _next_length_prefixed(self):
+        if (len(self._buffer)<self._LENGTH_SIZE):
+            return None
+        length = struct.unpack(self._LENGTH_FORMAT,self._buffer[:self._LENGTH_SIZE])[0]
+        if (length>self.MAX_FRAME_SIZE):
+            # lost synchronisation, nothing in the buffer can be trusted
+            self._buffer = ""
+            return None
+        end = self._LENGTH_SIZE + length
+        if (len(self._buffer)<end):
+            return None
+        frame = self._buffer[self._LENGTH_SIZE:end]
+        self._buffer = self._buffer[end:]
+        return frame
+
+    def _next_binary(self):
+        "return (type code,payload)"
+        if (not self._buffer):
+            return None
+        length,start = decode_varint(self._buffer,1)
+        if (length is None):
+            if (start>6):
+                self._buffer = ""
+            return None
+        if (length>self.MAX_FRAME_SIZE):
+            self._buffer = ""
+            return None
+        end = start + length
+        if (len(self._buffer)<end):
+            return None
+        frame = ord(self._buffer[0]),self._buffer[start:end]
+        self._buffer = self._buffer[end:]
+        return frame
+
+    def _next_json_object(self):
+        "return the next complete top level json object, braces inside strings are ignored"
+        buf = self._buffer
+        frame_start = 0 if self._depth else None
+        pos = self._scan_pos
+        depth,in_string,escaped = self._depth,self._in_string,self._escaped
+        frame = None
+        while (pos<len(buf)):
+            c = buf[pos]
+            pos += 1
+            if (in_string):
+                if (escaped):
+                    escaped = False
+                elif (c=="\\"):
+                    escaped = True
+                elif (c=='"'):
+                    in_string = False
+            elif (c=='"'):
+                in_string = depth>0
+            elif (c=='{'):
+                if (depth==0):
+                    frame_start = pos - 1
+                depth += 1
+            elif (c=='}' and depth>0):
+                depth -= 1
+                if (depth==0):
+                    frame = buf[frame_start:pos]
+                    break
+        if (frame is not None):
+            self._buffer = buf[pos:]
+            self._reset_scan_state()
+            return frame
+        # keep only the incomplete object
+        if (frame_start is None or pos-frame_start>self.MAX_FRAME_SIZE):
+            self._buffer = ""
+            self._reset_scan_state()
+        else:
+            self._buffer = buf[frame_start:]
+            self._scan_pos = pos - frame_start
+            self._depth,self._in_string,self._escaped = depth,in_string,escaped
+        return None
@@ -2,23 +2,58 @@
 Mixin class for implementing Publisher-Observer pattern
 """
 
+import weakref
 from abc import abstractmethod,ABCMeta
 
 class BasePublisher():
-    _listeners = []
+    """
+    every publisher instance keeps its own listeners
+    listeners are held by weak reference unless added with weak=False
+    """
+    # topics of notifications
+    TOPIC_MAP = "map"
+    TOPIC_ROBOT = "robot"
+    TOPIC_STATUS = "status"
 
-    def notify(self,data=None):
-        "notify all listeners"
-        for listener in self._listeners:
+    _topic = None # topic of notifications sent without an explicit topic
+    _listener_refs = None # list of (reference,topic), calling reference returns the listener or None
+
+    def notify(self,data=None,topic=None):
+        "notify all listeners interested in topic"
+        topic = topic if topic else self._topic
+        for ref,listener_topic in list(self._get_listener_refs()):
+            listener = ref()
+            if (listener is None):
+                # listener has been garbage collected
+                self._listener_refs.remove((ref,listener_topic))
+                continue
+            if (listener_topic and topic and listener_topic!=topic):
+                continue
             try:
                 listener.update(data)
             except Exception as e:
                 print ("Exception in update:{}".format(e))
                 pass
 
-    def add_change_listener(self,listener):
-        "add a listener object, which has update() method"
-        self._listeners.append(listener)
+    def add_change_listener(self,listener,topic=None,weak=True):
+        "add a listener object, which has update() method, topic None means all topics"
+        if (listener in self.get_change_listeners()):
+            return
+        ref = weakref.ref(listener) if weak else (lambda: listener)
+        self._get_listener_refs().append((ref,topic))
+
+    def remove_change_listener(self,listener):
+        self._listener_refs = [(ref,topic) for ref,topic in self._get_listener_refs()
+                               if ref() is not None and ref() is not listener]
+
+    def get_change_listeners(self):
+        "return the list of listeners that are still alive"
+        return [listener for listener in [ref() for ref,_ in self._get_listener_refs()] if listener is not None]
+
+    def _get_listener_refs(self):
+        if (self._listener_refs is None):
+            self._listener_refs = []
+        return self._listener_refs
 
 class BaseObserver(object):
 
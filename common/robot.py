@@ -1,10 +1,15 @@
 from common import *
 from common.popattern import BasePublisher
-from copy import copy
 from common.amap import *
 from common.debug import debug,DEBUG_COMMON
 from common.orientation import *
 
+try:
+    import numpy
+except ImportError:
+    # get_footprint_unknown_counts() falls back to plain python
+    numpy = None
+
 class RobotSettings(object):
     BODY_COLOR = "red"
     HEAD_COLOR = "white"
@@ -24,10 +29,18 @@ class RobotRef(RobotSettings,BasePublisher):
     """
     _ori = None # orientation
     _pos = None # position (tuple)
+    _topic = BasePublisher.TOPIC_ROBOT
     DEFAULT_POS = (1,18)
     # DEFAULT_POS = (1,13)
     DEFAULT_ORI = EAST
 
+    _USE_NUMPY = numpy is not None
+    _NUMPY_MIN_POSES = 8 # fewer poses are evaluated faster in plain python
+    # lookup tables built from SENSORS on first use, every position delta is relative to the robot centre
+    _sensor_templates = None # orientation value => list of (sensor position delta,direction delta,range) in the order of SENSORS
+    _sensor_cells = None # (orientation value,sensor index,reading) => (clear position deltas,obstacle position deltas)
+    _footprint_deltas = None # orientation value => clear position deltas of all sensors detecting nothing
+
     def __init__(self,ori=DEFAULT_ORI,pos=DEFAULT_POS):
         self.reset(ori,pos)
 
@@ -96,11 +109,9 @@ class RobotRef(RobotSettings,BasePublisher):
 
     def get_sensor_readings(self,map_ref):
         "return a list of numbers"
-        readings = []
-        for sensor in self.SENSORS:
-            sensor_pos,sensor_ori = self.get_cur_sensor_state(rel_pos=sensor['pos'],rel_ori=sensor['ori'])
-            readings.append(self._sense(map=map_ref,x=sensor_pos[0],y=sensor_pos[1],ori=sensor_ori,range=sensor['range']))
-        return readings
+        x,y = self._pos
+        return [self._sense(map=map_ref,x=x+delta_x,y=y+delta_y,pos_delta=direction,range=sensor_range)
+                for (delta_x,delta_y),direction,sensor_range in self.get_sensor_templates(self._ori)]
 
     def get_cur_sensor_state(self,rel_pos,rel_ori):
         "return the actual sensor location and orientation"
@@ -109,11 +120,10 @@ class RobotRef(RobotSettings,BasePublisher):
         actual_position = (self._pos[0] + position_delta[0], self._pos[1] + position_delta[1])
         return actual_position,abs_ori
 
-    def _sense(self,map,x,y,ori,range):
-        "return int, the reading of one sensor"
+    def _sense(self,map,x,y,pos_delta,range):
+        "return int, the reading of one sensor at (x,y) pointing to pos_delta"
         dist = 0
         limit = range
-        pos_delta = ori.to_pos_change()
         while (limit>0):
             x += pos_delta[0]
             y += pos_delta[1]
@@ -129,46 +139,114 @@ class RobotRef(RobotSettings,BasePublisher):
         # NOTE: sensor values should correspond to Robot.SENSORS in sequence
         all_clear_list = []
         all_obstacle_list = []
+        x,y = self._pos
         for i in range(len(sensor_values)):
-            # get necessary info for update
-            sensor_setting = self.SENSORS[i]
-            sensor_range = sensor_setting['range']
-            sensor_pos,sensor_ori = self.get_cur_sensor_state(rel_pos=sensor_setting['pos'],rel_ori=sensor_setting['ori'])
-            reading = sensor_values[i]
-            pos_change = sensor_ori.to_pos_change()
-            # if reading goes over range, treat it as no obstacle detected
-            if (reading>sensor_range): reading=self.NOTHING_DETECTED
-            # get list of clear positions and obstacle positions
-            if (reading==self.NOTHING_DETECTED):
-                x_min,x_max = min(sensor_pos[0],sensor_pos[0]+pos_change[0]*sensor_range),max(sensor_pos[0],sensor_pos[0]+pos_change[0]*sensor_range)
-                y_min,y_max = min(sensor_pos[1],sensor_pos[1]+pos_change[1]*sensor_range),max(sensor_pos[1],sensor_pos[1]+pos_change[1]*sensor_range)
-                obstacle_list = []
-            else:
-                x_min,x_max = min(sensor_pos[0],sensor_pos[0]+pos_change[0]*(reading)),max(sensor_pos[0],sensor_pos[0]+pos_change[0]*(reading))
-                y_min,y_max = min(sensor_pos[1],sensor_pos[1]+pos_change[1]*(reading)),max(sensor_pos[1],sensor_pos[1]+pos_change[1]*(reading))
-                obstacle_list = [(sensor_pos[0]+pos_change[0]*(reading+1),sensor_pos[1]+pos_change[1]*(reading+1))]
-
-            clear_list = [
-                (x,y) for x in range(x_min,x_max+1)
-                for y in range(y_min,y_max+1) if x>=0 and y>=0
-            ]
-            all_clear_list.extend(clear_list)
-            all_obstacle_list.extend(obstacle_list)
-
+            clear_deltas,obstacle_deltas = self.get_sensor_cells(self._ori,i,sensor_values[i])
+            all_clear_list.extend([(x+delta_x,y+delta_y) for delta_x,delta_y in clear_deltas
+                                   if x+delta_x>=0 and y+delta_y>=0])
+            all_obstacle_list.extend([(x+delta_x,y+delta_y) for delta_x,delta_y in obstacle_deltas])
         return all_clear_list,all_obstacle_list
 
     def get_action_utility_points(self,action,map_ref):
         "return the number of grids the robot can explore should it take the given action"
-        num_sensors = len(self.SENSORS)
-        robot_copy = copy(self)
-        robot_copy.execute_command(action)
-        robot_copy.execute_command(PMessage.M_MOVE_FORWARD)
-        clear_ls,obstacle_ls = robot_copy.sense_area([self.NOTHING_DETECTED]*num_sensors)
-        utility_point = 0
-        for x,y in clear_ls:
-            if (not map_ref.is_out_of_arena(x,y) and map_ref.get_cell(x,y)==map_ref.UNKNOWN):
-                utility_point += 1
-        return utility_point
+        return self.get_footprint_unknown_counts([self.get_pose_after([action,PMessage.M_MOVE_FORWARD])],map_ref)[0]
+
+    def get_pose_after(self,commands):
+        "return (position,orientation) after executing the list of commands, the robot itself is not changed"
+        (x,y),ori = self._pos,self._ori
+        for command in commands:
+            if (command==PMessage.M_TURN_RIGHT): ori = ori.to_right()
+            elif (command==PMessage.M_TURN_LEFT): ori = ori.to_left()
+            elif (command==PMessage.M_TURN_BACK): ori = ori.to_back()
+            elif (command.find(PMessage.M_MOVE_FORWARD)!=-1):
+                num_grids = int(command.split("*")[1]) if "*" in command else 1
+                delta_x,delta_y = ori.to_pos_change()
+                x,y = x+delta_x*num_grids,y+delta_y*num_grids
+        return (x,y),ori
+
+    @classmethod
+    def get_sensor_templates(cls,ori):
+        "return a list of (sensor position delta,direction delta,range) of the robot facing ori, in the order of SENSORS"
+        if (cls.__dict__.get('_sensor_templates') is None):
+            # tables belong to the class defining them, a subclass may change SENSORS
+            cls._sensor_templates,cls._sensor_cells,cls._footprint_deltas = {},{},{}
+        templates = cls._sensor_templates.get(ori.get_value())
+        if (templates is None):
+            templates = [(sensor['pos'].to_pos_change(ori),
+                          sensor['ori'].get_actual_abs_ori(ref_front_ori=ori).to_pos_change(),
+                          sensor['range'])
+                         for sensor in cls.SENSORS]
+            cls._sensor_templates[ori.get_value()] = templates
+        return templates
+
+    @classmethod
+    def get_sensor_cells(cls,ori,index,reading):
+        "return (clear position deltas,obstacle position deltas) of sensor number index of the robot facing ori"
+        templates = cls.get_sensor_templates(ori)
+        key = (ori.get_value(),index,reading)
+        cells = cls._sensor_cells.get(key)
+        if (cells is None):
+            (delta_x,delta_y),(step_x,step_y),sensor_range = templates[index]
+            # if reading goes over range, treat it as no obstacle detected
+            if (reading==cls.NOTHING_DETECTED or reading>sensor_range):
+                length,obstacle_deltas = sensor_range,[]
+            else:
+                length,obstacle_deltas = reading,[(delta_x+step_x*(reading+1),delta_y+step_y*(reading+1))]
+            # from the sensor position to the last clear cell, sorted like the positions of a range scan
+            clear_deltas = sorted([(delta_x+step_x*i,delta_y+step_y*i) for i in range(min(0,length),max(0,length)+1)])
+            cells = (clear_deltas,obstacle_deltas)
+            cls._sensor_cells[key] = cells
+        return cells
+
+    @classmethod
+    def get_footprint_deltas(cls,ori):
+        "return the clear position deltas of all sensors of the robot facing ori detecting nothing, with repetition"
+        cls.get_sensor_templates(ori)
+        deltas = cls._footprint_deltas.get(ori.get_value())
+        if (deltas is None):
+            deltas = []
+            for i in range(len(cls.SENSORS)):
+                deltas.extend(cls.get_sensor_cells(ori,i,cls.NOTHING_DETECTED)[0])
+            cls._footprint_deltas[ori.get_value()] = deltas
+        return deltas
+
+    @classmethod
+    def get_footprint_unknown_counts(cls,poses,map_ref):
+        """
+        poses is a list of ((x,y),orientation),
+        return for each pose the number of unknown cells the sensors would cover if none of them detects anything,
+        a cell covered by several sensors is counted once for each of them
+        """
+        if (cls._USE_NUMPY and len(poses)>=cls._NUMPY_MIN_POSES):
+            return cls._get_footprint_unknown_counts_with_numpy(poses,map_ref)
+        cells,size_x,size_y = map_ref.get_cells(),map_ref.get_size_x(),map_ref.get_size_y()
+        counts = []
+        for (x,y),ori in poses:
+            count = 0
+            for delta_x,delta_y in cls.get_footprint_deltas(ori):
+                cell_x,cell_y = x+delta_x,y+delta_y
+                if (0<=cell_x<size_x and 0<=cell_y<size_y and cells[cell_y*size_x+cell_x]==MapSetting.UNKNOWN):
+                    count += 1
+            counts.append(count)
+        return counts
+
+    @classmethod
+    def _get_footprint_unknown_counts_with_numpy(cls,poses,map_ref):
+        cells = numpy.frombuffer(map_ref.get_cells(),dtype=numpy.uint8)
+        size_x,size_y = map_ref.get_size_x(),map_ref.get_size_y()
+        positions = numpy.array([pos for pos,_ in poses],dtype=int)
+        counts = numpy.zeros(len(poses),dtype=int)
+        rows_by_ori = {} # orientation value => (orientation,list of pose indexes)
+        for i,(_,ori) in enumerate(poses):
+            rows_by_ori.setdefault(ori.get_value(),(ori,[]))[1].append(i)
+        for ori,rows in rows_by_ori.values():
+            deltas = numpy.array(cls.get_footprint_deltas(ori),dtype=int)
+            xs = positions[rows,0][:,None] + deltas[:,0][None,:]
+            ys = positions[rows,1][:,None] + deltas[:,1][None,:]
+            inside = (xs>=0) & (ys>=0) & (xs<size_x) & (ys<size_y)
+            indexes = numpy.where(inside,ys*size_x+xs,0)
+            counts[rows] = ((cells[indexes]==MapSetting.UNKNOWN) & inside).sum(axis=1)
+        return counts.tolist()
 
     def get_orientation(self):
         return self._ori
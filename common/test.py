@@ -1,14 +1,20 @@
 """
 testing MapIO loading and exporting
 """
+import copy
 import os
+import pickle
 import random
 import sys
 import time
 from thread import start_new_thread
 from threading import Lock,Thread
 from common.amap import BitMapIOMixin,TextMapIOMixin,MapRef,MapSetting
-from common.utils import synchronized,MinQueue
+from common.orientation import NORTH,EAST,SOUTH,WEST,AbsoluteOrientation,RelativeOrientation
+from common.pmessage import PMessage,PMessageStream,ValidationException
+from common.popattern import BaseObserver
+from common.robot import RobotRef
+from common.utils import synchronized,MinQueue,HeapMinQueue
 
 x_len = 15
 y_len = 20
@@ -22,6 +28,155 @@ def test_q():
     print(q.dequeue())
     print(q.dequeue())
 
+def test_heap_q():
+    q = HeapMinQueue(key=lambda x:x)
+    for i in [4,10,1,7,1]:
+        q.enqueue(i)
+    # no duplicates in the queue
+    assert len(q)==4 and 1 in q
+    assert [q.dequeue() for _ in range(4)]==[1,4,7,10]
+    assert q.is_empty()
+    # an item whose key has changed is moved by update()
+    keys = {'a':3,'b':2,'c':1}
+    q = HeapMinQueue(key=lambda x:keys[x])
+    for item in ['a','b','c']:
+        q.enqueue(item)
+    keys['a'] = 0
+    q.update('a')
+    keys['c'] = 5
+    q.enqueue('c')
+    assert [q.dequeue_min() for _ in range(3)]==['a','b','c']
+
+class ObstacleCache(BaseObserver):
+    "positions of the obstacles of a map, kept from its change notifications"
+    def __init__(self,map_ref):
+        self._map_ref = map_ref
+        self._version = None
+        self._obstacles = set()
+        map_ref.add_change_listener(self)
+
+    def update(self,data=None):
+        map_ref = self._map_ref
+        if (data is None):
+            data = [(x,y) for x in range(map_ref.get_size_x()) for y in range(map_ref.get_size_y())]
+        for x,y in data:
+            if (map_ref.get_cell(x,y)==MapRef.OBSTACLE):
+                self._obstacles.add((x,y))
+            else:
+                self._obstacles.discard((x,y))
+
+    def get_obstacles(self):
+        # notifications are held back during a batch
+        if (self._map_ref.get_version()!=self._version):
+            self.update(self._map_ref.get_pending_changes())
+            self._version = self._map_ref.get_version()
+        return self._obstacles
+
+def test_batch_read():
+    map_ref = MapRef()
+    cache = ObstacleCache(map_ref)
+    assert sorted(cache.get_obstacles())==[]
+    with map_ref.batch():
+        map_ref.set_cell(5,5,MapRef.OBSTACLE)
+        assert map_ref.get_pending_changes()==[(5,5)]
+        # a listener reading inside the batch sees the changes held back
+        assert sorted(cache.get_obstacles())==[(5,5)]
+        map_ref.set_cell(5,5,MapRef.CLEAR)
+        map_ref.set_cell(6,6,MapRef.OBSTACLE)
+        assert sorted(cache.get_obstacles())==[(6,6)]
+    assert map_ref.get_pending_changes()==[]
+    assert sorted(cache.get_obstacles())==[(6,6)]
+
+def test_split_frame():
+    "a frame split across reads is decoded once, when its last byte arrives"
+    msg = PMessage(type=PMessage.T_UPDATE_MAP_STATUS,msg="1,2,0|3,4,1")
+    for framing in PMessageStream.VALID_FRAMINGS:
+        stream = PMessageStream(framing=framing)
+        data = stream.encode(msg)*2
+        decoded = []
+        for i in range(len(data)):
+            decoded.append(stream.feed(data[i]))
+        assert sum(map(len,decoded))==2,framing
+        assert decoded[len(data)/2-1][0].equals(msg) and decoded[-1][0].equals(msg),framing
+
+def test_pmessage_validation():
+    invalid = [("fly",PMessage.M_MOVE_FORWARD),
+               (PMessage.T_COMMAND,"fly"),
+               (PMessage.T_COMMAND,"mf*{}".format(PMessage.MAX_MOVE_FORWARD_STEPS+1)),
+               (PMessage.T_ROBOT_MOVE,"fly"),
+               (PMessage.T_MAP_UPDATE,"1,2,3"),
+               (PMessage.T_SET_ROBOT_POS,"1"),
+               (PMessage.T_UPDATE_ROBOT_STATUS,"1,2"),
+               (PMessage.T_UPDATE_MAP_STATUS,"1,2,0|3,4"),
+               (PMessage.T_SET_FRAMING,"xml")]
+    for type,msg in invalid:
+        try:
+            PMessage(type=type,msg=msg)
+        except ValidationException:
+            continue
+        assert False,"{} {} is accepted".format(type,msg)
+    PMessage(type=PMessage.T_COMMAND,msg="mf*3")
+    PMessage(type=PMessage.T_UPDATE_MAP_STATUS,msg="1,2,0|3,4,1")
+    # trusted messages skip the check
+    PMessage(validate=False,type=PMessage.T_COMMAND,msg="fly")
+
+def raycast_readings(robot,map_ref):
+    "get_sensor_readings() before the sensor templates"
+    readings = []
+    for sensor in robot.SENSORS:
+        sensor_pos,sensor_ori = robot.get_cur_sensor_state(rel_pos=sensor['pos'],rel_ori=sensor['ori'])
+        readings.append(robot._sense(map=map_ref,x=sensor_pos[0],y=sensor_pos[1],
+                                     pos_delta=sensor_ori.to_pos_change(),range=sensor['range']))
+    return readings
+
+def raycast_sense_area(robot,sensor_values):
+    "sense_area() before the sensor templates"
+    all_clear_list = []
+    all_obstacle_list = []
+    for i in range(len(sensor_values)):
+        sensor_setting = robot.SENSORS[i]
+        sensor_range = sensor_setting['range']
+        sensor_pos,sensor_ori = robot.get_cur_sensor_state(rel_pos=sensor_setting['pos'],rel_ori=sensor_setting['ori'])
+        reading = sensor_values[i]
+        pos_change = sensor_ori.to_pos_change()
+        if (reading>sensor_range): reading=robot.NOTHING_DETECTED
+        length = sensor_range if reading==robot.NOTHING_DETECTED else reading
+        x_min,x_max = min(sensor_pos[0],sensor_pos[0]+pos_change[0]*length),max(sensor_pos[0],sensor_pos[0]+pos_change[0]*length)
+        y_min,y_max = min(sensor_pos[1],sensor_pos[1]+pos_change[1]*length),max(sensor_pos[1],sensor_pos[1]+pos_change[1]*length)
+        if (reading!=robot.NOTHING_DETECTED):
+            all_obstacle_list.append((sensor_pos[0]+pos_change[0]*(reading+1),sensor_pos[1]+pos_change[1]*(reading+1)))
+        all_clear_list.extend([(x,y) for x in range(x_min,x_max+1) for y in range(y_min,y_max+1) if x>=0 and y>=0])
+    return all_clear_list,all_obstacle_list
+
+def test_sensor_templates():
+    rand = random.Random(18)
+    map_ref = MapRef()
+    size_x,size_y = map_ref.get_size_x(),map_ref.get_size_y()
+    map_ref.set_cell_list([(x,y) for x in range(size_x) for y in range(size_y) if rand.random()<0.8],
+                          MapRef.CLEAR,maintain_obstacle=False)
+    map_ref.set_cell_list([(x,y) for x in range(size_x) for y in range(size_y) if rand.random()<0.2],
+                          MapRef.OBSTACLE)
+    for x in range(size_x):
+        for y in range(size_y):
+            for ori in (NORTH,EAST,SOUTH,WEST):
+                robot = RobotRef(ori=ori,pos=(x,y))
+                assert robot.get_sensor_readings(map_ref)==raycast_readings(robot,map_ref),((x,y),ori)
+                values = [rand.randint(-1,sensor['range']+1) for sensor in robot.SENSORS]
+                assert robot.sense_area(values)==raycast_sense_area(robot,values),((x,y),ori,values)
+
+def test_orientation_interning():
+    orientations = [AbsoluteOrientation.get_instance(val) for val in range(8)]+\
+                   [RelativeOrientation.get_instance(val) for val in range(-3,5)]
+    for ori in orientations:
+        assert copy.copy(ori) is ori,ori
+        assert copy.deepcopy(ori) is ori,ori
+        for protocol in range(pickle.HIGHEST_PROTOCOL+1):
+            assert pickle.loads(pickle.dumps(ori,protocol)) is ori,(ori,protocol)
+    # containers are copied, the orientations in them are not
+    pose = {'pos':(1,18),'ori':EAST}
+    assert copy.deepcopy(pose)['ori'] is EAST
+    assert pickle.loads(pickle.dumps(pose))['ori'] is EAST
+
 def main():
     print(os.path.dirname(__file__))
     convert_text_to_binary("map-7.txt")
@@ -92,4 +247,10 @@ def test_multithread():
         pass
 
 if __name__ == '__main__':
+    test_heap_q()
+    test_batch_read()
+    test_split_frame()
+    test_pmessage_validation()
+    test_sensor_templates()
+    test_orientation_interning()
     convert_text_to_binary("map-12.txt")
\ No newline at end of file
@@ -1,5 +1,5 @@
 """
-Min queue to be used in A* algo
+Min queues to be used in A* algo
 """
 from abc import ABCMeta,abstractmethod
 import os
@@ -70,6 +70,124 @@ class MinQueue(BaseQueue):
         self._list.sort(key=self._key_func)
         return self._list[0]
 
+class HeapMinQueue(BaseQueue):
+    """
+    Indexed binary heap, no duplicated allowed in the queue
+    enqueue, dequeue_min and update are O(log n), membership check is O(1)
+    items must be hashable, call update() after an item's key has changed
+    """
+    _key_func = None # function used to order the items
+    _index = None # dict of item -> position in _list
+    _counter = 0 # insertion counter, used to break ties in FIFO order
+
+    def __init__(self,*args,**kwargs):
+        super(HeapMinQueue,self).__init__(*args,**kwargs)
+        if (not kwargs.get("key")):
+            raise Exception("`key` must be passed in to create HeapMinQueue")
+        self._key_func = kwargs.get("key")
+        self._index = {}
+        self._counter = 0
+
+    def __contains__(self,item):
+        return item in self._index
+
+    def __len__(self):
+        return len(self._list)
+
+    def enqueue(self,item):
+        "add item to the queue, re-position it if it is already in the queue"
+        if (item in self._index):
+            self.update(item)
+            return
+        self._counter += 1
+        self._list.append([self._key_func(item),self._counter,item])
+        self._index[item] = len(self._list)-1
+        self._sift_up(len(self._list)-1)
+
+    def update(self,item):
+        "re-compute the key of item and restore the heap order"
+        if (item not in self._index):
+            raise Exception("item is not in the queue, cannot call update")
+        pos = self._index[item]
+        entry = self._list[pos]
+        old_key = entry[0]
+        entry[0] = self._key_func(item)
+        if (entry[0]<old_key):
+            self._sift_up(pos)
+        else:
+            self._sift_down(pos)
+
+    def remove(self,item):
+        "remove item from the queue"
+        if (item not in self._index):
+            raise Exception("item is not in the queue, cannot call remove")
+        pos = self._index.pop(item)
+        last = self._list.pop()
+        if (pos<len(self._list)):
+            # fill the hole with the last entry
+            self._list[pos] = last
+            self._index[last[2]] = pos
+            self._sift_up(pos)
+            self._sift_down(self._index[last[2]])
+
+    def dequeue(self):
+        return self.dequeue_min()
+
+    def dequeue_min(self):
+        if (self.is_empty()):
+            raise Exception("queue is empty, cannot call dequeue")
+        last = self._list.pop()
+        if (not self._list):
+            del self._index[last[2]]
+            return last[2]
+        min_entry = self._list[0]
+        self._list[0] = last
+        self._index[last[2]] = 0
+        del self._index[min_entry[2]]
+        self._sift_down(0)
+        return min_entry[2]
+
+    def peek(self):
+        if (self.is_empty()):
+            raise Exception("queue is empty, cannot call peek")
+        return self._list[0][2]
+
+    def _sift_up(self,pos):
+        heap = self._list
+        entry = heap[pos]
+        while (pos>0):
+            parent_pos = (pos-1)>>1
+            parent = heap[parent_pos]
+            if (entry[:2]<parent[:2]):
+                heap[pos] = parent
+                self._index[parent[2]] = pos
+                pos = parent_pos
+            else:
+                break
+        heap[pos] = entry
+        self._index[entry[2]] = pos
+
+    def _sift_down(self,pos):
+        heap = self._list
+        size = len(heap)
+        entry = heap[pos]
+        while (True):
+            child_pos = 2*pos+1
+            if (child_pos>=size):
+                break
+            right_pos = child_pos+1
+            if (right_pos<size and heap[right_pos][:2]<heap[child_pos][:2]):
+                child_pos = right_pos
+            child = heap[child_pos]
+            if (child[:2]<entry[:2]):
+                heap[pos] = child
+                self._index[child[2]] = pos
+                pos = child_pos
+            else:
+                break
+        heap[pos] = entry
+        self._index[entry[2]] = pos
+
 def get_or_exception(kwargs,key,err_msg=""):
     "return kwargs[key], raise exception if it gives none"
     value = kwargs.get(key)
@@ -1,4 +1,5 @@
 import time
+from Queue import Empty
 from thread import start_new_thread
 
 from common.robot import RobotRef,RobotRefWithMemory
@@ -21,6 +22,11 @@ class CentralController(StateMachine):
     _cmd_out_q = None
     _data_out_qs = None # list of queue
     _instance = None
+    _map_listener = None # MapUpdateListener
+    _robot_listener = None # RobotUpdateListener
+    _running = False
+    _realtime = True # False when driven by simulators.headless, timers and map saving are skipped
+    _INPUT_TIMEOUT = 0.5 # seconds to block on the input queue before checking whether to stop
 
     @staticmethod
     def get_instance(*args,**kwargs):
@@ -28,21 +34,43 @@ class CentralController(StateMachine):
             CentralController._instance = CentralController(*args,**kwargs)
         return CentralController._instance
 
+    @staticmethod
+    def reset_instance(*args,**kwargs):
+        "replace the instance returned by get_instance() with a new controller, for several runs in one process"
+        old = CentralController._instance
+        if (old and old._running):
+            old.stop()
+        CentralController._instance = CentralController(*args,**kwargs)
+        return CentralController._instance
+
     def control_task(self):
-        "central control"
-        #TODO: init listeners
-        self._map_listener = MapUpdateListener(map_ref=self._map_ref)
-        self._robot_listener = RobotUpdateListener(robot_ref=self._robot_ref)
-        while True:
-            if (not self._input_q.empty()):
-                input_tuple = self._input_q.get_nowait()
-                if (not input_tuple): continue
-                cmd_list,data_list = self._state.process_input(input_tuple[0],input_tuple[1])
-                if (cmd_list):
-                    self._enqueue_list(self._cmd_out_q,cmd_list,True)
-                if (data_list):
-                    for q in self._data_out_qs:
-                        self._enqueue_list(q,data_list)
+        "central control, block on the input queue until stop() is called"
+        self.init_listeners()
+        self._running = True
+        while self._running:
+            try:
+                input_tuple = self._input_q.get(timeout=self._INPUT_TIMEOUT)
+            except Empty:
+                continue
+            if (not input_tuple): continue
+            self.process_input(input_tuple[0],input_tuple[1])
+
+    def process_input(self,label,msg):
+        "let the current state process one input and enqueue the resulting messages"
+        # one input results in at most one map change notification
+        with self._map_ref.batch():
+            cmd_list,data_list = self._state.process_input(label,msg)
+        if (cmd_list):
+            self._enqueue_list(self._cmd_out_q,cmd_list,True)
+        if (data_list):
+            for q in self._data_out_qs:
+                self._enqueue_list(q,data_list)
+
+    def stop(self):
+        "make control_task return after the input being processed"
+        self._running = False
+        # wake up the blocking get
+        self._input_q.put_nowait(None)
 
     def set_next_state(self,state):
         debug("Next state set to {}".format(str(state)),DEBUG_STATES)
@@ -55,13 +83,25 @@ class CentralController(StateMachine):
         self._map_ref = MapRefWithBuffer()
         self._robot_ref = RobotRefWithMemory()
         self._state = ReadyState(machine=self)
+        # listeners belong to the old map_ref and robot_ref, attach new ones
+        if (self._map_listener or self._robot_listener):
+            self.init_listeners()
+
+    def init_listeners(self):
+        "send map and robot changes to the data queues"
+        self._map_listener = MapUpdateListener(map_ref=self._map_ref)
+        self._robot_listener = RobotUpdateListener(robot_ref=self._robot_ref)
 
     def __init__(self,*args,**kwargs):
         self._input_q = kwargs.get("input_q")
         self._cmd_out_q = kwargs.get("cmd_out_q")
         self._data_out_qs = kwargs.get("data_out_qs")
+        self._realtime = kwargs.get("realtime",True)
         self.reset()
 
+    def is_realtime(self):
+        return self._realtime
+
     def update(self):
         pass
 
@@ -108,7 +148,8 @@ class MapUpdateListener(BaseObserver):
             message = "|".join(["{},{},{}".format(x,y,self.format_cell_value(x,y))
                                           for x,y in cleaned_data])
             if (message!=self._LAST_MSG):
-                self._controller.send_data_pmsg(PMessage(type=PMessage.T_UPDATE_MAP_STATUS,
+                # sent on every sensor reading and built from valid cells, validating it takes ~35us
+                self._controller.send_data_pmsg(PMessage(validate=False,type=PMessage.T_UPDATE_MAP_STATUS,
                             msg=message))
                 self._LAST_MSG = message
 
@@ -134,5 +175,6 @@ class RobotUpdateListener(BaseObserver):
     def update(self,data=None):
         x,y = self._robot_ref.get_position()
         o = self._robot_ref.get_orientation().get_value()
-        self._controller.send_data_pmsg(PMessage(type=PMessage.T_UPDATE_ROBOT_STATUS,
+        # sent on every move and built from the robot pose, not validated like ums
+        self._controller.send_data_pmsg(PMessage(validate=False,type=PMessage.T_UPDATE_ROBOT_STATUS,
                             msg="{},{},{}".format(x,y,o)))
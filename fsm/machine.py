@@ -12,12 +12,19 @@ class StateMachine(object):
         self._state = st
         debug("state changed to {}".format(st),DEBUG_STATES)
 
+    def get_state(self):
+        return self._state
+
     def get_map_ref(self):
         return self._map_ref
 
     def get_robot_ref(self):
         return self._robot_ref
 
+    def is_realtime(self):
+        "False if the machine is driven faster than real time, e.g. by a headless simulation"
+        return True
+
     def reset(self):
         raise NotImplementedError()
 
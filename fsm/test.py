@@ -20,4 +20,62 @@ def combine_move_forawrd(ls):
 
 
 cmds = ['tl','mf','tr','mf','mf','mf','tr','mf']
-print (combine_move_forawrd(cmds))
\ No newline at end of file
+print (combine_move_forawrd(cmds))
+
+from Queue import Empty
+from common.pmessage import PMessage
+from interfaces.config import ANDROID_LABEL,ARDUINO_LABEL
+from algorithms.maze_explore import FrontierTracker
+from fsm.states import ExplorationFirstRoundState,ExplorationDoneState,FastRunState
+from simulators.headless import HeadlessSimulation
+
+def test_map_update_in_batch(map_file="map-1.bin"):
+    "feed the sensor readings through CentralController.process_input, the frontier must be up to date inside the batch"
+    simulation = HeadlessSimulation(map_file=map_file)
+    controller = simulation.get_controller()
+    map_ref = controller.get_map_ref()
+    use_frontier = ExplorationFirstRoundState._USE_FRONTIER_EXPLORATION
+    ExplorationFirstRoundState._USE_FRONTIER_EXPLORATION = True
+    controller.process_input(ANDROID_LABEL,PMessage(type=PMessage.T_COMMAND,msg=PMessage.M_START_EXPLORE))
+    ExplorationFirstRoundState._USE_FRONTIER_EXPLORATION = use_frontier
+    explore_algo = controller.get_state()._state._explore_algo
+    cmd_q,arduino = simulation._cmd_q,simulation._arduino
+    num_updates,num_stale = 0,0
+    while True:
+        try:
+            cmd = cmd_q.get_nowait()
+        except Empty:
+            break
+        arduino.handle_message(cmd)
+        for reply in arduino.pop_outbox():
+            if (not reply.is_map_update()):
+                controller.process_input(ARDUINO_LABEL,reply)
+                continue
+            # keep the notifications of the map update held back while checking
+            with map_ref.batch():
+                controller.process_input(ARDUINO_LABEL,reply)
+                num_updates += 1
+                if (explore_algo.get_frontier_tracker().get_frontier()!=FrontierTracker(map_ref).get_frontier()):
+                    num_stale += 1
+    assert num_updates>0
+    assert num_stale==0,"{} of {} map updates saw a stale frontier".format(num_stale,num_updates)
+    assert isinstance(controller.get_state(),ExplorationDoneState)
+    assert map_ref.get_unknown_percentage()==0
+
+def test_fastrun_plan_keeps_history(map_file="map-1.bin"):
+    "compiling the fast run plan must not clear the straight moves the robot has made"
+    simulation = HeadlessSimulation(map_file=map_file)
+    simulation.explore()
+    controller = simulation.get_controller()
+    robot = controller.get_robot_ref()
+    robot.clear_history()
+    for _ in range(3):
+        robot.set_position(robot.get_position())
+    assert robot.has_continuous_straight_moves(3)
+    cmd_buffer = FastRunState(machine=controller).get_commands_for_fastrun()
+    assert [msg for msg in cmd_buffer if isinstance(msg,PMessage) and msg.get_msg()==PMessage.M_CALLIBRATE_RIGHT]
+    assert robot.has_continuous_straight_moves(3)
+
+if __name__ == '__main__':
+    test_map_update_in_batch()
+    test_fastrun_plan_keeps_history()
@@ -1,10 +1,11 @@
 from abc import ABCMeta, abstractmethod
 import time
 import socket
-from threading import Lock
-from common.pmessage import PMessage,ValidationException
+from threading import Lock,Event,Thread
+from common.pmessage import PMessage,PMessageStream,ValidationException
 from common.utils import synchronized,SimpleQueue
 from common.debug import debug,DEBUG_INTERFACE,DEBUG_VALIDATION
+from interfaces.pacing import DelayPacer,TokenBucketPacer
 
 class Interface(object):
     """
@@ -14,8 +15,14 @@ class Interface(object):
     _read_lock = None
     _write_lock = None # prevent simultaneous write
     _ready = False
+    _ready_event = None # set while the interface is ready, for threads waiting on it
     _name = "interface"
     _msg_buffer = None # a queue
+    _pacer = None # interfaces.pacing.Pacer, created by create_pacer() when first used
+    _ready_callbacks = None # list of functions called whenever the interface becomes ready
+    _reconnecting = False # whether a reconnect_async() thread is running
+    _reconnect_lock = None
+    _reconnect_retry_delay = 1 # seconds between reconnection attempts of reconnect_async()
 
     def __unicode__(self):
         return self._name
@@ -23,7 +30,10 @@ class Interface(object):
     def __init__(self):
         self._read_lock = Lock()
         self._write_lock = Lock()
+        self._ready_event = Event()
         self._msg_buffer = SimpleQueue()
+        self._ready_callbacks = []
+        self._reconnect_lock = Lock()
 
     @abstractmethod
     def connect(self):
@@ -39,24 +49,116 @@ class Interface(object):
         self.disconnect()
         self.connect()
 
+    def reconnect_async(self):
+        "mark the interface not ready and reconnect on a helper thread, for callers that must not block"
+        with self._reconnect_lock:
+            if (self._reconnecting):
+                return
+            self._reconnecting = True
+        self.set_not_ready()
+        t = Thread(target=self._reconnect_task)
+        t.daemon = True
+        t.start()
+
+    def _reconnect_task(self):
+        try:
+            while (True):
+                try:
+                    self.reconnect()
+                    return
+                except Exception as e:
+                    debug("{} reconnection exception: {}".format(self._name,e),DEBUG_INTERFACE)
+                    time.sleep(self._reconnect_retry_delay)
+        finally:
+            with self._reconnect_lock:
+                self._reconnecting = False
+
     @abstractmethod
     def read(self):
         "return list of pmessage objects"
         pass
 
-    @abstractmethod
     def write(self,msg):
-        "msg is pmessage object"
-        pass
+        "msg is pmessage object, block until the pacer allows msg to be sent"
+        pacer = self.get_pacer()
+        wait = pacer.get_wait_time(msg,time.time())
+        while (wait>0):
+            time.sleep(wait)
+            wait = pacer.get_wait_time(msg,time.time())
+        self.send(msg)
+        pacer.on_sent(msg,time.time())
+
+    # methods used by interfaces.reactor.Reactor, which never blocks on a single interface
+    def fileno(self):
+        "return the file descriptor to be watched for incoming data"
+        raise NotImplementedError("fileno not implemented")
+
+    def read_available(self):
+        "read the data that is already available, return list of pmessage objects"
+        raise NotImplementedError("read_available not implemented")
+
+    def send(self,msg):
+        "write msg without any delay, msg is pmessage object"
+        raise NotImplementedError("send not implemented")
+
+    def get_write_delay(self,msg):
+        "return seconds to wait after writing msg before writing the next message"
+        return 0
+
+    def flush_held(self,now):
+        "write held back data whose deadline has passed, return seconds until the next deadline, None if nothing is held"
+        return None
+
+    # pacing of written messages, see interfaces.pacing
+    def get_pacer(self):
+        if (self._pacer is None):
+            self._pacer = self.create_pacer()
+        return self._pacer
+
+    def set_pacer(self,pacer):
+        self._pacer = pacer
+
+    def create_pacer(self):
+        "return the default pacer of this interface"
+        return DelayPacer(self)
+
+    def expects_ack(self,msg):
+        "return whether the other side acknowledges msg, used by AckPacer"
+        return False
+
+    def is_ack(self,sent_msg,received_msg):
+        "return whether received_msg acknowledges sent_msg, used by AckPacer"
+        return False
+
+    def _on_messages_received(self,pmsgs):
+        "let the pacer see every message read, return pmsgs"
+        if (pmsgs):
+            pacer = self.get_pacer()
+            now = time.time()
+            for pmsg in pmsgs:
+                pacer.on_received(pmsg,now)
+        return pmsgs
 
     def is_ready(self):
         return self._ready
 
     def set_ready(self):
         self._ready = True
+        self._ready_event.set()
+        for callback in self._ready_callbacks:
+            callback()
+
+    def add_ready_callback(self,callback):
+        "callback() is called from the connecting thread whenever the interface becomes ready"
+        self._ready_callbacks.append(callback)
 
     def set_not_ready(self):
         self._ready = False
+        self._ready_event.clear()
+
+    def wait_until_ready(self,timeout=None):
+        "block until the interface is ready, return whether it is ready"
+        return self._ready_event.wait(timeout)
 
 class BaseSocketInterface(Interface):
     """
@@ -67,22 +169,47 @@ class BaseSocketInterface(Interface):
     _name = "Base Socket Interface"
     _server_ip = "localhost"  # addr to bind to
     _server_port = 0
-    _write_delay = 0.2 # delay for writing in seconds
+    _write_delay = 0.2 # average interval between written messages in seconds
+    _write_burst = 3 # number of messages that can be written back to back
     _recv_size= 2048
+    _framing = PMessageStream.FRAMING_JSON # both sides of the connection must use the same framing
+    _stream = None # PMessageStream, keeps partial messages between reads
+    _preferred_framing = None # framing requested from the other side after connecting, e.g. PMessageStream.FRAMING_BINARY
 
 
     def __init__(self,ip=None,port=None):
         super(BaseSocketInterface,self).__init__()
         if (ip): self._server_ip = ip
         if (port): self._server_port = port
+        self._stream = PMessageStream(self._framing)
 
 
-    def set_write_delay(self,delay):
+    def set_write_delay(self,delay,burst=None):
+        "can be changed at runtime"
         self._write_delay = delay
+        if (burst is not None):
+            self._write_burst = burst
+        self.get_pacer().set_rate(self._get_write_rate(),self._write_burst)
+
+    def set_preferred_framing(self,framing):
+        "framing to request from the other side on the next connect"
+        self._preferred_framing = framing
+
+    def get_write_delay(self,msg):
+        return self._write_delay
+
+    def create_pacer(self):
+        return TokenBucketPacer(rate=self._get_write_rate(),burst=self._write_burst)
+
+    def _get_write_rate(self):
+        return 1.0/self._write_delay if self._write_delay else None
 
     def connect(self):
         debug("waiting to connect to {}".format(self._name),DEBUG_INTERFACE)
         self._connection = self._connect(server_ip=self._server_ip,server_port=self._server_port)
+        self._stream = PMessageStream(self._framing)
+        if (self._preferred_framing and self._preferred_framing!=self._framing):
+            self._connection.sendall(self._stream.request_framing(self._preferred_framing))
         self.set_ready()
         debug("{} connected to {}:{}".format(self._name, self._server_ip,self._server_port),DEBUG_INTERFACE)
 
@@ -113,32 +240,66 @@ class BaseSocketInterface(Interface):
             return None
 
         if (data):
-            debug("Received data from {} : {}".format(self._name, data),DEBUG_INTERFACE)
-            try:
-                pmsgs = PMessage.load_messages_from_json(json_str=data)
-                if (pmsgs):
-                    for msg in pmsgs:
-                        self._msg_buffer.enqueue(msg)
-                    return self._msg_buffer.dequeue()
-            except ValidationException as e:
-                debug("Validation exception: {}".format(e.message),DEBUG_VALIDATION)
-                return None
-
-
-    def write(self, msg):
-        """msg is a Message object"""
+            pmsgs = self._decode_data(data)
+            if (pmsgs):
+                for msg in pmsgs:
+                    self._msg_buffer.enqueue(msg)
+                return self._msg_buffer.dequeue()
+
+    def fileno(self):
+        return self._connection.fileno()
+
+    def read_available(self):
+        "called when the connection is readable, so recv will not block"
+        pmsgs = []
+        while (not self._msg_buffer.is_empty()):
+            pmsgs.append(self._msg_buffer.dequeue())
+        try:
+            data = self._connection.recv(self._recv_size)
+        except Exception as e:
+            debug("Read exception: {}".format(e),DEBUG_INTERFACE)
+            if (hasattr(e,'errno') and getattr(e,'errno')==10054):
+                self.reconnect_async()
+            return pmsgs
+        if (not data):
+            # the other side has closed the connection, wait for it to connect again
+            debug("{} connection closed".format(self._name),DEBUG_INTERFACE)
+            self.reconnect_async()
+            return pmsgs
+        return pmsgs + self._decode_data(data)
+
+    def _decode_data(self,data):
+        "return list of PMessage completed by the received data"
+        debug("Received data from {} : {!r}".format(self._name, data),DEBUG_INTERFACE)
+        pmsgs = self._stream.feed(data)
+        for reply in self._stream.pop_outgoing():
+            self._connection.sendall(reply)
+        return self._on_messages_received(pmsgs)
+
+    def flush_held(self,now):
+        "messages held by an unanswered framing request are sent in the old framing once it times out"
+        wait = self._stream.check_negotiation(now)
+        for data in self._stream.pop_outgoing():
+            self._send_data(data)
+        return wait
+
+    def send(self, msg):
         if (not self._connection):
             raise Exception("connectio not ready, cannot write")
-        data = msg.render_msg()
-        debug("{} Writing data: {}".format(self._name, data),DEBUG_INTERFACE)
+        data = self._stream.encode(msg)
+        if (not data):
+            # held until the framing negotiation is answered or times out, see flush_held()
+            return
+        self._send_data(data)
+
+    def _send_data(self,data):
+        debug("{} Writing data: {!r}".format(self._name, data),DEBUG_INTERFACE)
         try:
             self._connection.sendall(data)
-            if (self._write_delay):
-                time.sleep(self._write_delay)
         except Exception as e:
             debug("Write exception: {}".format(e),DEBUG_INTERFACE)
             if (hasattr(e,'errno') and getattr(e,'errno')==10054):
-                self.reconnect()
+                self.reconnect_async()
             return None
 
 class SocketClientInterface(BaseSocketInterface):
@@ -176,6 +337,8 @@ class SocketServerInterface(BaseSocketInterface):
 
     def _connect(self,server_ip,server_port):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # the port is bound again when the client reconnects
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         server_address = (server_ip, server_port)
         sock.bind(server_address)
         # listening for connections
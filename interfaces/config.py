@@ -16,6 +16,13 @@ N7_MAC = "08:60:6E:A5:A5:86"
 BT_UUID = "00001101-0000-1000-8000-00805F9B34FB"
 BT_PORT = 4
 
+# seconds map and robot status updates to android and pc are held to be merged
+DATA_LATENCY_BUDGET = 0.1
+
+# execution cost model written by simulators.costfit, relative to the package directory,
+# the fast run plans on it if the file exists, otherwise on the default costs
+COST_MODEL_FILE = "cost_model.json"
+
 # device labels
 VALID_LABELS = ANDROID_LABEL, ARDUINO_LABEL, PC_LABEL = "android","arduino","pc"
 CMD_SOURCES = [ANDROID_LABEL,PC_LABEL]
@@ -5,6 +5,8 @@ import socket
 from threading import Lock
 from interfaces.config import *
 from base import SocketServerInterface
+from common.pmessage import PMessage
+from interfaces.pacing import AckPacer
 
 
 class MockPCInterface(SocketServerInterface):
@@ -23,4 +25,16 @@ class MockArduinoInterface(SocketServerInterface):
     _name = ARDUINO_LABEL + "interface"
     _server_ip = MOCK_SERVER_ADDR
     _server_port = ARDUINO_SERVER_PORT
-    _write_delay = 0.8
\ No newline at end of file
+    _write_delay = 0.8 # delay after messages the simulator does not acknowledge
+    _ack_timeout = 5 # a multiple move forward takes 0.2s per grid in the simulator
+
+    def create_pacer(self):
+        "send the next command once the simulator acknowledges the previous one"
+        return AckPacer(self,ack_timeout=self._ack_timeout)
+
+    def expects_ack(self,msg):
+        "the simulator acknowledges every command except sensor requests"
+        return msg.get_type()==PMessage.T_COMMAND and msg.get_msg()!=PMessage.M_GET_SENSOR
+
+    def is_ack(self,sent_msg,received_msg):
+        return received_msg.get_type()==PMessage.T_ROBOT_MOVE
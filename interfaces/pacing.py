@@ -0,0 +1,148 @@
+"""
+pacing of the messages written to an interface,
+decides when the next message may be sent instead of sleeping a fixed delay after every write
+"""
+import time
+from threading import Lock
+from common.debug import debug,DEBUG_INTERFACE
+
+
+class Pacer(object):
+    """
+    base pacer, never delays any message
+    all methods can be called from any thread, `now` is time.time()
+    """
+    _lock = None
+
+    def __init__(self):
+        self._lock = Lock()
+
+    def get_wait_time(self,msg,now):
+        "return seconds to wait before msg can be sent, 0 if it can be sent now"
+        return 0
+
+    def on_sent(self,msg,now):
+        "called after msg is sent"
+        pass
+
+    def on_received(self,msg,now):
+        "called for every message read from the interface"
+        pass
+
+
+class DelayPacer(Pacer):
+    """
+    wait interface.get_write_delay(msg) after writing msg
+    """
+    _interface = None
+    _next_time = 0
+
+    def __init__(self,interface):
+        super(DelayPacer,self).__init__()
+        self._interface = interface
+
+    def get_wait_time(self,msg,now):
+        with self._lock:
+            return max(0,self._next_time-now)
+
+    def on_sent(self,msg,now):
+        with self._lock:
+            self._next_time = now + self._interface.get_write_delay(msg)
+
+
+class TokenBucketPacer(Pacer):
+    """
+    limit the average rate to `rate` messages per second, allowing bursts of up to `burst` messages
+    rate of None means unlimited, the rate can be changed at runtime by set_rate()
+    """
+    _rate = None # messages per second
+    _burst = 1 # bucket size
+    _tokens = 0
+    _last_time = None # time the tokens were last refilled
+
+    def __init__(self,rate=None,burst=1):
+        super(TokenBucketPacer,self).__init__()
+        self.set_rate(rate,burst)
+
+    def set_rate(self,rate,burst=None):
+        with self._lock:
+            self._rate = rate
+            if (burst is not None):
+                self._burst = max(1,burst)
+            self._tokens = self._burst
+            self._last_time = None
+
+    def get_rate(self):
+        return self._rate
+
+    def get_burst(self):
+        return self._burst
+
+    def get_wait_time(self,msg,now):
+        with self._lock:
+            if (not self._rate):
+                return 0
+            self._refill(now)
+            if (self._tokens>=1):
+                return 0
+            return (1-self._tokens)/float(self._rate)
+
+    def on_sent(self,msg,now):
+        with self._lock:
+            if (self._rate):
+                self._refill(now)
+                self._tokens -= 1
+
+    def _refill(self,now):
+        if (self._last_time is not None):
+            self._tokens = min(self._burst,self._tokens+(now-self._last_time)*self._rate)
+        self._last_time = now
+
+
+class AckPacer(Pacer):
+    """
+    send the next message as soon as the previous one is acknowledged,
+    the interface decides which messages are acknowledged through expects_ack() and is_ack(),
+    other messages are followed by interface.get_write_delay(msg)
+    if the ack is lost, sending resumes after `ack_timeout` seconds
+    """
+    _interface = None
+    _ack_timeout = 3
+    _waiting_msg = None # message waiting to be acknowledged
+    _next_time = 0 # time the next message can be sent without an ack
+
+    def __init__(self,interface,ack_timeout=None):
+        super(AckPacer,self).__init__()
+        self._interface = interface
+        if (ack_timeout is not None):
+            self._ack_timeout = ack_timeout
+
+    def set_ack_timeout(self,ack_timeout):
+        with self._lock:
+            self._ack_timeout = ack_timeout
+
+    def is_waiting_for_ack(self):
+        return self._waiting_msg is not None
+
+    def get_wait_time(self,msg,now):
+        with self._lock:
+            wait = self._next_time - now
+            if (self._waiting_msg is not None and wait<=0):
+                debug("No ack for {} within {}s, sending next message".format(self._waiting_msg,self._ack_timeout),DEBUG_INTERFACE)
+                self._waiting_msg = None
+            return max(0,wait)
+
+    def on_sent(self,msg,now):
+        with self._lock:
+            if (self._interface.expects_ack(msg)):
+                self._waiting_msg = msg
+                self._next_time = now + self._ack_timeout
+            else:
+                self._waiting_msg = None
+                self._next_time = now + self._interface.get_write_delay(msg)
+
+    def on_received(self,msg,now):
+        with self._lock:
+            if (self._waiting_msg is not None and self._interface.is_ack(self._waiting_msg,msg)):
+                self._waiting_msg = None
+                self._next_time = now
@@ -0,0 +1,233 @@
+"""
+single thread io loop for all interfaces, replacing one reader and one writer thread per interface
+"""
+import select
+import socket
+import time
+from collections import OrderedDict
+from Queue import Queue,Empty
+from common.pmessage import PMessage
+from common.debug import debug,DEBUG_INTERFACE,DEBUG_IO_QUEUE
+
+
+class OutputQueue(Queue):
+    """
+    queue of PMessage to be written to one interface,
+    wakes up the reactor whenever something is put in
+    """
+    _reactor = None
+
+    def __init__(self,reactor,maxsize=0):
+        Queue.__init__(self,maxsize)
+        self._reactor = reactor
+
+    def put(self,item,block=True,timeout=None):
+        Queue.put(self,item,block,timeout)
+        self._reactor.wakeup()
+
+    def get_wait_time(self,now):
+        "return seconds until a held message becomes available, None if nothing is held"
+        return None
+
+
+class CoalescingOutputQueue(OutputQueue):
+    """
+    output queue merging map and robot status updates,
+    `ums` messages are merged cell by cell with the last value winning and only the latest `ur` is kept,
+    they are held for at most `latency_budget` seconds after the first of them is put in,
+    any other message releases the held updates first so that the order of messages is kept
+    """
+    _latency_budget = 0.1 # seconds
+    _cells = None # (x,y) => value of the held map updates, in the order first updated
+    _robot_status = None # latest held `ur` PMessage
+    _held_since = None # time the first held update was put in
+
+    def __init__(self,reactor,maxsize=0,latency_budget=None):
+        OutputQueue.__init__(self,reactor,maxsize)
+        if (latency_budget is not None):
+            self._latency_budget = latency_budget
+        self._cells = OrderedDict()
+
+    def set_latency_budget(self,latency_budget):
+        "can be changed at runtime"
+        with self.mutex:
+            self._latency_budget = latency_budget
+        self._reactor.wakeup()
+
+    def get_wait_time(self,now):
+        with self.mutex:
+            if (self._held_since is None):
+                return None
+            return max(0,self._held_since+self._latency_budget-now)
+
+    # hooks of Queue, called with self.mutex held
+    def _qsize(self,len=len):
+        size = len(self.queue)
+        if (self._held_since is not None and time.time()>=self._held_since+self._latency_budget):
+            size += 1
+        return size
+
+    def _put(self,item):
+        type = item.get_type()
+        if (type==PMessage.T_UPDATE_MAP_STATUS and self._merge_cells(item.get_msg())):
+            pass
+        elif (type==PMessage.T_UPDATE_ROBOT_STATUS):
+            self._robot_status = item
+        else:
+            self._release_held()
+            self.queue.append(item)
+            return
+        if (self._held_since is None):
+            self._held_since = time.time()
+
+    def _get(self):
+        if (not self.queue):
+            self._release_held()
+        return self.queue.popleft()
+
+    def _merge_cells(self,msg):
+        "return False if msg is not a list of x,y,value"
+        try:
+            cells = [cell.split(",") for cell in msg.split("|")] if msg else []
+            cells = [((int(x),int(y)),int(v)) for x,y,v in cells]
+        except ValueError:
+            return False
+        for pos,value in cells:
+            self._cells[pos] = value
+        return True
+
+    def _release_held(self):
+        "move held updates to the end of the queue"
+        if (self._held_since is None):
+            return
+        if (self._cells):
+            msg = "|".join(["{},{},{}".format(x,y,v) for (x,y),v in self._cells.iteritems()])
+            self.queue.append(PMessage(validate=False,type=PMessage.T_UPDATE_MAP_STATUS,msg=msg))
+            self._cells = OrderedDict()
+        if (self._robot_status):
+            self.queue.append(self._robot_status)
+            self._robot_status = None
+        self._held_since = None
+
+
+class Reactor(object):
+    """
+    multiplex all interfaces with select() in one thread
+    incoming messages are put into input_q as (label,PMessage),
+    outgoing messages are taken from the OutputQueue returned by add_interface(),
+    each message is written when the pacer of its interface allows, without sleeping,
+    an interface that is not ready is left out until it is connected again, its messages wait in its OutputQueue
+    """
+    _SELECT_TIMEOUT = 0.5 # seconds, upper bound of one select call
+
+    _input_q = None # queue of (label,PMessage)
+    _channels = None # list of {'interface','label','out_q','pending'}
+    _running = False
+    _wakeup_r = None # socket pair to interrupt select when an output queue gets a message
+    _wakeup_w = None
+
+    def __init__(self,input_q):
+        self._input_q = input_q
+        self._channels = []
+        self._wakeup_r,self._wakeup_w = self._make_wakeup_pair()
+
+    def add_interface(self,interface,label,latency_budget=None):
+        """
+        register interface, return the OutputQueue for messages to be written to it,
+        map and robot status updates are coalesced if latency_budget is given
+        """
+        if (latency_budget is None):
+            out_q = OutputQueue(reactor=self)
+        else:
+            out_q = CoalescingOutputQueue(reactor=self,latency_budget=latency_budget)
+        self._channels.append({
+            'interface':interface,
+            'label':label,
+            'out_q':out_q,
+            'pending':None, # message taken from out_q but not written yet
+        })
+        # select the interface again as soon as it is (re)connected
+        interface.add_ready_callback(self.wakeup)
+        return out_q
+
+    def get_pacer(self,label):
+        "return the pacer of the interface added with label, its rate can be changed while running"
+        for channel in self._channels:
+            if (channel['label']==label):
+                return channel['interface'].get_pacer()
+        return None
+
+    def run(self):
+        "io loop, returns after stop() is called"
+        self._running = True
+        while self._running:
+            timeout = self._flush_writes()
+            channels = [c for c in self._channels if c['interface'].is_ready()]
+            try:
+                readable,_,_ = select.select([self._wakeup_r]+[c['interface'] for c in channels],[],[],timeout)
+            except (select.error,socket.error,ValueError) as e:
+                # an interface is closed while waiting, it is no longer ready in the next round
+                debug("Select exception: {}".format(e),DEBUG_INTERFACE)
+                continue
+            if (self._wakeup_r in readable):
+                self._wakeup_r.recv(1024)
+            for channel in channels:
+                if (channel['interface'] in readable):
+                    self._read(channel)
+
+    def stop(self):
+        self._running = False
+        self.wakeup()
+
+    def wakeup(self):
+        "interrupt the select call, can be called from any thread"
+        try:
+            self._wakeup_w.send("x")
+        except socket.error:
+            pass
+
+    def _read(self,channel):
+        for pmsg in channel['interface'].read_available():
+            debug("get {} from interface to enqueue".format(pmsg),DEBUG_IO_QUEUE)
+            self._input_q.put_nowait((channel['label'],pmsg))
+
+    def _flush_writes(self):
+        "write every message its pacer allows, return seconds until the next write may be allowed"
+        timeout = self._SELECT_TIMEOUT
+        for channel in self._channels:
+            interface = channel['interface']
+            if (not interface.is_ready()):
+                continue
+            pacer = interface.get_pacer()
+            # the clock is read again after every write, a send can take long on a slow link
+            for held_wait in (channel['out_q'].get_wait_time(time.time()),interface.flush_held(time.time())):
+                if (held_wait is not None):
+                    timeout = min(timeout,held_wait)
+            while (True):
+                if (channel['pending'] is None):
+                    try:
+                        channel['pending'] = channel['out_q'].get_nowait()
+                    except Empty:
+                        break
+                wait = pacer.get_wait_time(channel['pending'],time.time())
+                if (wait>0):
+                    timeout = min(timeout,wait)
+                    break
+                pmsg,channel['pending'] = channel['pending'],None
+                debug("get {} from queue to write".format(pmsg),DEBUG_IO_QUEUE)
+                interface.send(pmsg)
+                pacer.on_sent(pmsg,time.time())
+        return timeout
+
+    def _make_wakeup_pair(self):
+        "return a pair of connected sockets, os.pipe cannot be used with select on windows"
+        server = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+        server.bind(("127.0.0.1",0))
+        server.listen(1)
+        writer = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+        writer.connect(server.getsockname())
+        reader,_ = server.accept()
+        server.close()
+        reader.setblocking(0)
+        writer.setblocking(0)
+        return reader,writer
@@ -7,7 +7,8 @@ import time
 import serial
 from bluetooth import *
 from base import Interface
-from common.pmessage import PMessage,ValidationException
+from interfaces.pacing import AckPacer,TokenBucketPacer
+from common.pmessage import PMessage,PMessageStream,ValidationException
 from common.debug import debug,DEBUG_INTERFACE,DEBUG_VALIDATION
 from interfaces.config import *
 
@@ -21,14 +22,16 @@ current_milli_time = lambda: int(round(time.time() * 1000))
 
 class ArduinoInterface(Interface):
     name = ARDUINO_LABEL
-    _write_delay = 0.5
+    _write_delay = 0.5 # delay after messages arduino does not acknowledge
     _calib_delay = 1
+    _ack_timeout = 3 # resume sending if a move is not acknowledged within this time
 
     def __init__(self):
         super(ArduinoInterface,self).__init__()
         self.status = False
         self.ser = None
         self.port_no = 1
+        self._read_buffer = "" # incomplete line received by read_available
 
     def connect(self):
         if self.ser is not None:
@@ -59,35 +62,84 @@ class ArduinoInterface(Interface):
 
     def read(self):
         try:
-            msg = self.ser.readline().rstrip()
-            if msg != "":
-                debug(str(current_milli_time()) + "SER--Read from Arduino: %s" % str(msg), DEBUG_INTERFACE)
-                if msg[0] != 'T' and len(msg.split(',')) == 6:
-                    realmsg = PMessage(type=PMessage.T_MAP_UPDATE, msg=msg)
-                    debug(str(current_milli_time()) + "SER--Read from Arduino after1: %s" % str(realmsg), DEBUG_INTERFACE)
-                    return realmsg
-                elif msg[0] != 'T' and msg in FROM_SER:
-                    if msg[0] <= '8':
-                        realmsg = PMessage(type=PMessage.T_ROBOT_MOVE, msg=FROM_SER.get(msg[0]))
-                        debug(str(current_milli_time()) + "SER--Read from Arduino after2: %s" % str(realmsg), DEBUG_INTERFACE)
-                        return realmsg
-                elif msg[0] != 'T' and len(msg) > 1:
-                    tmp = ord(msg[1]) - 96
-                    if tmp > 1:
-                        msg = FROM_SER.get(msg[0]) + "*" + str(tmp)
-                    else:
-                        msg = FROM_SER.get(msg[0])
-                    realmsg = PMessage(type=PMessage.T_ROBOT_MOVE, msg=msg)
-                    debug(str(current_milli_time()) + "SER--Read from Arduino after3: %s" % str(realmsg), DEBUG_INTERFACE)
-                    return realmsg
-
+            pmsg = self._parse_line(self.ser.readline().rstrip())
+            if pmsg:
+                self._on_messages_received([pmsg])
+            return pmsg
         except ValidationException as e:
             debug(str(current_milli_time()) + "validation exception: {}".format(e.message),DEBUG_VALIDATION)
         except Exception, e:
             debug(str(current_milli_time()) + "SER--read exception: %s" % str(e),DEBUG_INTERFACE)
             self.reconnect()
 
-    def write(self, msg):
+    def fileno(self):
+        return self.ser.fileno()
+
+    def read_available(self):
+        "read the bytes waiting in the serial buffer, return the messages of the complete lines"
+        try:
+            self._read_buffer += self.ser.read(self.ser.inWaiting() or 1)
+        except Exception, e:
+            debug(str(current_milli_time()) + "SER--read exception: %s" % str(e),DEBUG_INTERFACE)
+            self._read_buffer = ""
+            self.reconnect_async()
+            return []
+        lines = self._read_buffer.split("\n")
+        self._read_buffer = lines.pop()
+        pmsgs = []
+        for line in lines:
+            try:
+                pmsg = self._parse_line(line.rstrip())
+            except ValidationException as e:
+                debug(str(current_milli_time()) + "validation exception: {}".format(e.message),DEBUG_VALIDATION)
+                continue
+            if pmsg:
+                pmsgs.append(pmsg)
+        return self._on_messages_received(pmsgs)
+
+    def _parse_line(self,msg):
+        "convert a line sent by arduino to PMessage, None if it is not a message"
+        if msg != "":
+            debug(str(current_milli_time()) + "SER--Read from Arduino: %s" % str(msg), DEBUG_INTERFACE)
+            if msg[0] != 'T' and len(msg.split(',')) == 6:
+                realmsg = PMessage(type=PMessage.T_MAP_UPDATE, msg=msg)
+                debug(str(current_milli_time()) + "SER--Read from Arduino after1: %s" % str(realmsg), DEBUG_INTERFACE)
+                return realmsg
+            elif msg[0] != 'T' and msg in FROM_SER:
+                if msg[0] <= '8':
+                    realmsg = PMessage(type=PMessage.T_ROBOT_MOVE, msg=FROM_SER.get(msg[0]))
+                    debug(str(current_milli_time()) + "SER--Read from Arduino after2: %s" % str(realmsg), DEBUG_INTERFACE)
+                    return realmsg
+            elif msg[0] != 'T' and len(msg) > 1:
+                tmp = ord(msg[1]) - 96
+                if tmp > 1:
+                    msg = FROM_SER.get(msg[0]) + "*" + str(tmp)
+                else:
+                    msg = FROM_SER.get(msg[0])
+                realmsg = PMessage(type=PMessage.T_ROBOT_MOVE, msg=msg)
+                debug(str(current_milli_time()) + "SER--Read from Arduino after3: %s" % str(realmsg), DEBUG_INTERFACE)
+                return realmsg
+
+    def get_write_delay(self, msg):
+        "calibration takes longer for arduino to finish"
+        if msg.get_msg() in (PMessage.M_CALLIBRATE_FRONT, PMessage.M_CALLIBRATE_RIGHT):
+            return self._calib_delay
+        return self._write_delay
+
+    def create_pacer(self):
+        "send the next command once arduino acknowledges the previous one"
+        return AckPacer(self,ack_timeout=self._ack_timeout)
+
+    def expects_ack(self, msg):
+        "arduino only acknowledges the moves it executes, sr has no serial code and is never written"
+        move = msg.get_msg()
+        return move in PMessage.VALID_MOVE_COMMAND_SET and move.split('*')[0] in TO_SER
+
+    def is_ack(self, sent_msg, received_msg):
+        return received_msg.get_type() == PMessage.T_ROBOT_MOVE
+
+    def send(self, msg):
+        "return True if msg is written to serial"
         try:
             msg = msg.get_msg()
             debug(str(current_milli_time()) + "SER--Write to Arduino b4: %s" % str(msg), DEBUG_INTERFACE)       
@@ -104,22 +156,24 @@ class ArduinoInterface(Interface):
             if realmsg:
                 debug(str(current_milli_time()) + "SER--Write to Arduino: %s" % str(realmsg),DEBUG_INTERFACE)
                 self.ser.write(realmsg)
-                if realmsg == 'i' or realmsg == 'o':
-                    time.sleep(self._calib_delay - self._write_delay)
-                time.sleep(self._write_delay)
+                return True
         except Exception, e:
             debug(str(current_milli_time()) + "SER--write exception: %s" % str(e),DEBUG_INTERFACE)
-            self.reconnect()
+            self.reconnect_async()
+        return False
 
 
 class AndroidInterface(Interface):
 
     name = ANDROID_LABEL
-    _write_delay = 0.1
+    _write_delay = 0.1 # average interval between written messages in seconds
+    _write_burst = 3
+    _framing = PMessageStream.FRAMING_JSON # initial framing, the android app may switch it with a `framing` message
 
     def __init__(self):
         super(AndroidInterface,self).__init__()
         self.status = False
+        self._stream = PMessageStream(self._framing)
 
     def connect(self):
         connected = False
@@ -135,6 +189,7 @@ class AndroidInterface(Interface):
                                   profiles=[SERIAL_PORT_PROFILE],
                 )
                 self.client_sock, client_info = self.server_sock.accept()
+                self._stream = PMessageStream(self._framing)
                 debug("BT--Connected to %s on channel %s" % (str(client_info), str(port)),DEBUG_INTERFACE)
                 self.set_ready()
                 return True
@@ -153,24 +208,74 @@ class AndroidInterface(Interface):
     def read(self):
         if (not self._msg_buffer.is_empty()):
             return self._msg_buffer.dequeue()
+        pmsgs = self.read_available()
+        if (pmsgs):
+            for msg in pmsgs:
+                self._msg_buffer.enqueue(msg)
+            return self._msg_buffer.dequeue()
+
+    def fileno(self):
+        return self.client_sock.fileno()
+
+    def read_available(self):
         try:
             msg = self.client_sock.recv(2048)
-            debug("BT--Read from Android: %s" % str(msg),DEBUG_INTERFACE)
-            pmsgs = PMessage.load_messages_from_json(json_str=msg)
-            if (pmsgs):
-                for msg in pmsgs:
-                    self._msg_buffer.enqueue(msg)
-                return self._msg_buffer.dequeue()
-        except ValidationException as e:
-            debug("Validation exception: {}".format(e.message),DEBUG_VALIDATION)
         except Exception, e:
             debug("BT--read exception: %s" % str(e),DEBUG_INTERFACE)
+            self.reconnect_async()
+            return []
+        if not msg:
+            # android has closed the connection, wait for it to connect again
+            debug("BT--Android disconnected",DEBUG_INTERFACE)
+            self.reconnect_async()
+            return []
+        return self._decode_data(msg)
+
+    def _decode_data(self, data):
+        "return list of PMessage completed by the received data"
+        debug("BT--Read from Android: %r" % data,DEBUG_INTERFACE)
+        try:
+            pmsgs = self._stream.feed(data)
+        except Exception, e:
+            debug("BT--read exception: %s" % str(e),DEBUG_INTERFACE)
+            return []
+        for reply in self._stream.pop_outgoing():
+            self._send_data(reply)
+        return self._on_messages_received(pmsgs)
+
+    def get_write_delay(self, msg):
+        return self._write_delay
+
+    def set_write_delay(self, delay, burst=None):
+        "can be changed at runtime"
+        self._write_delay = delay
+        if burst is not None:
+            self._write_burst = burst
+        self.get_pacer().set_rate(1.0 / delay if delay else None, self._write_burst)
+
+    def create_pacer(self):
+        return TokenBucketPacer(rate=1.0 / self._write_delay if self._write_delay else None, burst=self._write_burst)
+
+    def flush_held(self, now):
+        "messages held by an unanswered framing request are sent in the old framing once it times out"
+        wait = self._stream.check_negotiation(now)
+        for data in self._stream.pop_outgoing():
+            self._send_data(data)
+        return wait
+
+    def send(self, msg):
+        "return True if msg is sent, False if it is held back or cannot be written"
+        data = self._stream.encode(msg)
+        if (not data):
+            # held until the framing negotiation is answered or times out, see flush_held()
+            return False
+        return self._send_data(data)
 
-    def write(self, msg):
+    def _send_data(self, data):
         try:
-            msg = msg.render_msg()
-            self.client_sock.send(msg)
-            time.sleep(self._write_delay)
-            debug("BT--Write to Android: %s" % str(msg),DEBUG_INTERFACE)
+            self.client_sock.sendall(data)
+            debug("BT--Write to Android: %r" % data,DEBUG_INTERFACE)
+            return True
         except Exception, e:
             debug("BT--write exception: %s" % str(e),DEBUG_INTERFACE)
+        return False
@@ -6,4 +6,99 @@ q.enqueue("1")
 print q.is_empty()
 print q.dequeue()
 
-print q.is_empty()
\ No newline at end of file
+print q.is_empty()
+
+import socket
+import time
+from base import BaseSocketInterface
+from pacing import AckPacer
+from reactor import Reactor,CoalescingOutputQueue
+from Queue import Queue,Empty
+from common.pmessage import PMessage,PMessageStream
+
+class SocketPairInterface(BaseSocketInterface):
+    "connected to the other end of a socket pair, which is left to the test"
+    _name = "socket pair"
+    _preferred_framing = PMessageStream.FRAMING_BINARY
+
+    def _connect(self,server_ip,server_port):
+        connection,self.peer = socket.socketpair()
+        return connection
+
+def test_unanswered_framing_request():
+    "the peer never answers the framing request, the held message must still be sent"
+    interface = SocketPairInterface()
+    interface.connect()
+    peer = interface.peer
+    peer.settimeout(0.5)
+    assert peer.recv(2048)==PMessage(type=PMessage.T_SET_FRAMING,msg=PMessageStream.FRAMING_BINARY).render_msg()
+    explore = PMessage(type=PMessage.T_COMMAND,msg=PMessage.M_START_EXPLORE)
+    interface.send(explore)
+    assert interface.flush_held(time.time())>0
+    assert interface.flush_held(time.time()+PMessageStream._negotiation_timeout) is None
+    # the held message is sent in the old framing
+    assert peer.recv(2048)==explore.render_msg()
+    fastrun = PMessage(type=PMessage.T_COMMAND,msg=PMessage.M_START_FASTRUN)
+    interface.send(fastrun)
+    assert peer.recv(2048)==fastrun.render_msg()
+
+class MoveAckInterface(object):
+    "acknowledges the moves only, like ArduinoInterface"
+    def expects_ack(self,msg):
+        return msg.get_msg() in PMessage.VALID_MOVE_COMMAND_SET
+
+    def is_ack(self,sent_msg,received_msg):
+        return received_msg.get_type()==PMessage.T_ROBOT_MOVE
+
+    def get_write_delay(self,msg):
+        return 0.5
+
+def test_ack_pacer():
+    "a move holds the next message until its ack arrives, a callibration message only waits for the write delay"
+    pacer = AckPacer(MoveAckInterface(),ack_timeout=3)
+    move = PMessage(type=PMessage.T_COMMAND,msg="mf*3")
+    callibration = PMessage(type=PMessage.T_CALLIBRATE,msg=PMessage.M_CALLIBRATE_RIGHT)
+    assert pacer.get_wait_time(move,100)==0
+    pacer.on_sent(move,100)
+    assert pacer.is_waiting_for_ack()
+    assert pacer.get_wait_time(move,101)==2
+    pacer.on_received(PMessage(type=PMessage.T_MAP_UPDATE,msg="1,2,3,4,5,6"),101)
+    assert pacer.is_waiting_for_ack()
+    pacer.on_received(PMessage(type=PMessage.T_ROBOT_MOVE,msg="mf*3"),101)
+    assert not pacer.is_waiting_for_ack()
+    assert pacer.get_wait_time(callibration,101)==0
+    pacer.on_sent(callibration,101)
+    assert not pacer.is_waiting_for_ack()
+    assert pacer.get_wait_time(move,101)==0.5
+    assert pacer.get_wait_time(move,101.5)==0
+
+def test_coalescing_queue():
+    "only the latest map and robot status are kept, commands keep their order"
+    q = CoalescingOutputQueue(Reactor(input_q=Queue()),latency_budget=10)
+    for type,msg in [(PMessage.T_UPDATE_MAP_STATUS,"1,1,0|2,2,1"),
+                     (PMessage.T_UPDATE_ROBOT_STATUS,"1,1,0"),
+                     (PMessage.T_UPDATE_MAP_STATUS,"2,2,0|3,3,1"),
+                     (PMessage.T_UPDATE_ROBOT_STATUS,"1,2,0"),
+                     (PMessage.T_COMMAND,PMessage.M_MOVE_FORWARD),
+                     (PMessage.T_UPDATE_MAP_STATUS,"4,4,1"),
+                     (PMessage.T_COMMAND,PMessage.M_TURN_LEFT),
+                     (PMessage.T_UPDATE_ROBOT_STATUS,"1,3,1")]:
+        q.put(PMessage(type=type,msg=msg))
+    written = []
+    while True:
+        try:
+            written.append(q.get_nowait())
+        except Empty:
+            break
+    assert [(m.get_type(),m.get_msg()) for m in written]==[(PMessage.T_UPDATE_MAP_STATUS,"1,1,0|2,2,0|3,3,1"),
+                                                           (PMessage.T_UPDATE_ROBOT_STATUS,"1,2,0"),
+                                                           (PMessage.T_COMMAND,PMessage.M_MOVE_FORWARD),
+                                                           (PMessage.T_UPDATE_MAP_STATUS,"4,4,1"),
+                                                           (PMessage.T_COMMAND,PMessage.M_TURN_LEFT)]
+    # the last robot status is held until the latency budget has passed
+    assert q.get_wait_time(time.time())>0
+
+if __name__ == '__main__':
+    test_unanswered_framing_request()
+    test_ack_pacer()
+    test_coalescing_queue()
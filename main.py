@@ -3,33 +3,18 @@ This is the script to start running the system
 Run main() to start running
 """
 
+import os
 from Queue import Queue
 import thread
 import threading
 
-from common.debug import debug,DEBUG_IO_QUEUE
-from interfaces.config import ARDUINO_LABEL,ANDROID_LABEL,PC_LABEL
+from common.debug import debug,DEBUG_IO_QUEUE,DEBUG_ALGO
+from interfaces.config import ARDUINO_LABEL,ANDROID_LABEL,PC_LABEL,DATA_LATENCY_BUDGET,COST_MODEL_FILE
 from interfaces import *
+from interfaces.reactor import Reactor
 from fsm.control import CentralController
-
-
-def write_to_interface(from_queue, interface):
-    """thread task for writing to android,pc,arduino"""
-    while True:
-        if (not from_queue.empty()) and interface.is_ready():
-            val = from_queue.get_nowait()
-            debug("get {} from queue to write".format(val),DEBUG_IO_QUEUE)
-            interface.write(val)
-
-
-def read_from_interface(to_queue, interface,label):
-    """thread task for reading from android, arduino"""
-    while True:
-        if (interface.is_ready()):
-            val = interface.read()
-            if val:
-                debug("get {} from interface to enqueue".format(val),DEBUG_IO_QUEUE)
-                to_queue.put_nowait((label,val))
+from algorithms.cost_model import ExecutionCostModel
+from algorithms.shortest_path import AStarShortestPathAlgoWithCostModel
 
 
 def connect_interfaces(interfaces):
@@ -40,13 +25,22 @@ def connect_interfaces(interfaces):
         t.start()
 
 
+def load_cost_model(file_name=COST_MODEL_FILE):
+    """plan the fast run on the execution cost model fitted to the robot, if there is one"""
+    file_name = os.path.join(os.path.dirname(os.path.abspath(__file__)),file_name)
+    if (not os.path.isfile(file_name)):
+        debug("No cost model at {}, planning on the default costs".format(file_name),DEBUG_ALGO)
+        return
+    AStarShortestPathAlgoWithCostModel.set_cost_model(ExecutionCostModel.load(file_name))
+    debug("Cost model loaded from {}".format(file_name),DEBUG_ALGO)
+
+
 def main(use_mock_arduino=False):
     """init and start the system"""
+    load_cost_model()
     # init all queues
-    to_android = Queue(maxsize=0)  # output
-    to_pc = Queue(maxsize=0)  # output
-    to_arduino = Queue(maxsize=0)  # output
     to_control = Queue(maxsize=0)  # for processing
+    reactor = Reactor(input_q=to_control)
     # init all interfaces
     pc_interface = get_pc_interface()
     android_interface = get_android_interface()
@@ -59,16 +53,19 @@ def main(use_mock_arduino=False):
         arduino_mock = ArduinoController(map_ref=MapRef(),robot_ref=RobotRef())
         thread.start_new_thread(arduino_mock.run,())
     connect_interfaces([pc_interface, arduino_interface,android_interface])
-    # start output threads
-    thread.start_new_thread(write_to_interface,(to_pc,pc_interface,))
-    thread.start_new_thread(write_to_interface, (to_android, android_interface,))
-    thread.start_new_thread(write_to_interface, (to_arduino, arduino_interface,))
-    # start input threads
-    thread.start_new_thread(read_from_interface, (to_control, arduino_interface,ARDUINO_LABEL))
-    thread.start_new_thread(read_from_interface, (to_control, android_interface,ANDROID_LABEL))
-    thread.start_new_thread(read_from_interface, (to_control, pc_interface,PC_LABEL))
+    # output queues, all interfaces are read and written by the reactor thread
+    to_pc = reactor.add_interface(pc_interface,PC_LABEL,latency_budget=DATA_LATENCY_BUDGET)
+    to_android = reactor.add_interface(android_interface,ANDROID_LABEL,latency_budget=DATA_LATENCY_BUDGET)
+    to_arduino = reactor.add_interface(arduino_interface,ARDUINO_LABEL)
+    thread.start_new_thread(reactor.run,())
     controller = CentralController.get_instance(input_q=to_control, cmd_out_q=to_arduino, data_out_qs=[to_pc, to_android])
-    controller.control_task()
+    try:
+        controller.control_task()
+    except KeyboardInterrupt:
+        debug("shutting down",DEBUG_IO_QUEUE)
+    finally:
+        reactor.stop()
+        controller.stop()
 
 use_mock_arduino = raw_input("use mock arduino?[y/n]")
 if (use_mock_arduino=="y"):
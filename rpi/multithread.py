@@ -33,49 +33,48 @@ class Main:
     def activateAlgo(self, algoQ, arduinoQ, androidQ):
         algo = Algo()
         while 1:
-            if not algoQ.empty():
-                val = algoQ.get_nowait()
-                if algo.explore_done and algo.enter_goal:
-                    arduinoQ.put_nowait("CF")
-                    break
-                if algo.in_start_zone() and algo.enter_goal:
-                    arduinoQ.put_nowait("CF")
-                    while not algo.commands.empty():
-                        print(algo.commands.get_nowait())
-                    algo.explore_done = True
-
-                if val == "M":
-                    result = algo.move_forward()
-                    print("robot mved")
-                    print (result)
-                elif val == "R":
-                    result = algo.turn_right()
-                elif val == "L":
-                    result = algo.turn_left()
-                elif val == "B":
-                    result = algo.turn_back()
-
-                elif (val == "SE" and not algo.explore_start):
-                    result = algo.explore()
-                    arduinoQ.put_nowait(result)
-
-                elif val == "SF":
-                    algo.fast()
-                    while not algo.commands.empty() and not algo.enter_goal:
-                        arduinoQ.put_nowait(algo.commands.get_nowait())
-
-                elif len(val.split(',')) == 6:
-                    result = algo.update_map(val)
-                    print "algo return to bt to update map", result
-                    androidQ.put_nowait(result)
-                algo.map.print_map()
+            # block until the next message arrives
+            val = algoQ.get()
+            if algo.explore_done and algo.enter_goal:
+                arduinoQ.put_nowait("CF")
+                break
+            if algo.in_start_zone() and algo.enter_goal:
+                arduinoQ.put_nowait("CF")
+                while not algo.commands.empty():
+                    print(algo.commands.get_nowait())
+                algo.explore_done = True
+
+            if val == "M":
+                result = algo.move_forward()
+                print("robot mved")
+                print (result)
+            elif val == "R":
+                result = algo.turn_right()
+            elif val == "L":
+                result = algo.turn_left()
+            elif val == "B":
+                result = algo.turn_back()
+
+            elif (val == "SE" and not algo.explore_start):
+                result = algo.explore()
+                arduinoQ.put_nowait(result)
+
+            elif val == "SF":
+                algo.fast()
+                while not algo.commands.empty() and not algo.enter_goal:
+                    arduinoQ.put_nowait(algo.commands.get_nowait())
+
+            elif len(val.split(',')) == 6:
+                result = algo.update_map(val)
+                print "algo return to bt to update map", result
+                androidQ.put_nowait(result)
+            algo.map.print_map()
 
 # sending data to android from queue
     def btWrite(self, androidQ):
         while 1:
-            if not androidQ.empty():
-                val = androidQ.get_nowait()
-                self.android.write(val)
+            val = androidQ.get()
+            self.android.write(val)
 
     # reading android value, send data to algo.
     def btRead(self, algoQ):
@@ -87,9 +86,8 @@ class Main:
     #sending data to arduino from arduino msg queue.
     def arduinoWrite(self, arduinoQ):
         while 1:
-            if not arduinoQ.empty():
-                val = arduinoQ.get_nowait()
-                self.arduino.write(val)
+            val = arduinoQ.get()
+            self.arduino.write(val)
 
     #reading data from arduino to ALGO & android.
     def arduinoRead(self, algoQ):
@@ -110,8 +108,9 @@ class Main:
 
         except Exception, e:
             print "RPI--Cannot start threads: %s" % str(e)
+        # keep the main thread alive without spinning
         while 1:
-            pass
+            time.sleep(1)
 
 if "name == __main__":
     test = Main()
@@ -4,7 +4,7 @@ import time
 
 from common.robot import *
 from common.amap import *
-from algorithms.shortest_path import AStarShortestPathAlgo
+from algorithms.shortest_path import AStarShortestPathAlgo,PlanCache
 
 from simulators.controllers import ArduinoController
 
@@ -37,7 +37,7 @@ class ArduinoSimulationApp(BaseObserver,AppSettings):
         # add this app as the listener of robot
         _robot = RobotRef()
         self._robotUI = RobotUIWithTracing(robot=_robot,cells=self._map_ui.get_cells())
-        #_robot.add_change_listener(self)
+        _robot.add_change_listener(self)
         # init controller
         self._controller = ArduinoController(map_ref=_map_ref,robot_ref=_robot)
         self._controller.add_change_listener(self)
@@ -86,8 +86,8 @@ class ArduinoSimulationApp(BaseObserver,AppSettings):
     def show_path(self):
         map_ref = self._controller.get_map_ref()
         robot_ref = self._controller.get_robot_ref()
-        algo = AStarShortestPathAlgo(map_ref=map_ref,target_pos=(13,1))
-        algo._build_search_tree(robot_pos=robot_ref.get_position(),robot_ori=robot_ref.get_orientation())
+        algo = PlanCache.get_instance().get_planner(AStarShortestPathAlgo,map_ref=map_ref,target_pos=(13,1),
+                                                    robot_pos=robot_ref.get_position(),robot_ori=robot_ref.get_orientation())
         nodes = algo._get_nodes()
         # paint f values
         for y in range(len(nodes)):
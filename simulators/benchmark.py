@@ -0,0 +1,234 @@
+"""
+benchmark exploration and fast run over the map files and randomly generated maps,
+every map is simulated by simulators.headless in its own worker process,
+results are written as json and can be compared against the results of an earlier run
+
+usage: python -m simulators.benchmark [-j jobs] [--random N] [--seed S] [--frontier] [--cost-model model.json]
+                                      [-o results.json] [--baseline old.json] [map files]
+"""
+import argparse
+import json
+import multiprocessing
+import random
+import sys
+import time
+
+from common.amap import MapRef,MapSetting
+from common.robot import RobotRef
+from common.pmessage import PMessage
+from common.debug import DEBUG_SETTING
+from fsm.states import FastRunState,ExplorationFirstRoundState
+from algorithms.shortest_path import AStarShortestPathAlgoWithCostModel
+from algorithms.cost_model import ExecutionCostModel
+from simulators.headless import HeadlessSimulation,get_map_files
+
+try:
+    import resource
+except ImportError:
+    # not available on windows, peak memory is not reported
+    resource = None
+
+COVERAGE_MILESTONES = [50,80,90,95,100]
+RANDOM_MAP_OBSTACLES = 20 # obstacle blocks in a random map
+RANDOM_MAP_MAX_TRIES = 100
+
+# metric => True if a larger value is better, used to report regressions against a baseline
+QUALITY_METRICS = [
+    ('coverage',True),
+    ('map_errors',False),
+    ('explore_steps',False),
+    ('fastrun_steps',False),
+    ('fastrun_turns',False),
+    ('predicted_time',False),
+    ('collisions',False),
+]
+# only reported, these depend on the machine running the benchmark
+PERFORMANCE_METRICS = ['plan_expanded','plan_time_ms','wall_time_ms','peak_memory_kb']
+
+
+def generate_random_map(seed,num_obstacles=RANDOM_MAP_OBSTACLES):
+    "return a MapRef with random obstacle blocks in which the end zone can be reached from the start zone"
+    rand = random.Random(seed)
+    for i in range(RANDOM_MAP_MAX_TRIES):
+        map_ref = MapRef()
+        map_ref.set_unknowns_as_clear()
+        for j in range(num_obstacles):
+            # horizontal or vertical block of 1 to 3 cells, cells of the start and end zone are fixed
+            length = rand.randint(1,3)
+            dx,dy = rand.choice([(1,0),(0,1)])
+            x,y = rand.randrange(map_ref.get_size_x()),rand.randrange(map_ref.get_size_y())
+            for k in range(length):
+                map_ref.set_cell(x+dx*k,y+dy*k,MapSetting.OBSTACLE,notify=False)
+        if (is_end_reachable(map_ref)):
+            return map_ref
+    raise Exception("cannot generate a solvable map with seed {}".format(seed))
+
+def is_end_reachable(map_ref):
+    robot = RobotRef()
+    planner = FastRunState.get_planner_class()(map_ref=map_ref,target_pos=map_ref.get_end_zone_center_pos())
+    try:
+        planner.get_shortest_path(robot_pos=robot.get_position(),robot_ori=robot.get_orientation())
+    except Exception:
+        return False
+    return True
+
+def count_turns(commands):
+    turns = 0
+    for cmd in commands:
+        if (cmd in (PMessage.M_TURN_LEFT,PMessage.M_TURN_RIGHT)):
+            turns += 1
+        elif (cmd==PMessage.M_TURN_BACK):
+            turns += 2
+    return turns
+
+def get_steps_to_coverage(coverage_trace,milestones=COVERAGE_MILESTONES):
+    "return {milestone: number of exploration moves to reach it, None if it is never reached}"
+    steps = {}
+    for milestone in milestones:
+        steps[str(milestone)] = next((i+1 for i,c in enumerate(coverage_trace) if c>=milestone),None)
+    return steps
+
+def benchmark_task(task):
+    """
+    task is (name,map_file,seed,use_frontier), seed is used for a random map when map_file is None,
+    return a result dict
+    """
+    name,map_file,seed,use_frontier = task
+    # every task runs in its own worker process
+    ExplorationFirstRoundState._USE_FRONTIER_EXPLORATION = use_frontier
+    if (map_file):
+        sim = HeadlessSimulation(map_file=map_file)
+    else:
+        sim = HeadlessSimulation(map_ref=generate_random_map(seed),name=name)
+    result = sim.explore()
+    result['plan_time_ms'] = None
+    result['plan_expanded'] = None
+    if (result['explore_finished']):
+        # plan exactly like FastRunState does, on the map built by exploration
+        controller = sim.get_controller()
+        map_ref,robot = controller.get_map_ref(),controller.get_robot_ref()
+        start = time.time()
+        planner = FastRunState.get_planner_class()(map_ref=map_ref,target_pos=map_ref.get_end_zone_center_pos())
+        try:
+            planner.get_shortest_path(robot_pos=robot.get_position(),robot_ori=robot.get_orientation())
+        except Exception:
+            pass
+        result['plan_time_ms'] = (time.time()-start)*1000
+        result['plan_expanded'] = planner.get_num_expanded()
+        result = sim.fastrun()
+    result['explore_turns'] = count_turns(result['explore_commands'])
+    result['fastrun_turns'] = count_turns(result['fastrun_commands'])
+    # predicted by the model the fast run is planned with, in grid steps unless --cost-model is given
+    fastrun_messages = result['fastrun_commands']+result.pop('fastrun_callibrations')
+    result['predicted_time'] = AStarShortestPathAlgoWithCostModel.get_cost_model().get_run_time(
+        fastrun_messages) if result['reached_goal'] else None
+    result['steps_to_coverage'] = get_steps_to_coverage(result.pop('coverage_trace'))
+    result['wall_time_ms'] = result.pop('wall_time')*1000
+    result['peak_memory_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None
+    del result['explore_commands']
+    return result
+
+def _init_worker(cost_model_params=None):
+    DEBUG_SETTING['enabled_types'] = []
+    if (cost_model_params):
+        AStarShortestPathAlgoWithCostModel.set_cost_model(ExecutionCostModel(**cost_model_params))
+
+def run_benchmark(map_files,num_random=0,seed=0,jobs=None,use_frontier=False,cost_model=None):
+    "return the list of result dicts, in the order of map_files followed by the random maps"
+    tasks = [(None,f,None,use_frontier) for f in map_files]
+    tasks += [("random-{}-{}".format(seed,i),None,seed*100003+i,use_frontier) for i in range(num_random)]
+    # one process per map, so that peak memory belongs to a single run
+    pool = multiprocessing.Pool(processes=jobs,initializer=_init_worker,maxtasksperchild=1,
+                                initargs=(cost_model.get_params() if cost_model else None,))
+    try:
+        return pool.map(benchmark_task,tasks,chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+def compare_results(results,baseline):
+    "return a list of regression descriptions of results against baseline, maps are matched by name"
+    baseline_by_map = dict((r['map'],r) for r in baseline)
+    regressions = []
+    for result in results:
+        old = baseline_by_map.get(result['map'])
+        if (not old):
+            continue
+        if (old['reached_goal'] and not result['reached_goal']):
+            regressions.append("{}: goal no longer reached".format(result['map']))
+        for metric,larger_is_better in QUALITY_METRICS:
+            new_value,old_value = result.get(metric),old.get(metric)
+            if (new_value is None or old_value is None or new_value==old_value):
+                continue
+            if ((new_value>old_value)!=larger_is_better):
+                regressions.append("{}: {} {} -> {}".format(result['map'],metric,old_value,new_value))
+    return regressions
+
+def summarize(results):
+    "return {metric: mean} over the results having the metric"
+    summary = {}
+    for metric in [m for m,_ in QUALITY_METRICS]+PERFORMANCE_METRICS:
+        values = [r[metric] for r in results if r.get(metric) is not None]
+        summary[metric] = sum(values)/float(len(values)) if values else None
+    summary['reached_goal'] = sum(1 for r in results if r['reached_goal'])
+    summary['maps'] = len(results)
+    return summary
+
+def print_results(results,summary,baseline_summary=None):
+    row_format = "{:<16}{:>7}{:>9}{:>7}{:>8}{:>7}{:>6}{:>9}{:>9}{:>9}{:>10}"
+    print(row_format.format("map","steps","coverage","to95%","fastrun","turns","goal","expanded","plan(ms)","time(ms)","mem(kb)"))
+    for r in results:
+        print(row_format.format(r['map'],r['explore_steps'],r['coverage'],r['steps_to_coverage']['95'],
+                                r['fastrun_steps'],r['fastrun_turns'],"yes" if r['reached_goal'] else "no",
+                                r['plan_expanded'],_format_number(r['plan_time_ms']),
+                                _format_number(r['wall_time_ms']),r['peak_memory_kb']))
+    print("")
+    print("{:<16}{:>12}{:>12}".format("mean","current","baseline" if baseline_summary else ""))
+    for metric in sorted(summary.keys()):
+        print("{:<16}{:>12}{:>12}".format(metric,_format_number(summary[metric]),
+                                          _format_number(baseline_summary.get(metric)) if baseline_summary else ""))
+
+def _format_number(value):
+    if (isinstance(value,float)):
+        return "{:.2f}".format(value)
+    return str(value)
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark exploration and fast run over a corpus of maps")
+    parser.add_argument("maps",nargs="*",help="map files, default to all .bin files in simulators/mapfiles")
+    parser.add_argument("-j","--jobs",type=int,default=None,help="worker processes, default to the number of cpus")
+    parser.add_argument("--random",type=int,default=0,help="number of random maps to add")
+    parser.add_argument("--seed",type=int,default=0,help="seed of the random maps")
+    parser.add_argument("--frontier",action="store_true",help="explore with the frontier strategy instead of following the wall")
+    parser.add_argument("--cost-model",help="plan the fast run with the cost model fitted by simulators.costfit")
+    parser.add_argument("-o","--output",help="write the results to this json file")
+    parser.add_argument("--baseline",help="json file of an earlier run to compare with")
+    args = parser.parse_args()
+    cost_model = ExecutionCostModel.load(args.cost_model) if args.cost_model else None
+    _init_worker(cost_model.get_params() if cost_model else None)
+
+    results = run_benchmark(get_map_files(args.maps),num_random=args.random,seed=args.seed,jobs=args.jobs,
+                            use_frontier=args.frontier,cost_model=cost_model)
+    summary = summarize(results)
+    baseline,baseline_summary = None,None
+    if (args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        # means over the maps present in both runs
+        maps = set(r['map'] for r in results)
+        baseline_summary = summarize([r for r in baseline['results'] if r['map'] in maps])
+    print_results(results,summary,baseline_summary)
+    if (args.output):
+        with open(args.output,"w") as f:
+            json.dump({'created':time.time(),'summary':summary,'results':results},f,indent=1,sort_keys=True)
+    if (baseline):
+        regressions = compare_results(results,baseline['results'])
+        print("")
+        print("{} regressions against {}".format(len(regressions),args.baseline))
+        for regression in regressions:
+            print("  "+regression)
+        if (regressions):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
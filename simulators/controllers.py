@@ -2,7 +2,7 @@ import time
 import random
 from thread import start_new_thread
 
-from common.pmessage import PMessage
+from common.pmessage import PMessage,PMessageStream
 from common.amap import MapRef,MapSetting
 from common.orientation import AbsoluteOrientation
 from interfaces.base import SocketClientInterface
@@ -14,6 +14,7 @@ class BaseSimulatorController():
     _robot = None # RobotRef object
     _map_ref = None # MapRef object
     _client = None # SocketClient Object
+    PREFERRED_FRAMING = None # framing negotiated with the server after connecting
 
     def __init__(self,**kwargs):
         self._map_ref = kwargs.get("map_ref")
@@ -28,6 +29,8 @@ class BaseSimulatorController():
     def run(self):
         # init client connection
         self._client = SocketClientInterface(ip=self.get_server_addr(),port=self.get_server_port())
+        if (self.PREFERRED_FRAMING):
+            self._client.set_preferred_framing(self.PREFERRED_FRAMING)
         start_new_thread(self.start_session,())
 
     def start_session(self):
@@ -53,9 +56,11 @@ class ArduinoController(BasePublisher,BaseSimulatorController):
     controlling the internal logic of arduino simulator
     """
     EXECUTION_DELAY = 0
+    MOVE_DELAY = 0.2 # seconds per grid of a multiple move forward
     MAP_FILE_NAME = "map-19.bin"
     VALID_CELL_VALUE = MapRef.VALID_CELL_VALUES
     VALID_INSTRUCTIONS = [PMessage.M_MOVE_FORWARD,PMessage.M_TURN_LEFT,PMessage.M_TURN_RIGHT,PMessage.M_START_EXPLORE,PMessage.M_START_FASTRUN,PMessage.M_RESET]
+    _topic = BasePublisher.TOPIC_STATUS
 
     _sending_sensor_data = True
     _sending_move_ack = True
@@ -107,39 +112,43 @@ class ArduinoController(BasePublisher,BaseSimulatorController):
         while True:
             msg_obj =conn.read()
             if (msg_obj):
-                self.show_status("received data: " + str(msg_obj))
-                if (msg_obj.get_type()==PMessage.T_SET_ROBOT_POS):
-                    x,y=msg_obj.get_msg().split(",")
-                    self._map_ref.refresh()
-                    self._robot.set_position((int(x),int(y)))
-                    self.show_status("Robot position set to {},{}".format(x,y))
-                    continue
-                elif (msg_obj.get_type()==PMessage.T_COMMAND and msg_obj.get_msg()==PMessage.M_GET_SENSOR):
-                    self.send_sensor_data()
-                    continue
-                elif (msg_obj.get_msg()==PMessage.M_START_FASTRUN):
-                    self.send_data(type=PMessage.T_ROBOT_MOVE,data=PMessage.M_START_FASTRUN)
-                    continue
-                elif(msg_obj.get_type()==PMessage.T_CALLIBRATE):
-                    self.do_callibration(msg_obj.get_msg())
-                    continue
-                instruction = self.decode_instruction(msg_obj)
-                if (instruction):
-                    self.execute_instruction(instruction)
-                    if (self._sending_move_ack and instruction in PMessage.get_valid_cmd_msgs()):
-                        self.send_data(type=PMessage.T_ROBOT_MOVE,data=instruction)
-                    if (self._sending_sensor_data):
-                        self.send_sensor_data()
-
-                else: self.show_status("Instruction cannot be decoded!")
+                self.handle_message(msg_obj)
+
+    def handle_message(self,msg_obj):
+        "execute one instruction from Rpi, replies are sent by send_data()"
+        self.show_status("received data: " + str(msg_obj))
+        if (msg_obj.get_type()==PMessage.T_SET_ROBOT_POS):
+            x,y=msg_obj.get_msg().split(",")
+            self._map_ref.refresh()
+            self._robot.set_position((int(x),int(y)))
+            self.show_status("Robot position set to {},{}".format(x,y))
+            return
+        elif (msg_obj.get_type()==PMessage.T_COMMAND and msg_obj.get_msg()==PMessage.M_GET_SENSOR):
+            self.send_sensor_data()
+            return
+        elif (msg_obj.get_msg()==PMessage.M_START_FASTRUN):
+            self.send_data(type=PMessage.T_ROBOT_MOVE,data=PMessage.M_START_FASTRUN)
+            return
+        elif(msg_obj.get_type()==PMessage.T_CALLIBRATE):
+            self.do_callibration(msg_obj.get_msg())
+            return
+        instruction = self.decode_instruction(msg_obj)
+        if (instruction):
+            self.execute_instruction(instruction)
+            if (self._sending_move_ack and instruction in PMessage.VALID_CMD_MSG_SET):
+                self.send_data(type=PMessage.T_ROBOT_MOVE,data=instruction)
+            if (self._sending_sensor_data):
+                self.send_sensor_data()
+
+        else: self.show_status("Instruction cannot be decoded!")
 
     def do_callibration(self,msg):
         if (msg==PMessage.M_CALLIBRATE_LEFT):
-            print("Callibrating to the left")
-        elif (msg==PMessage.M_CALLIBRATE_RIGHT):
-            print("Callibrating to the right")
+            self.show_status("Callibrating to the left")
         elif (msg==PMessage.M_CALLIBRATE_RIGHT):
-            print("Callibrating to the right")
+            self.show_status("Callibrating to the right")
+        elif (msg==PMessage.M_CALLIBRATE_FRONT):
+            self.show_status("Callibrating to the front")
 
     def decode_instruction(self,msg):
         return msg.get_msg()
@@ -165,14 +174,16 @@ class ArduinoController(BasePublisher,BaseSimulatorController):
             self._map_ref.refresh()
             try:
                 _,grid = instruct.split("*")
-                print("move forward by {} grids".format(int(grid)))
+                self.show_status("move forward by {} grids".format(int(grid)))
                 for i in range(int(grid)):
                     self._robot.move_forward()
-                    time.sleep(0.2)
+                    if (self.MOVE_DELAY):
+                        time.sleep(self.MOVE_DELAY)
             except Exception as e:
-                print ("Exception in multi-move forward:{}".format(e))
+                self.show_status("Exception in multi-move forward:{}".format(e))
         # simulate the delay in real execution
-        time.sleep(self.EXECUTION_DELAY)
+        if (self.EXECUTION_DELAY):
+            time.sleep(self.EXECUTION_DELAY)
 
     def reset(self):
         self._sending_sensor_data = True
@@ -203,6 +214,8 @@ class AndroidController(BasePublisher,BaseSimulatorController):
     _cur_explore_coverage = 0
 
     _MAP_UPDATE_IN_LIST = False
+    _topic = BasePublisher.TOPIC_STATUS
+    PREFERRED_FRAMING = PMessageStream.FRAMING_BINARY # map and robot updates are the bulk of the traffic
 
     def get_server_port(self):
         return ANDROID_SERVER_PORT
@@ -230,9 +243,10 @@ class AndroidController(BasePublisher,BaseSimulatorController):
                     self._robot.set_orientation(AbsoluteOrientation.get_instance(ls[2]))
                 elif (msg_obj.get_type()==PMessage.T_UPDATE_MAP_STATUS):
                     update_ls = msg_obj.get_msg().split("|")
-                    for update in update_ls:
-                        x,y,value = map(int,update.split(","))
-                        self._map_ref.set_cell(x,y,value)
+                    with self._map_ref.batch():
+                        for update in update_ls:
+                            x,y,value = map(int,update.split(","))
+                            self._map_ref.set_cell(x,y,value)
                     self._robot.refresh()
 
 
@@ -0,0 +1,52 @@
+"""
+fit the execution cost model of the planner to recorded runs,
+the logs are the debug output of a run on the real robot with DEBUG_INTERFACE enabled,
+the fitted model can be passed to simulators.benchmark with --cost-model,
+main.py loads it from interfaces.config.COST_MODEL_FILE
+
+usage: python -m simulators.costfit [-o cost_model.json] log files
+"""
+import argparse
+
+from algorithms.cost_model import ExecutionCostModel,parse_ack_log
+
+
+def fit_logs(log_files):
+    "return (model,samples) fitted to all the log files"
+    samples = []
+    for log_file in log_files:
+        with open(log_file) as f:
+            samples.extend(parse_ack_log(f))
+    return ExecutionCostModel.fit(samples),samples
+
+def get_errors(model,samples):
+    "return {command: (number of samples,mean measured seconds,mean absolute error of the model)}"
+    by_command = {}
+    for command,seconds in samples:
+        by_command.setdefault(command,[]).append(seconds)
+    errors = {}
+    for command,values in by_command.items():
+        predicted = model.get_command_time(command)
+        errors[command] = (len(values),sum(values)/len(values),sum([abs(v-predicted) for v in values])/len(values))
+    return errors
+
+def main():
+    parser = argparse.ArgumentParser(description="fit the execution cost model to timestamped ack logs of recorded runs")
+    parser.add_argument("logs",nargs="+",help="debug logs of runs on the robot")
+    parser.add_argument("-o","--output",help="write the fitted model to this json file")
+    args = parser.parse_args()
+
+    model,samples = fit_logs(args.logs)
+    row_format = "{:<10}{:>9}{:>12}{:>12}{:>12}"
+    print(row_format.format("command","samples","mean(s)","model(s)","error(s)"))
+    for command,(count,mean,error) in sorted(get_errors(model,samples).items()):
+        print(row_format.format(command,count,"{:.3f}".format(mean),"{:.3f}".format(model.get_command_time(command)),
+                                "{:.3f}".format(error)))
+    print("")
+    for name in ExecutionCostModel.PARAM_NAMES:
+        print("{:<16}{:>10.3f}".format(name,model.get_params()[name]))
+    if (args.output):
+        model.save(args.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+"""
+headless simulation of a whole run, exploration followed by fast run,
+the central controller and a simulated arduino are wired together in one thread,
+without sockets, GUI or sleeps, so a run takes milliseconds instead of minutes
+
+usage: python -m simulators.headless [--no-fastrun] [--frontier] [-v] [map files]
+"""
+import argparse
+import glob
+import os
+import time
+from Queue import Queue,Empty
+
+from common.amap import MapRef,MapSetting
+from common.robot import RobotRef
+from common.pmessage import PMessage
+from common.debug import DEBUG_SETTING
+from interfaces.config import ANDROID_LABEL,ARDUINO_LABEL
+from fsm.control import CentralController
+from fsm.states import ExplorationDoneState,EndState,ExplorationFirstRoundState
+from simulators.controllers import ArduinoController
+
+
+class HeadlessArduinoController(ArduinoController):
+    """
+    simulated arduino whose replies are collected instead of written to a socket
+    """
+    EXECUTION_DELAY = 0
+    MOVE_DELAY = 0
+    _outbox = None # list of PMessage to be read by the controller
+
+    def __init__(self,**kwargs):
+        self._map_ref = kwargs.get("map_ref")
+        self._robot = kwargs.get("robot_ref")
+        self._outbox = []
+
+    def send_data(self,type,data):
+        self._outbox.append(PMessage(type=type,msg=data))
+
+    def pop_outbox(self):
+        outbox,self._outbox = self._outbox,[]
+        return outbox
+
+    def show_status(self,msg):
+        pass
+
+    def reset(self):
+        self._sending_sensor_data = True
+        self._sending_move_ack = True
+        self._robot.reset()
+
+
+class HeadlessSimulation(object):
+    """
+    run exploration and fast run on one map file
+    the arduino side uses a robot on the true map, the controller builds its own map from the sensor readings
+    """
+    _MAX_MESSAGES = 2000 # per phase, guards against exploration that never ends
+
+    _name = None
+    _run_fastrun = True
+    _true_map = None # MapRef loaded from the map file
+    _true_robot = None # RobotRef moved by the simulated arduino
+    _arduino = None # HeadlessArduinoController
+    _controller = None # CentralController
+    _cmd_q = None
+    _data_q = None
+    _result = None # dict
+
+    def __init__(self,map_file=None,run_fastrun=True,map_ref=None,name=None):
+        "pass either map_file or map_ref, the true map"
+        self._run_fastrun = run_fastrun
+        if (map_ref is None):
+            map_ref = MapRef()
+            map_ref.load_map_from_file(map_file)
+        self._true_map = map_ref
+        self._name = name or os.path.basename(map_file)
+        self._true_robot = RobotRef()
+        self._arduino = HeadlessArduinoController(map_ref=self._true_map,robot_ref=self._true_robot)
+        self._cmd_q = Queue()
+        self._data_q = Queue()
+        # listeners look the controller up through get_instance()
+        self._controller = CentralController.reset_instance(input_q=Queue(),cmd_out_q=self._cmd_q,
+                                                            data_out_qs=[self._data_q],realtime=False)
+        self._controller.init_listeners()
+
+    def get_controller(self):
+        return self._controller
+
+    def get_true_map(self):
+        return self._true_map
+
+    def run(self):
+        "return a dict of the run statistics"
+        self.explore()
+        if (self._run_fastrun and self._result['explore_finished']):
+            self.fastrun()
+        return self._result
+
+    def explore(self):
+        "run the exploration, return the statistics so far"
+        self._result = {
+            'map':self._name,
+            'explore_steps':0,
+            'explore_commands':[],
+            'coverage_trace':[], # coverage after each exploration move
+            'fastrun_steps':0,
+            'fastrun_commands':[],
+            'fastrun_callibrations':[],
+            'fastrun_finished':False,
+            'reached_goal':False,
+            'arduino_messages':0,
+            'collisions':0,
+            'data_messages':0,
+            'fastrun_time':0,
+        }
+        start = time.time()
+        self._send_command(PMessage.M_START_EXPLORE)
+        self._run_until_idle(phase='explore')
+        self._result['explore_finished'] = isinstance(self._controller.get_state(),ExplorationDoneState)
+        self._result['coverage'] = 100-self._controller.get_map_ref().get_unknown_percentage()
+        self._result['map_errors'] = self.count_map_errors()
+        self._result['explore_time'] = time.time()-start
+        self._result['wall_time'] = self._result['explore_time']
+        return self._result
+
+    def fastrun(self):
+        "run the fast run after explore(), return the statistics"
+        start = time.time()
+        self._send_command(PMessage.M_START_FASTRUN)
+        self._run_until_idle(phase='fastrun')
+        robot = self._controller.get_robot_ref()
+        self._result['fastrun_finished'] = isinstance(self._controller.get_state(),EndState)
+        self._result['reached_goal'] = robot.get_position()==self._true_map.get_end_zone_center_pos()
+        self._result['fastrun_time'] = time.time()-start
+        self._result['wall_time'] = self._result['explore_time'] + self._result['fastrun_time']
+        return self._result
+
+    def count_map_errors(self):
+        "number of explored cells whose value is different from the true map"
+        explored = self._controller.get_map_ref()
+        errors = 0
+        for y in range(explored.size_y):
+            for x in range(explored.size_x):
+                value = explored.get_cell(x,y)
+                if (value!=MapSetting.UNKNOWN and
+                        (value==MapSetting.OBSTACLE)!=(self._true_map.get_cell(x,y)==MapSetting.OBSTACLE)):
+                    errors += 1
+        return errors
+
+    def _send_command(self,msg):
+        "command from android"
+        self._controller.process_input(ANDROID_LABEL,PMessage(type=PMessage.T_COMMAND,msg=msg))
+
+    def _run_until_idle(self,phase):
+        "deliver messages between controller and arduino until neither has anything to send, phase is explore or fastrun"
+        for i in range(self._MAX_MESSAGES):
+            self._drain_data()
+            try:
+                cmd = self._cmd_q.get_nowait()
+            except Empty:
+                break
+            self._result['arduino_messages'] += 1
+            is_move = cmd.get_type()==PMessage.T_COMMAND and cmd.get_msg() in PMessage.VALID_MOVE_COMMAND_SET
+            if (is_move):
+                self._result[phase+'_steps'] += 1
+                self._result[phase+'_commands'].append(cmd.get_msg())
+            elif (cmd.get_type()==PMessage.T_CALLIBRATE and phase=='fastrun'):
+                self._result['fastrun_callibrations'].append(cmd.get_msg())
+            self._arduino.handle_message(cmd)
+            if (not self._is_robot_position_valid()):
+                self._result['collisions'] += 1
+            for reply in self._arduino.pop_outbox():
+                self._controller.process_input(ARDUINO_LABEL,reply)
+            if (is_move and phase=='explore'):
+                self._result['coverage_trace'].append(100-self._controller.get_map_ref().get_unknown_percentage())
+        self._drain_data()
+
+    def _drain_data(self):
+        "updates for android and pc are only counted"
+        while (not self._data_q.empty()):
+            self._data_q.get_nowait()
+            self._result['data_messages'] += 1
+
+    def _is_robot_position_valid(self):
+        for x,y in self._true_robot.get_occupied_postions():
+            if (self._true_map.is_out_of_arena(x,y) or self._true_map.get_cell(x,y)==MapSetting.OBSTACLE):
+                return False
+        return True
+
+
+def simulate(map_file,run_fastrun=True):
+    "return the statistics of a full run on map_file"
+    return HeadlessSimulation(map_file=map_file,run_fastrun=run_fastrun).run()
+
+def get_map_files(patterns=None):
+    "map files matching the patterns, all .bin files in MapSetting.MAP_FILE_DIR by default"
+    if (not patterns):
+        patterns = [os.path.join(MapSetting.MAP_FILE_DIR,"*.bin")]
+    files = []
+    for pattern in patterns:
+        files.extend(sorted(glob.glob(pattern)) or [pattern])
+    # relative names are resolved against MapSetting.MAP_FILE_DIR by MapRef
+    return [os.path.abspath(f) if os.path.exists(f) else f for f in files]
+
+def main():
+    parser = argparse.ArgumentParser(description="run exploration and fast run without GUI, sockets or delays")
+    parser.add_argument("maps",nargs="*",help="map files, default to all .bin files in simulators/mapfiles")
+    parser.add_argument("--no-fastrun",action="store_true",help="only run exploration")
+    parser.add_argument("--frontier",action="store_true",help="explore with the frontier strategy instead of following the wall")
+    parser.add_argument("-v","--verbose",action="store_true",help="keep debug output")
+    args = parser.parse_args()
+    if (not args.verbose):
+        DEBUG_SETTING['enabled_types'] = []
+    ExplorationFirstRoundState._USE_FRONTIER_EXPLORATION = args.frontier
+    row_format = "{:<12}{:>8}{:>10}{:>8}{:>10}{:>9}{:>8}{:>10}"
+    print(row_format.format("map","steps","coverage","errors","fastrun","goal","crash","time(ms)"))
+    for map_file in get_map_files(args.maps):
+        result = simulate(map_file,run_fastrun=not args.no_fastrun)
+        print(row_format.format(result['map'],result['explore_steps'],"{:.1f}".format(result['coverage']),
+                                result['map_errors'],len(result['fastrun_commands']),
+                                "yes" if result['reached_goal'] else "no",result['collisions'],
+                                int(result['wall_time']*1000)))
+
+if __name__ == '__main__':
+    main()